@@ -1,10 +1,36 @@
 import os
-import requests
 import hmac
 import hashlib
+import time
 import uuid
-
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, g, request, jsonify
+
+from batching import Coalescer
+from expiry import ExpiryScheduler
+from http_client import HttpClient
+from idempotency import (
+    Idempotency,
+    MemoryIdempotencyBackend,
+    RedisIdempotencyBackend,
+    idempotency_key,
+)
+from metrics import Metrics
+from teams_card import (
+    MAX_RUN_MESSAGE_CHARS,
+    build_card_message,
+    open_url,
+    run_section_bytes,
+    truncate,
+)
+from token_store import MemoryTokenStore, RedisTokenStore, SQLiteTokenStore
+from delivery import (
+    DeliveryQueue,
+    DeliveryQueueFull,
+    MemoryDeliveryBackend,
+    RedisDeliveryBackend,
+)
 
 #
 # Optional Redis Setup
@@ -32,48 +58,108 @@ if REDIS_URL and redis is not None:
         print(f"Using Redis for token storage: {REDIS_URL}")
     except Exception as e:
         print(f"Failed to connect to Redis ({REDIS_URL}): {e}")
-        print("Falling back to in-memory storage.")
+        print("Falling back to local token storage.")
 else:
-    print(
-        "Redis not configured or redis library not available. Using in-memory storage."
-    )
+    print("Redis not configured or redis library not available. Using local storage.")
 
 #
-# In-Memory Fallback Store
+# Local Fallback Store
 #
-pending_callbacks_memory = {}
-
+# "memory" is per-process; "sqlite" is shared by every worker on the host.
+TOKEN_STORE_BACKEND = os.environ.get("TOKEN_STORE_BACKEND", "memory").lower()
+TOKEN_TTL_SECONDS = int(os.environ.get("TOKEN_TTL_SECONDS", "600"))
+TOKEN_STORE_MAX_SIZE = int(os.environ.get("TOKEN_STORE_MAX_SIZE", "10000"))
+TOKEN_STORE_SQLITE_PATH = os.environ.get(
+    "TOKEN_STORE_SQLITE_PATH", "/tmp/teams-approval-tokens.db"
+)
 
 #
-# Helper functions for ephemeral data
+# Expiry policy
 #
-def store_token(run_id, data, ttl_seconds=600):
-    if REDIS_ENABLED and redis_client:
-        import json
+# What happens when a pending approval's TTL runs out. "none" leaves the run
+# to HCP's own timeout; "fail" and "pass" resolve it; "renotify" posts it to
+# Teams again with a fresh link (up to EXPIRY_MAX_RENOTIFY times) and then
+# fails it.
+EXPIRY_POLICY = os.environ.get("EXPIRY_POLICY", "none").lower()
+EXPIRY_TRACKING = EXPIRY_POLICY in ("fail", "pass", "renotify")
+EXPIRY_POLL_SECONDS = float(os.environ.get("EXPIRY_POLL_SECONDS", "1"))
+EXPIRY_GRACE_SECONDS = float(os.environ.get("EXPIRY_GRACE_SECONDS", "300"))
+EXPIRY_MAX_RENOTIFY = int(os.environ.get("EXPIRY_MAX_RENOTIFY", "1"))
+EXPIRY_MAX_ATTEMPTS = int(os.environ.get("EXPIRY_MAX_ATTEMPTS", "5"))
+EXPIRY_RETRY_SECONDS = float(os.environ.get("EXPIRY_RETRY_SECONDS", "10"))
+
+if TOKEN_STORE_BACKEND == "sqlite":
+    local_token_store = SQLiteTokenStore(
+        TOKEN_STORE_SQLITE_PATH,
+        track_expiry=EXPIRY_TRACKING,
+        expiry_grace_seconds=EXPIRY_GRACE_SECONDS,
+    )
+else:
+    local_token_store = MemoryTokenStore(
+        max_size=TOKEN_STORE_MAX_SIZE, track_expiry=EXPIRY_TRACKING
+    )
 
-        redis_client.setex(run_id, ttl_seconds, json.dumps(data))
-    else:
-        pending_callbacks_memory[run_id] = data
+if not REDIS_ENABLED:
+    print(f"Using {local_token_store.name} token storage.")
 
+redis_token_store = None
+expiry_scheduler = None
 
-def get_token(run_id):
+
+def get_token_store():
+    """
+    Return the active TokenStore: Redis when it is enabled, otherwise the
+    local fallback.
+    """
+    global redis_token_store
     if REDIS_ENABLED and redis_client:
-        import json
+        if redis_token_store is None or redis_token_store.client is not redis_client:
+            redis_token_store = RedisTokenStore(
+                redis_client,
+                track_expiry=EXPIRY_TRACKING,
+                expiry_grace_seconds=EXPIRY_GRACE_SECONDS,
+            )
+        return redis_token_store
+    return local_token_store
 
-        raw = redis_client.get(run_id)
-        if raw is None:
-            return None
-        return json.loads(raw)
-    else:
-        return pending_callbacks_memory.get(run_id)
+
+#
+# Helper functions for ephemeral data
+#
+def store_token(run_id, data, ttl_seconds=None):
+    if ttl_seconds is None:
+        ttl_seconds = TOKEN_TTL_SECONDS
+    store = get_token_store()
+    with metrics.store_operation("store_token", store.name):
+        store.set(run_id, data, ttl_seconds)
+    if EXPIRY_TRACKING:
+        get_expiry_scheduler().start()
+
+
+def get_token(run_id):
+    store = get_token_store()
+    with metrics.store_operation("get_token", store.name):
+        return store.get(run_id)
 
 
 def remove_token(run_id):
-    if REDIS_ENABLED and redis_client:
-        redis_client.delete(run_id)
-    else:
-        if run_id in pending_callbacks_memory:
-            del pending_callbacks_memory[run_id]
+    store = get_token_store()
+    with metrics.store_operation("remove_token", store.name):
+        store.delete(run_id)
+
+
+def get_expiry_scheduler():
+    global expiry_scheduler
+    if expiry_scheduler is None:
+        expiry_scheduler = ExpiryScheduler(
+            get_token_store,
+            # Late-bound so the policy is resolved when a run expires
+            lambda run_id, data: handle_expired_run(run_id, data),
+            poll_seconds=EXPIRY_POLL_SECONDS,
+            max_attempts=EXPIRY_MAX_ATTEMPTS,
+            retry_seconds=EXPIRY_RETRY_SECONDS,
+        )
+    return expiry_scheduler
 
 
 def generate_uuid_based():
@@ -102,48 +188,297 @@ if not HMAC_KEY:
 if FILTER_SPECULATIVE_PLANS_ONLY:
     print("WARNING: Filtering for speculative plans only.")
 
+#
+# Metrics
+#
+# Prometheus metrics are served on /metrics when prometheus_client is
+# installed. With OTEL_TRACING_ENABLED, spans are also emitted through the
+# OpenTelemetry API; configure an SDK and exporter to collect them.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+OTEL_TRACING_ENABLED = os.environ.get("OTEL_TRACING_ENABLED", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+metrics = Metrics(enabled=METRICS_ENABLED, tracing=OTEL_TRACING_ENABLED)
 
-@app.before_request
-def verify_hmac():
+#
+# Teams delivery
+#
+# "sync" posts to Teams inside the request handler. "queue" acknowledges HCP
+# immediately and lets background workers post to Teams with retries.
+TEAMS_DELIVERY_MODE = os.environ.get("TEAMS_DELIVERY_MODE", "sync").lower()
+TEAMS_DELIVERY_QUEUE_SIZE = int(os.environ.get("TEAMS_DELIVERY_QUEUE_SIZE", "1000"))
+TEAMS_DELIVERY_WORKERS = int(os.environ.get("TEAMS_DELIVERY_WORKERS", "2"))
+TEAMS_DELIVERY_MAX_ATTEMPTS = int(os.environ.get("TEAMS_DELIVERY_MAX_ATTEMPTS", "5"))
+TEAMS_DELIVERY_BACKOFF_SECONDS = float(
+    os.environ.get("TEAMS_DELIVERY_BACKOFF_SECONDS", "1.0")
+)
+
+# Coalesce run tasks that arrive within this window into one digest card.
+# 0 disables batching and posts one card per run.
+TEAMS_BATCH_WINDOW_MS = int(os.environ.get("TEAMS_BATCH_WINDOW_MS", "0"))
+TEAMS_BATCH_MAX_SIZE = int(os.environ.get("TEAMS_BATCH_MAX_SIZE", "20"))
+# Budget for the run sections of one digest, leaving room for the envelope,
+# title and card actions under Teams' ~28 KB payload limit
+TEAMS_BATCH_MAX_BYTES = int(os.environ.get("TEAMS_BATCH_MAX_BYTES", "24000"))
+
+#
+# Bulk approve/reject
+#
+# Selecting runs by workspace or run_ids requires BULK_API_TOKEN as a bearer
+# token. A batch_id is unguessable and only ever appears on its digest card,
+# like the per-run uuid, so the card's "Approve all"/"Reject all" links need
+# nothing else.
+BULK_API_TOKEN = os.environ.get("BULK_API_TOKEN", "")
+BULK_MAX_IN_FLIGHT = int(os.environ.get("BULK_MAX_IN_FLIGHT", "10"))
+
+#
+# Duplicate deliveries
+#
+# HCP retries run task POSTs and proxies may replay them. A repeat of a
+# delivery that was already handled gets the original response back, for up
+# to IDEMPOTENCY_TTL_SECONDS (0 disables this). A repeat that arrives while
+# the original is still in progress waits up to IDEMPOTENCY_WAIT_SECONDS.
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "3600"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get("IDEMPOTENCY_WAIT_SECONDS", "10"))
+IDEMPOTENCY_LOCK_SECONDS = float(os.environ.get("IDEMPOTENCY_LOCK_SECONDS", "30"))
+
+delivery_queue = None
+coalescer = None
+bulk_executor = None
+idempotency = None
+local_idempotency_backend = MemoryIdempotencyBackend(max_size=TOKEN_STORE_MAX_SIZE)
+
+#
+# Outbound HTTP
+#
+# One pooled client for Teams posts and Terraform callbacks, so repeated calls
+# reuse keep-alive connections instead of paying a TCP+TLS handshake each time.
+http_client = HttpClient(
+    connect_timeout=float(os.environ.get("HTTP_CONNECT_TIMEOUT_SECONDS", "3.05")),
+    read_timeout=float(os.environ.get("HTTP_READ_TIMEOUT_SECONDS", "10")),
+    max_retries=int(os.environ.get("HTTP_MAX_RETRIES", "2")),
+    backoff_seconds=float(os.environ.get("HTTP_BACKOFF_SECONDS", "0.5")),
+    pool_maxsize=int(os.environ.get("HTTP_POOL_MAXSIZE", "20")),
+    breaker_threshold=int(os.environ.get("HTTP_BREAKER_THRESHOLD", "5")),
+    breaker_reset_seconds=float(os.environ.get("HTTP_BREAKER_RESET_SECONDS", "30")),
+    metrics=metrics,
+)
+
+
+def post_teams_message(teams_message, max_retries=None):
     """
-    Enforce HMAC checks ONLY on the POST /teams-approval route.
+    POST a rendered message to the Teams webhook, raising on failure.
     """
-    if request.path == "/teams-approval" and request.method == "POST":
-        local_key_configured = bool(HMAC_KEY)
-        inbound_signature = request.headers.get("X-Tfc-Task-Signature")
-        inbound_has_hmac = bool(inbound_signature)
+    resp = http_client.post(
+        TEAMS_WEBHOOK_URL, json=teams_message, max_retries=max_retries
+    )
+    resp.raise_for_status()
 
-        # CASE 1: both sides have HMAC
-        if inbound_has_hmac and local_key_configured:
-            provided_signature = inbound_signature.strip()
-            raw_body = request.get_data()
-            computed_signature = hmac.new(
-                key=HMAC_KEY.encode("utf-8"), msg=raw_body, digestmod=hashlib.sha512
-            ).hexdigest()
 
-            if not hmac.compare_digest(computed_signature, provided_signature):
-                return "Invalid HMAC signature", 403
+def get_delivery_queue():
+    """
+    Build the delivery queue on first use. It is backed by Redis when Redis is
+    enabled, so any replica can drain it; otherwise it lives in this process.
+    """
+    global delivery_queue
+    if delivery_queue is None:
+        if REDIS_ENABLED and redis_client:
+            backend = RedisDeliveryBackend(
+                redis_client, maxsize=TEAMS_DELIVERY_QUEUE_SIZE
+            )
+        else:
+            backend = MemoryDeliveryBackend(maxsize=TEAMS_DELIVERY_QUEUE_SIZE)
+        delivery_queue = DeliveryQueue(
+            # Late-bound so the webhook URL can be changed at runtime. The
+            # queue has its own retry schedule, so the client doesn't retry.
+            lambda message: post_teams_message(message, max_retries=0),
+            backend,
+            workers=TEAMS_DELIVERY_WORKERS,
+            max_attempts=TEAMS_DELIVERY_MAX_ATTEMPTS,
+            backoff_seconds=TEAMS_DELIVERY_BACKOFF_SECONDS,
+        )
+    return delivery_queue
 
-            return  # Valid HMAC → continue
 
-        # CASE 2: neither side has HMAC
-        elif not inbound_has_hmac and not local_key_configured:
-            return  # No HMAC → continue
+def deliver_teams_message(teams_message, label):
+    """
+    Send a rendered message using the configured delivery mode.
+    Returns True if it was queued, False if it was posted directly.
+    """
+    if TEAMS_DELIVERY_MODE == "queue":
+        try:
+            get_delivery_queue().enqueue(teams_message, label=label)
+            return True
+        except DeliveryQueueFull as e:
+            # Backpressure: deliver inline rather than drop the message
+            print(f"{e}; posting {label} to Teams directly.")
 
-        # CASE 3: inbound has HMAC, local doesn’t
-        elif inbound_has_hmac and not local_key_configured:
-            return "Inbound signature provided, but local key is not configured.", 403
+    post_teams_message(teams_message)
+    print(f"Posted approval request to Teams for {label}.")
+    return False
 
-        # CASE 4: local has HMAC, inbound doesn’t
-        else:  # not inbound_has_hmac and local_key_configured
-            return "No HMAC signature was provided, but we require one.", 403
 
+def flush_batch(batch_id, entries):
+    """
+    Render a closed batch as one digest card and deliver it.
 
-def patch_terraform_callback(access_token, callback_url, status, message):
+    Its runs were acknowledged to HCP when they joined the batch, so HCP
+    won't retry them. The digest therefore always goes through the delivery
+    queue, whatever TEAMS_DELIVERY_MODE says, for its retries and
+    dead-lettering.
     """
-    A helper function to send a PATCH to Terraform’s task callback URL.
-    - `status` should be one of: ["passed", "failed"] (or "canceled").
-    - `message` is a short description that Terraform will log.
+    if not entries:
+        return
+    label = f"batch {batch_id} ({len(entries)} runs)"
+    teams_message = build_digest_message(batch_id, entries)
+    queue = get_delivery_queue()
+    try:
+        queue.enqueue(teams_message, label=label)
+    except DeliveryQueueFull as e:
+        print(f"{e}; posting {label} to Teams directly.")
+        item = {"message": teams_message, "label": label, "enqueued_at": time.time()}
+        try:
+            post_teams_message(teams_message)
+        except Exception as post_error:
+            print(f"Failed to post {label} to Teams; dead-lettering it: {post_error}")
+            queue.dead_letter(item, post_error)
+            return
+        print(f"Posted approval request to Teams for {label}.")
+
+
+def stop_delivery():
+    """
+    Flush the open digest batch and stop the delivery workers, on worker
+    shutdown. The batch's runs were already acknowledged to HCP, so it must
+    not die with its timer. Flush first: enqueueing after stop() would start
+    the workers again.
+    """
+    if coalescer is not None:
+        coalescer.flush_now()
+    if delivery_queue is not None:
+        delivery_queue.stop()
+
+
+def get_coalescer():
+    global coalescer
+    if coalescer is None:
+        coalescer = Coalescer(
+            flush_batch,
+            window_seconds=TEAMS_BATCH_WINDOW_MS / 1000.0,
+            max_batch_size=TEAMS_BATCH_MAX_SIZE,
+            max_batch_bytes=TEAMS_BATCH_MAX_BYTES,
+            item_size=run_section_bytes,
+        )
+    return coalescer
+
+
+def get_idempotency():
+    """
+    Return the duplicate-delivery guard: shared through Redis when it is
+    enabled, otherwise local to this process.
+    """
+    global idempotency
+    if REDIS_ENABLED and redis_client:
+        backend = idempotency.backend if idempotency else None
+        if getattr(backend, "client", None) is not redis_client:
+            backend = RedisIdempotencyBackend(redis_client)
+    else:
+        backend = local_idempotency_backend
+    if idempotency is None or idempotency.backend is not backend:
+        idempotency = Idempotency(
+            backend,
+            ttl_seconds=IDEMPOTENCY_TTL_SECONDS,
+            lock_seconds=IDEMPOTENCY_LOCK_SECONDS,
+            wait_seconds=IDEMPOTENCY_WAIT_SECONDS,
+        )
+    return idempotency
+
+
+def check_hmac(inbound_signature, raw_body):
+    """
+    Check a run task request's X-Tfc-Task-Signature against HMAC_KEY.
+    Returns None when the request may proceed, otherwise a (message, 403) tuple.
+    """
+    local_key_configured = bool(HMAC_KEY)
+    inbound_has_hmac = bool(inbound_signature)
+
+    # CASE 1: both sides have HMAC
+    if inbound_has_hmac and local_key_configured:
+        provided_signature = inbound_signature.strip()
+        computed_signature = hmac.new(
+            key=HMAC_KEY.encode("utf-8"), msg=raw_body, digestmod=hashlib.sha512
+        ).hexdigest()
+
+        if not hmac.compare_digest(computed_signature, provided_signature):
+            return "Invalid HMAC signature", 403
+
+        return None  # Valid HMAC → continue
+
+    # CASE 2: neither side has HMAC
+    elif not inbound_has_hmac and not local_key_configured:
+        return None  # No HMAC → continue
+
+    # CASE 3: inbound has HMAC, local doesn’t
+    elif inbound_has_hmac and not local_key_configured:
+        return "Inbound signature provided, but local key is not configured.", 403
+
+    # CASE 4: local has HMAC, inbound doesn’t
+    else:  # not inbound_has_hmac and local_key_configured
+        return "No HMAC signature was provided, but we require one.", 403
+
+
+def metrics_route():
+    """
+    The route pattern a request matched, so metric labels stay bounded.
+    """
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+# Registered ahead of verify_hmac so rejected requests are still counted
+@app.before_request
+def start_request_metrics():
+    g.metrics_handle = metrics.request_started(metrics_route(), request.method)
+
+
+@app.after_request
+def record_request_metrics(response):
+    handle = g.pop("metrics_handle", None)
+    if handle is not None:
+        metrics.request_finished(
+            metrics_route(), request.method, response.status_code, handle
+        )
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    # Only reached with a handle left if the request failed before a response
+    handle = g.pop("metrics_handle", None)
+    if handle is not None:
+        metrics.request_finished(metrics_route(), request.method, 500, handle)
+
+
+@app.before_request
+def verify_hmac():
+    """
+    Enforce HMAC checks ONLY on the POST /teams-approval route.
+    """
+    if request.path == "/teams-approval" and request.method == "POST":
+        with metrics.hmac_check():
+            return check_hmac(
+                request.headers.get("X-Tfc-Task-Signature"), request.get_data()
+            )
+
+
+def build_callback_request(access_token, status, message):
+    """
+    Build the body and headers for a PATCH to Terraform’s task callback URL.
     """
     patch_body = {
         "data": {
@@ -155,11 +490,203 @@ def patch_terraform_callback(access_token, callback_url, status, message):
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/vnd.api+json",
     }
+    return patch_body, headers
 
-    resp = requests.patch(callback_url, json=patch_body, headers=headers)
+
+def patch_terraform_callback(access_token, callback_url, status, message):
+    """
+    A helper function to send a PATCH to Terraform’s task callback URL.
+    - `status` should be one of: ["passed", "failed"] (or "canceled").
+    - `message` is a short description that Terraform will log.
+    """
+    patch_body, headers = build_callback_request(access_token, status, message)
+    resp = http_client.patch(callback_url, json=patch_body, headers=headers)
     resp.raise_for_status()
 
 
+def build_run_entry(payload, uuid_string):
+    """
+    Collect the fields shown for one run in a Teams card, including its
+    Approve/Reject links.
+    """
+    run_id = payload.get("run_id", "unknown-run-id")
+    entry = {
+        "run_id": run_id,
+        "workspace": payload.get("workspace_name", "unknown-workspace"),
+        "stage": payload.get("stage", "unknown-stage"),
+        "is_speculative": payload.get("is_speculative", False),
+        "run_created_by": payload.get("run_created_by", ""),
+        "run_message": truncate(
+            payload.get("run_message") or "", MAX_RUN_MESSAGE_CHARS
+        ),
+        "workspace_app_url": payload.get("workspace_app_url"),
+        "vcs_pull_request_url": payload.get("vcs_pull_request_url"),
+        "vcs_commit_url": payload.get("vcs_commit_url"),
+    }
+    entry.update(build_run_links(run_id, uuid_string))
+    return entry
+
+
+def build_run_links(run_id, uuid_string):
+    """
+    Approve/Reject links for one run.
+    """
+    # Build Approve/Reject links - get latest hostname from env var
+    base_public_url = os.environ.get("CONTAINER_APP_HOSTNAME", "")
+    return {
+        "approve_link": (
+            f"https://{base_public_url}/approve?run_id={run_id}&uuid={uuid_string}"
+        ),
+        "reject_link": (
+            f"https://{base_public_url}/reject?run_id={run_id}&uuid={uuid_string}"
+        ),
+    }
+
+
+def build_teams_message(payload, uuid_string):
+    """
+    Render the Teams Adaptive Card for a single run task payload.
+    """
+    return build_card_message([build_run_entry(payload, uuid_string)])
+
+
+def build_digest_message(batch_id, entries):
+    """
+    Render a batch of runs as one Adaptive Card.
+    """
+    if len(entries) == 1:
+        return build_card_message(entries)
+
+    base_public_url = os.environ.get("CONTAINER_APP_HOSTNAME", "")
+    return build_card_message(
+        entries,
+        title=f"**{len(entries)} runs** have requested approval.",
+        actions=[
+            open_url(
+                "Approve all",
+                f"https://{base_public_url}/bulk-approve?batch_id={batch_id}",
+                "positive",
+            ),
+            open_url(
+                "Reject all",
+                f"https://{base_public_url}/bulk-reject?batch_id={batch_id}",
+                "destructive",
+            ),
+        ],
+    )
+
+
+def handle_expired_run(run_id, data):
+    """
+    Apply EXPIRY_POLICY to a run whose approval window has closed. Called by
+    the expiry scheduler exactly once per expiry.
+
+    A run evicted from a full in-memory store is always failed: its window
+    is still open, so passing it would skip the approval, and re-storing it
+    for a reminder would only evict another run.
+    """
+    if data.get("evicted"):
+        message = (
+            f"Run {run_id} was dropped from a full token store before it was "
+            "approved or rejected; marked failed."
+        )
+        patch_terraform_callback(
+            data["access_token"], data["callback_url"], "failed", message
+        )
+        print(message)
+        return
+
+    renotify_count = data.get("renotify_count", 0)
+    if (
+        EXPIRY_POLICY == "renotify"
+        and data.get("entry")
+        and renotify_count < EXPIRY_MAX_RENOTIFY
+    ):
+        uuid_string = generate_uuid_based()
+        entry = dict(data["entry"], **build_run_links(run_id, uuid_string))
+        store_token(
+            run_id,
+            dict(
+                data, uuid=uuid_string, entry=entry, renotify_count=renotify_count + 1
+            ),
+        )
+        deliver_teams_message(
+            build_card_message(
+                [entry], title="**Reminder:** this run is still waiting for approval."
+            ),
+            f"run {run_id} (reminder)",
+        )
+        return
+
+    status = "passed" if EXPIRY_POLICY == "pass" else "failed"
+    message = f"Run {run_id} was not approved or rejected in time; marked {status}."
+    patch_terraform_callback(
+        data["access_token"], data["callback_url"], status, message
+    )
+    print(message)
+
+
+def handle_run_task(payload):
+    """
+    Act on a validated run task payload: auto-approve it, or store its token
+    and post it to Teams. Returns the response as a (body, status) tuple.
+    """
+    access_token = payload["access_token"]
+    callback_url = payload["task_result_callback_url"]
+    run_id = payload.get("run_id", "unknown-run-id")
+    workspace = payload.get("workspace_name", "unknown-workspace")
+    is_speculative = payload.get("is_speculative", False)
+
+    # If user wants to only require approval for SPECULATIVE runs:
+    if FILTER_SPECULATIVE_PLANS_ONLY and not is_speculative:
+        # Instead of 'skipping', we automatically "pass" (auto-approve)
+        # so the pipeline doesn’t get stuck.
+        try:
+            patch_terraform_callback(
+                access_token,
+                callback_url,
+                "passed",
+                f"Run {run_id} auto-approved (non-speculative).",
+            )
+            print(
+                f"Auto-approved non-speculative run {run_id} from workspace {workspace}"
+            )
+            return "Auto-approved non-speculative run", 200
+        except Exception as e:
+            return f"Error auto-approving run: {str(e)}", 500
+
+    # Otherwise (speculative or filter is off), proceed with manual approval flow:
+    uuid_string = generate_uuid_based()
+    token = {
+        "access_token": access_token,
+        "callback_url": callback_url,
+        "uuid": uuid_string,
+        "workspace": workspace,
+    }
+    entry = build_run_entry(payload, uuid_string)
+    if EXPIRY_POLICY == "renotify":
+        # Kept so the run can be posted again when it expires
+        token["entry"] = entry
+
+    if TEAMS_BATCH_WINDOW_MS > 0:
+        # The token must be stored before the batch can be delivered
+        get_coalescer().add(
+            entry,
+            on_join=lambda batch_id: store_token(
+                run_id, dict(token, batch_id=batch_id)
+            ),
+        )
+        print(f"Added run {run_id} to Teams digest batch.")
+        return "Run task received. Added to Teams digest.", 200
+
+    store_token(run_id, token)
+    teams_message = build_card_message([entry])
+
+    if deliver_teams_message(teams_message, f"run {run_id}"):
+        return "Run task received. Teams message queued for delivery.", 200
+    return "Run task received. Posted message to Teams.", 200
+
+
 @app.route("/teams-approval", methods=["POST"])
 def teams_approval():
     """
@@ -179,8 +706,6 @@ def teams_approval():
         callback_url = payload.get("task_result_callback_url")
         run_id = payload.get("run_id", "unknown-run-id")
         stage = payload.get("stage", "unknown-stage")
-        workspace = payload.get("workspace_name", "unknown-workspace")
-        is_speculative = payload.get("is_speculative", False)
 
         if not access_token or not callback_url:
             return "Missing 'access_token' or 'task_result_callback_url'", 400
@@ -189,76 +714,15 @@ def teams_approval():
             print("Received test token; ignoring.")
             return "Test token received. No action taken.", 200
 
-        # If user wants to only require approval for SPECULATIVE runs:
-        if FILTER_SPECULATIVE_PLANS_ONLY and not is_speculative:
-            # Instead of 'skipping', we automatically "pass" (auto-approve)
-            # so the pipeline doesn’t get stuck.
-            try:
-                patch_terraform_callback(
-                    access_token,
-                    callback_url,
-                    "passed",
-                    f"Run {run_id} auto-approved (non-speculative).",
-                )
-                print(
-                    f"Auto-approved non-speculative run {run_id} from workspace {workspace}"
-                )
-                return "Auto-approved non-speculative run", 200
-            except Exception as e:
-                return f"Error auto-approving run: {str(e)}", 500
-
-        # Otherwise (speculative or filter is off), proceed with manual approval flow:
-        uuid_string = generate_uuid_based()
-        store_token(
-            run_id,
-            {
-                "access_token": access_token,
-                "callback_url": callback_url,
-                "uuid": uuid_string,
-            },
-        )
+        if IDEMPOTENCY_TTL_SECONDS <= 0:
+            return handle_run_task(payload)
 
-        run_created_by = payload.get("run_created_by", "")
-        run_message = payload.get("run_message", "")
-        vcs_pull_request_url = payload.get("vcs_pull_request_url")
-        vcs_commit_url = payload.get("vcs_commit_url")
-        workspace_app_url = payload.get("workspace_app_url")
-
-        # Build Approve/Reject links - get latest hostname from env var
-        base_public_url = os.environ.get("CONTAINER_APP_HOSTNAME", "")
-        approve_link = (
-            f"https://{base_public_url}/approve?run_id={run_id}&uuid={uuid_string}"
-        )
-        reject_link = (
-            f"https://{base_public_url}/reject?run_id={run_id}&uuid={uuid_string}"
-        )
-
-        message_lines = [
-            f"Workspace **{workspace}** has requested approval.",
-            f"Run ID: **{run_id}**",
-            f"Stage: **{stage}**",
-            f"Speculative: **{'Yes' if is_speculative else 'No'}**",
-        ]
-        if run_created_by:
-            message_lines.append(f"Triggered by: **{run_created_by}**")
-        if run_message:
-            message_lines.append(f"Run Message: {run_message}")
-        if workspace_app_url:
-            message_lines.append(f"[Open Workspace]({workspace_app_url})")
-        if vcs_pull_request_url:
-            message_lines.append(f"[View Pull Request]({vcs_pull_request_url})")
-        elif vcs_commit_url:
-            message_lines.append(f"[View Commit]({vcs_commit_url})")
-
-        # Approve/Reject links
-        message_lines.append(f"[Approve]({approve_link}) | [Reject]({reject_link})")
-        teams_message = {"text": "\n\n".join(message_lines)}
-
-        # POST to Teams
-        resp = requests.post(TEAMS_WEBHOOK_URL, json=teams_message)
-        resp.raise_for_status()
-        print(f"Posted approval request to Teams for run {run_id}.")
-        return "Run task received. Posted message to Teams.", 200
+        # HMAC has already been checked against this exact body
+        key = idempotency_key(run_id, stage, request.get_data())
+        result = get_idempotency().run(key, lambda: handle_run_task(payload))
+        if result is None:
+            return "Duplicate run task delivery is still being processed.", 409
+        return result
 
     except Exception as e:
         return f"Error in teams_approval: {str(e)}", 500
@@ -334,5 +798,166 @@ def reject():
         return f"Error rejecting run: {str(e)}", 500
 
 
+def get_bulk_executor():
+    global bulk_executor
+    if bulk_executor is None:
+        # Shared by all bulk requests, so BULK_MAX_IN_FLIGHT bounds the total
+        # number of concurrent callback PATCHes from this process
+        bulk_executor = ThreadPoolExecutor(
+            max_workers=BULK_MAX_IN_FLIGHT, thread_name_prefix="bulk-callback"
+        )
+    return bulk_executor
+
+
+def bulk_authorized(authorization):
+    if not BULK_API_TOKEN:
+        return False
+    return hmac.compare_digest(authorization or "", f"Bearer {BULK_API_TOKEN}")
+
+
+def parse_bulk_selection(params):
+    """
+    Read (workspace, run_ids, batch_id) from a JSON body or query string.
+    run_ids may be a list or a comma-separated string.
+    """
+    run_ids = params.get("run_ids")
+    if isinstance(run_ids, str):
+        run_ids = [run_id for run_id in run_ids.split(",") if run_id]
+    return params.get("workspace"), run_ids, params.get("batch_id")
+
+
+def bulk_lookup(workspace=None, run_ids=None, batch_id=None):
+    """
+    Pick the single index lookup for a selection: ("find", field, value)
+    or ("get_many", run_ids).
+    """
+    if batch_id:
+        return ("find", "batch_id", batch_id)
+    if workspace:
+        return ("find", "workspace", workspace)
+    return ("get_many", run_ids)
+
+
+def filter_pending_runs(runs, workspace=None, run_ids=None):
+    """
+    Narrow the lookup result to runs matching every remaining selector.
+    """
+    if workspace:
+        runs = {k: v for k, v in runs.items() if v.get("workspace") == workspace}
+    if run_ids:
+        runs = {k: v for k, v in runs.items() if k in run_ids}
+    return runs
+
+
+def find_pending_runs(workspace=None, run_ids=None, batch_id=None):
+    """
+    Return {run_id: token data} for pending runs matching every given selector.
+    Index lookups come from the token store in a single call.
+    """
+    method, *args = bulk_lookup(workspace, run_ids, batch_id)
+    runs = getattr(get_token_store(), method)(*args)
+    return filter_pending_runs(runs, workspace, run_ids)
+
+
+def summarize_bulk_results(action, results):
+    failed = sum(1 for result in results if result["status"] == "error")
+    return {
+        "action": action,
+        "matched": len(results),
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "results": results,
+    }
+
+
+def resolve_pending_run(run_id, data, status, message):
+    """
+    PATCH one run's callback and drop its token. Returns a per-run result.
+    """
+    try:
+        patch_terraform_callback(
+            data["access_token"], data["callback_url"], status, message
+        )
+        remove_token(run_id)
+        print(message)
+        return {"run_id": run_id, "status": status}
+    except Exception as e:
+        return {"run_id": run_id, "status": "error", "error": str(e)}
+
+
+def bulk_resolve(status, action):
+    """
+    Shared body of /bulk-approve and /bulk-reject.
+    """
+    if request.method == "POST":
+        params = request.get_json(silent=True) or {}
+    else:
+        params = request.args
+    workspace, run_ids, batch_id = parse_bulk_selection(params)
+    if not (workspace or run_ids or batch_id):
+        return "Provide 'workspace', 'run_ids' or 'batch_id'", 400
+    if (workspace or run_ids) and not bulk_authorized(
+        request.headers.get("Authorization")
+    ):
+        return "Selecting runs by workspace or run_ids requires BULK_API_TOKEN.", 403
+
+    runs = find_pending_runs(workspace=workspace, run_ids=run_ids, batch_id=batch_id)
+    if not runs:
+        return "No pending run tasks match this selection or they have expired.", 404
+
+    executor = get_bulk_executor()
+    futures = [
+        executor.submit(
+            resolve_pending_run,
+            run_id,
+            data,
+            status,
+            f"Run {run_id} {action} via bulk action.",
+        )
+        for run_id, data in runs.items()
+    ]
+    summary = summarize_bulk_results(action, [future.result() for future in futures])
+    return jsonify(summary), 502 if summary["failed"] else 200
+
+
+@app.route("/bulk-approve", methods=["GET", "POST"])
+def bulk_approve():
+    """
+    Approve every pending run matching a workspace, run_ids or batch_id.
+    """
+    return bulk_resolve("passed", "approved")
+
+
+@app.route("/bulk-reject", methods=["GET", "POST"])
+def bulk_reject():
+    """
+    Reject every pending run matching a workspace, run_ids or batch_id.
+    """
+    return bulk_resolve("failed", "rejected")
+
+
+@app.route("/delivery-stats", methods=["GET"])
+def delivery_stats():
+    """
+    Queue depth, dead-letter depth and delivery latency for the Teams queue.
+    """
+    if TEAMS_DELIVERY_MODE != "queue":
+        return jsonify({"mode": TEAMS_DELIVERY_MODE})
+    stats = get_delivery_queue().stats()
+    stats["mode"] = TEAMS_DELIVERY_MODE
+    return jsonify(stats)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    Prometheus scrape endpoint.
+    """
+    if not metrics.enabled:
+        return "Metrics are disabled or prometheus_client is not installed.", 404
+    body, content_type = metrics.render()
+    return body, 200, {"Content-Type": content_type}
+
+
 if __name__ == "__main__":
     app.run(port=8080, debug=True)
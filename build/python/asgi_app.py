@@ -0,0 +1,439 @@
+"""
+Async (ASGI) serving mode.
+
+Serves the same /teams-approval, /approve and /reject routes as the Flask app,
+using an async HTTP client and async Redis, so one process can hold thousands
+of outbound Teams posts and Terraform PATCHes in flight at once.
+
+Configuration, HMAC checking and message rendering are shared with app.py.
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8080
+"""
+
+import asyncio
+import contextlib
+import json
+import os
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+import app as wsgi
+from http_client import AsyncHttpClient
+from idempotency import (
+    AsyncIdempotency,
+    AsyncMemoryIdempotencyBackend,
+    AsyncRedisIdempotencyBackend,
+    idempotency_key,
+)
+from token_store import AsyncLocalTokenStore, AsyncRedisTokenStore
+
+#
+# Optional async Redis
+#
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+ASGI_MAX_CONNECTIONS = int(os.environ.get("ASGI_MAX_CONNECTIONS", "1000"))
+
+http_client = None
+token_store = None
+idempotency = None
+bulk_semaphore = None
+
+
+def build_token_store():
+    """
+    Async Redis when the Flask side found Redis reachable, otherwise the same
+    local fallback store the Flask app uses.
+    """
+    if wsgi.REDIS_ENABLED and aioredis is not None:
+        if wsgi.REDIS_PASSWORD:
+            client = aioredis.Redis.from_url(
+                wsgi.REDIS_URL, password=wsgi.REDIS_PASSWORD
+            )
+        else:
+            client = aioredis.Redis.from_url(wsgi.REDIS_URL)
+        return AsyncRedisTokenStore(
+            client,
+            track_expiry=wsgi.EXPIRY_TRACKING,
+            expiry_grace_seconds=wsgi.EXPIRY_GRACE_SECONDS,
+        )
+    return AsyncLocalTokenStore(wsgi.local_token_store)
+
+
+def build_idempotency():
+    """
+    Duplicate-delivery guard sharing the token store's Redis client, or the
+    Flask app's local record when Redis is not enabled.
+    """
+    if isinstance(token_store, AsyncRedisTokenStore):
+        backend = AsyncRedisIdempotencyBackend(token_store.client)
+    else:
+        backend = AsyncMemoryIdempotencyBackend(wsgi.local_idempotency_backend)
+    return AsyncIdempotency(
+        backend,
+        ttl_seconds=wsgi.IDEMPOTENCY_TTL_SECONDS,
+        lock_seconds=wsgi.IDEMPOTENCY_LOCK_SECONDS,
+        wait_seconds=wsgi.IDEMPOTENCY_WAIT_SECONDS,
+    )
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    global http_client, token_store, idempotency, bulk_semaphore
+    http_client = AsyncHttpClient(
+        connect_timeout=wsgi.http_client.timeout[0],
+        read_timeout=wsgi.http_client.timeout[1],
+        max_retries=wsgi.http_client.max_retries,
+        backoff_seconds=wsgi.http_client.backoff_seconds,
+        pool_maxsize=wsgi.http_client.pool_maxsize,
+        breaker_threshold=wsgi.http_client.breaker_threshold,
+        breaker_reset_seconds=wsgi.http_client.breaker_reset_seconds,
+        max_connections=ASGI_MAX_CONNECTIONS,
+        metrics=wsgi.metrics,
+    )
+    token_store = build_token_store()
+    idempotency = build_idempotency()
+    # Bounds concurrent callback PATCHes across all bulk requests
+    bulk_semaphore = asyncio.Semaphore(wsgi.BULK_MAX_IN_FLIGHT)
+    print(f"ASGI mode using {token_store.name} token storage.")
+    if wsgi.EXPIRY_TRACKING:
+        # The sweep is thread-based and uses the sync store, which shares
+        # its keys with the async one
+        wsgi.get_expiry_scheduler().start()
+    try:
+        yield
+    finally:
+        # Flushes the open digest batch and hands messages waiting on a
+        # retry back to the queue
+        await asyncio.to_thread(wsgi.stop_delivery)
+        await http_client.aclose()
+        if isinstance(token_store, AsyncRedisTokenStore):
+            await token_store.client.aclose()
+
+
+async def patch_terraform_callback(access_token, callback_url, status, message):
+    """
+    Async version of app.patch_terraform_callback().
+    """
+    patch_body, headers = wsgi.build_callback_request(access_token, status, message)
+    resp = await http_client.patch(callback_url, json=patch_body, headers=headers)
+    resp.raise_for_status()
+
+
+async def post_teams_message(teams_message):
+    resp = await http_client.post(wsgi.TEAMS_WEBHOOK_URL, json=teams_message)
+    resp.raise_for_status()
+
+
+async def handle_run_task(payload):
+    """
+    Async version of app.handle_run_task().
+    """
+    access_token = payload["access_token"]
+    callback_url = payload["task_result_callback_url"]
+    run_id = payload.get("run_id", "unknown-run-id")
+    workspace = payload.get("workspace_name", "unknown-workspace")
+    is_speculative = payload.get("is_speculative", False)
+
+    if wsgi.FILTER_SPECULATIVE_PLANS_ONLY and not is_speculative:
+        try:
+            await patch_terraform_callback(
+                access_token,
+                callback_url,
+                "passed",
+                f"Run {run_id} auto-approved (non-speculative).",
+            )
+            print(
+                f"Auto-approved non-speculative run {run_id} from workspace {workspace}"
+            )
+            return "Auto-approved non-speculative run", 200
+        except Exception as e:
+            return f"Error auto-approving run: {str(e)}", 500
+
+    uuid_string = wsgi.generate_uuid_based()
+    token = {
+        "access_token": access_token,
+        "callback_url": callback_url,
+        "uuid": uuid_string,
+        "workspace": workspace,
+    }
+    entry = wsgi.build_run_entry(payload, uuid_string)
+    if wsgi.EXPIRY_POLICY == "renotify":
+        token["entry"] = entry
+
+    if wsgi.TEAMS_BATCH_WINDOW_MS > 0:
+        # The coalescer is thread-based and may flush (post to Teams) on the
+        # calling thread, so keep it off the loop. The sync store shares
+        # its keys with the async one.
+        await asyncio.to_thread(
+            wsgi.get_coalescer().add,
+            entry,
+            lambda batch_id: wsgi.store_token(run_id, dict(token, batch_id=batch_id)),
+        )
+        print(f"Added run {run_id} to Teams digest batch.")
+        return "Run task received. Added to Teams digest.", 200
+
+    with wsgi.metrics.store_operation("store_token", token_store.name):
+        await token_store.set(run_id, token, wsgi.TOKEN_TTL_SECONDS)
+    teams_message = wsgi.build_card_message([entry])
+
+    if wsgi.TEAMS_DELIVERY_MODE == "queue":
+        try:
+            # The queue's backend may be Redis; keep its I/O off the loop
+            await asyncio.to_thread(
+                wsgi.get_delivery_queue().enqueue, teams_message, f"run {run_id}"
+            )
+            return "Run task received. Teams message queued for delivery.", 200
+        except wsgi.DeliveryQueueFull as e:
+            print(f"{e}; posting run {run_id} to Teams directly.")
+
+    await post_teams_message(teams_message)
+    print(f"Posted approval request to Teams for run {run_id}.")
+    return "Run task received. Posted message to Teams.", 200
+
+
+async def teams_approval(request):
+    """
+    Async version of app.teams_approval(), including the HMAC check that the
+    Flask app does in verify_hmac().
+    """
+    raw_body = await request.body()
+    with wsgi.metrics.hmac_check():
+        hmac_error = wsgi.check_hmac(
+            request.headers.get("X-Tfc-Task-Signature"), raw_body
+        )
+    if hmac_error:
+        return PlainTextResponse(*hmac_error)
+
+    try:
+        payload = json.loads(raw_body) if raw_body else {}
+        payload = payload or {}
+        access_token = payload.get("access_token")
+        callback_url = payload.get("task_result_callback_url")
+        run_id = payload.get("run_id", "unknown-run-id")
+        stage = payload.get("stage", "unknown-stage")
+
+        if not access_token or not callback_url:
+            return PlainTextResponse(
+                "Missing 'access_token' or 'task_result_callback_url'", 400
+            )
+
+        if access_token == "test-token" and stage == "test":
+            print("Received test token; ignoring.")
+            return PlainTextResponse("Test token received. No action taken.", 200)
+
+        if wsgi.IDEMPOTENCY_TTL_SECONDS <= 0:
+            result = await handle_run_task(payload)
+        else:
+            key = idempotency_key(run_id, stage, raw_body)
+            result = await idempotency.run(key, lambda: handle_run_task(payload))
+            if result is None:
+                return PlainTextResponse(
+                    "Duplicate run task delivery is still being processed.", 409
+                )
+        return PlainTextResponse(*result)
+
+    except Exception as e:
+        return PlainTextResponse(f"Error in teams_approval: {str(e)}", 500)
+
+
+async def resolve_run(request, status, action):
+    """
+    Shared body of /approve and /reject: check the link, PATCH Terraform,
+    then drop the token.
+    """
+    run_id = request.query_params.get("run_id")
+    if not run_id:
+        return PlainTextResponse("Missing 'run_id' parameter", 400)
+    uuid = request.query_params.get("uuid")
+    if not uuid:
+        return PlainTextResponse("Missing 'uuid' parameter", 400)
+
+    with wsgi.metrics.store_operation("get_token", token_store.name):
+        data = await token_store.get(run_id)
+    if not data:
+        return PlainTextResponse(
+            "No pending run task for this run_id or it has expired.", 404
+        )
+
+    if uuid != data["uuid"]:
+        return PlainTextResponse(
+            "UUID mismatch. This link may have expired or been tampered with.", 403
+        )
+
+    message = f"Run {run_id} {action} via Teams link."
+
+    try:
+        await patch_terraform_callback(
+            data["access_token"], data["callback_url"], status, message
+        )
+        with wsgi.metrics.store_operation("remove_token", token_store.name):
+            await token_store.delete(run_id)
+        print(message)
+        return PlainTextResponse(
+            f"Run {run_id} {action.upper()}. You can close this page."
+        )
+    except Exception as e:
+        verb = "approving" if status == "passed" else "rejecting"
+        return PlainTextResponse(f"Error {verb} run: {str(e)}", 500)
+
+
+async def approve(request):
+    """
+    Approve route: PATCH run status to "passed".
+    """
+    return await resolve_run(request, "passed", "approved")
+
+
+async def reject(request):
+    """
+    Reject route: PATCH run status to "failed".
+    """
+    return await resolve_run(request, "failed", "rejected")
+
+
+async def resolve_pending_run(run_id, data, status, message):
+    """
+    Async version of app.resolve_pending_run().
+    """
+    async with bulk_semaphore:
+        try:
+            await patch_terraform_callback(
+                data["access_token"], data["callback_url"], status, message
+            )
+            with wsgi.metrics.store_operation("remove_token", token_store.name):
+                await token_store.delete(run_id)
+            print(message)
+            return {"run_id": run_id, "status": status}
+        except Exception as e:
+            return {"run_id": run_id, "status": "error", "error": str(e)}
+
+
+async def bulk_resolve(request, status, action):
+    """
+    Async version of app.bulk_resolve().
+    """
+    if request.method == "POST":
+        try:
+            params = await request.json()
+        except ValueError:
+            params = {}
+    else:
+        params = request.query_params
+    workspace, run_ids, batch_id = wsgi.parse_bulk_selection(params or {})
+
+    if not (workspace or run_ids or batch_id):
+        return PlainTextResponse("Provide 'workspace', 'run_ids' or 'batch_id'", 400)
+    if (workspace or run_ids) and not wsgi.bulk_authorized(
+        request.headers.get("Authorization")
+    ):
+        return PlainTextResponse(
+            "Selecting runs by workspace or run_ids requires BULK_API_TOKEN.", 403
+        )
+
+    method, *args = wsgi.bulk_lookup(workspace, run_ids, batch_id)
+    runs = wsgi.filter_pending_runs(
+        await getattr(token_store, method)(*args), workspace, run_ids
+    )
+    if not runs:
+        return PlainTextResponse(
+            "No pending run tasks match this selection or they have expired.", 404
+        )
+
+    results = await asyncio.gather(
+        *(
+            resolve_pending_run(
+                run_id, data, status, f"Run {run_id} {action} via bulk action."
+            )
+            for run_id, data in runs.items()
+        )
+    )
+    summary = wsgi.summarize_bulk_results(action, list(results))
+    return JSONResponse(summary, 502 if summary["failed"] else 200)
+
+
+async def bulk_approve(request):
+    return await bulk_resolve(request, "passed", "approved")
+
+
+async def bulk_reject(request):
+    return await bulk_resolve(request, "failed", "rejected")
+
+
+async def delivery_stats(request):
+    """
+    Async version of app.delivery_stats(). Reading a Redis-backed queue's
+    depth blocks, so it runs in a worker thread.
+    """
+    if wsgi.TEAMS_DELIVERY_MODE != "queue":
+        return JSONResponse({"mode": wsgi.TEAMS_DELIVERY_MODE})
+    stats = await asyncio.to_thread(lambda: wsgi.get_delivery_queue().stats())
+    stats["mode"] = wsgi.TEAMS_DELIVERY_MODE
+    return JSONResponse(stats)
+
+
+async def metrics_endpoint(request):
+    """
+    Prometheus scrape endpoint.
+    """
+    if not wsgi.metrics.enabled:
+        return PlainTextResponse(
+            "Metrics are disabled or prometheus_client is not installed.", 404
+        )
+    body, content_type = wsgi.metrics.render()
+    return Response(body, media_type=content_type)
+
+
+class MetricsMiddleware:
+    """
+    Records latency, in-flight requests and error statuses per route. Plain
+    ASGI rather than BaseHTTPMiddleware, which would add a task per request.
+    """
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = frozenset(routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        route = path if path in self.routes else "unmatched"
+        method = scope["method"]
+        handle = wsgi.metrics.request_started(route, method)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            wsgi.metrics.request_finished(route, method, status, handle)
+
+
+routes = [
+    Route("/teams-approval", teams_approval, methods=["POST"]),
+    Route("/approve", approve, methods=["GET"]),
+    Route("/reject", reject, methods=["GET"]),
+    Route("/bulk-approve", bulk_approve, methods=["GET", "POST"]),
+    Route("/bulk-reject", bulk_reject, methods=["GET", "POST"]),
+    Route("/delivery-stats", delivery_stats, methods=["GET"]),
+    Route("/metrics", metrics_endpoint, methods=["GET"]),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(MetricsMiddleware, routes=[r.path for r in routes])],
+    lifespan=lifespan,
+)
@@ -0,0 +1,118 @@
+import threading
+import uuid
+
+
+class Coalescer:
+    """
+    Collects items into batches and hands each batch to `flush` once the
+    coalescing window closes or the batch reaches `max_batch_size`,
+    whichever comes first. With `max_batch_bytes`, a batch is also flushed
+    early when the next item's `item_size(item)` would take it over that
+    budget; the item then opens a new batch.
+
+    The window opens when the first item of a batch arrives, so a lone item
+    waits at most `window_seconds`. `flush(batch_id, items)` runs on a timer
+    thread, or on the caller's thread when a batch fills up.
+    """
+
+    def __init__(
+        self,
+        flush,
+        window_seconds=2.0,
+        max_batch_size=20,
+        max_batch_bytes=None,
+        item_size=len,
+    ):
+        self.flush = flush
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.item_size = item_size
+        self._lock = threading.Lock()
+        self._batch_id = None
+        self._items = []
+        self._bytes = 0
+        self._timer = None
+
+    def add(self, item, on_join=None):
+        """
+        Add an item to the open batch and return that batch's id.
+
+        `on_join(batch_id)` runs before the batch can be flushed. Use it for
+        anything that must happen before the batch is delivered, such as
+        storing the run's token. If it raises, the item is not added and
+        the exception propagates; a batch opened just for this item is
+        discarded.
+        """
+        size = self.item_size(item) if self.max_batch_bytes else 0
+        overflow = full = None
+        with self._lock:
+            if (
+                self.max_batch_bytes
+                and self._batch_id is not None
+                and self._bytes + size > self.max_batch_bytes
+            ):
+                self._timer.cancel()
+                overflow = self._take()
+            opened = self._batch_id is None
+            if opened:
+                self._batch_id = uuid.uuid4().hex
+                self._timer = threading.Timer(
+                    self.window_seconds, self._flush_expired, args=(self._batch_id,)
+                )
+                self._timer.daemon = True
+                self._timer.start()
+            batch_id = self._batch_id
+            if on_join is not None:
+                try:
+                    on_join(batch_id)
+                except BaseException:
+                    if opened:
+                        self._timer.cancel()
+                        self._take()
+                    raise
+            self._items.append(item)
+            self._bytes += size
+            if len(self._items) >= self.max_batch_size:
+                self._timer.cancel()
+                full = self._take()
+        if overflow is not None:
+            self._flush(*overflow)
+        if full is not None:
+            self._flush(*full)
+        return batch_id
+
+    def _take(self):
+        batch = (self._batch_id, self._items)
+        self._batch_id = None
+        self._items = []
+        self._bytes = 0
+        self._timer = None
+        return batch
+
+    def _flush_expired(self, batch_id):
+        with self._lock:
+            # The batch may already have been flushed for being full
+            if self._batch_id != batch_id:
+                return
+            batch = self._take()
+        self._flush(*batch)
+
+    def _flush(self, batch_id, items):
+        if not items:
+            return
+        try:
+            self.flush(batch_id, items)
+        except Exception as e:
+            print(f"Failed to flush batch {batch_id} ({len(items)} items): {e}")
+
+    def flush_now(self):
+        """
+        Flush the open batch immediately, if there is one.
+        """
+        with self._lock:
+            if self._batch_id is None:
+                return
+            self._timer.cancel()
+            batch = self._take()
+        self._flush(*batch)
@@ -0,0 +1,403 @@
+"""
+End-to-end load test: /teams-approval -> Teams card -> /approve -> Terraform.
+
+Starts the stub Teams webhook and Terraform callback servers, runs the app
+under gunicorn (Flask) or uvicorn (ASGI) against each token store backend,
+and drives run tasks at a fixed rate. Each simulated run is POSTed with a
+valid HMAC signature. The driver then reads the approve link from the card
+the Teams stub received and follows it. Latency percentiles are reported for
+both legs and for the whole flow.
+
+Requests are scheduled open-loop: each run's latency is measured from when
+it was due to start, not from when the driver got round to sending it, so a
+slow server can't hide its own queueing delay.
+
+    python -m benchmarks.load_test --rate 50 --duration 20
+    python -m benchmarks.load_test --find-max --backends memory,redis \\
+        --redis-url redis://localhost:6379/0 --teams-latency-ms 80
+
+Run it from build/python. The driver shares the host with the app, so on a
+small machine the driver may become the bottleneck before the app does.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.stub_servers import TeamsWebhookStub, TerraformCallbackStub
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HMAC_KEY = "benchmark-hmac-key"
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        "p50_ms": _ms(percentile(values, 50)),
+        "p95_ms": _ms(percentile(values, 95)),
+        "p99_ms": _ms(percentile(values, 99)),
+        "max_ms": _ms(values[-1] if values else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 2)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+#
+# App under test
+#
+class AppServer:
+    """
+    Runs the app in a subprocess, pointed at the stub servers.
+    """
+
+    def __init__(self, args, backend, teams_url):
+        self.args = args
+        self.backend = backend
+        self.teams_url = teams_url
+        self.port = free_port()
+        self.process = None
+        self.log = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def environment(self):
+        env = dict(os.environ)
+        env.update(
+            {
+                "TEAMS_WEBHOOK_URL": self.teams_url,
+                "HMAC_KEY": HMAC_KEY,
+                "CONTAINER_APP_HOSTNAME": f"127.0.0.1:{self.port}",
+                "TOKEN_STORE_BACKEND": "memory",
+                "PYTHONUNBUFFERED": "1",
+            }
+        )
+        env.pop("REDIS_URL", None)
+        if self.backend == "redis":
+            env["REDIS_URL"] = self.args.redis_url
+        for setting in self.args.app_env:
+            key, _, value = setting.partition("=")
+            env[key] = value
+        return env
+
+    def command(self):
+        bind = f"127.0.0.1:{self.port}"
+        if self.args.server == "uvicorn":
+            return [
+                sys.executable,
+                *("-m", "uvicorn", "asgi_app:app"),
+                *("--host", "127.0.0.1", "--port", str(self.port)),
+                *("--log-level", "warning", "--no-access-log"),
+            ]
+        # The memory store is per process, so /approve must reach the worker
+        # that stored the token
+        workers = 1 if self.backend == "memory" else self.args.workers
+        return [
+            sys.executable,
+            *("-m", "gunicorn", "app:app", "--bind", bind),
+            *("--workers", str(workers), "--threads", str(self.args.threads)),
+            *("--worker-class", "gthread", "--backlog", "2048"),
+        ]
+
+    def start(self, timeout=30.0):
+        self.log = tempfile.NamedTemporaryFile(
+            prefix=f"bench-{self.backend}-", suffix=".log", delete=False
+        )
+        self.process = subprocess.Popen(
+            self.command(),
+            cwd=APP_DIR,
+            env=self.environment(),
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"App exited during startup; see {self.log.name}")
+            try:
+                # 400 (missing run_id) means the app is up and routing
+                if requests.get(f"{self.url}/approve", timeout=1).status_code == 400:
+                    return self
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"App did not start in {timeout}s; see {self.log.name}")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.log is not None:
+            self.log.close()
+
+
+#
+# Load driver
+#
+class Driver:
+    """
+    Simulates HCP delivering run tasks and a person approving each one.
+    """
+
+    def __init__(self, app_url, teams, callback, max_in_flight=256, timeout=30.0):
+        self.app_url = app_url
+        self.teams = teams
+        self.callback = callback
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def session(self):
+        # One keep-alive session per driver thread
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def run_task_body(self, run_id):
+        payload = {
+            "payload_version": 1,
+            "stage": "post_plan",
+            "access_token": f"token-{run_id}",
+            "task_result_callback_url": (
+                f"{self.callback.url}/api/v2/task-results/{run_id}"
+            ),
+            "run_id": run_id,
+            "run_message": "Benchmark run",
+            "run_created_by": "benchmark",
+            "is_speculative": True,
+            "workspace_name": f"bench-ws-{hash(run_id) % 10}",
+            "workspace_app_url": "https://app.terraform.io/app/org/workspaces/ws",
+            "vcs_commit_url": "https://github.com/org/repo/commit/abc123",
+        }
+        return json.dumps(payload).encode("utf-8")
+
+    def one_run(self, run_id, scheduled):
+        """
+        Returns (error, teams_approval seconds, approve seconds, total seconds).
+        """
+        session = self.session()
+        body = self.run_task_body(run_id)
+        signature = hmac.new(HMAC_KEY.encode(), body, hashlib.sha512).hexdigest()
+        try:
+            resp = session.post(
+                f"{self.app_url}/teams-approval",
+                data=body,
+                headers={
+                    "Content-Type": "application/json",
+                    "X-Tfc-Task-Signature": signature,
+                },
+                timeout=self.timeout,
+            )
+            posted = time.perf_counter()
+            if resp.status_code != 200:
+                return f"teams-approval {resp.status_code}", None, None, None
+
+            # Immediate in sync delivery mode; waits for a worker in queue mode
+            run_uuid = self.teams.wait_for_uuid(run_id, self.timeout)
+            if run_uuid is None:
+                return "no Teams card", posted - scheduled, None, None
+
+            clicked = time.perf_counter()
+            resp = session.get(
+                f"{self.app_url}/approve",
+                params={"run_id": run_id, "uuid": run_uuid},
+                timeout=self.timeout,
+            )
+            done = time.perf_counter()
+            if resp.status_code != 200:
+                return f"approve {resp.status_code}", posted - scheduled, None, None
+            return None, posted - scheduled, done - clicked, done - scheduled
+        except requests.RequestException as e:
+            return type(e).__name__, None, None, None
+
+    def run(self, rate, duration):
+        """
+        Start `rate` runs per second for `duration` seconds and wait for all
+        of them to finish.
+        """
+        total = max(1, int(rate * duration))
+        prefix = uuid.uuid4().hex[:8]
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            start = time.perf_counter() + 0.05
+            futures = []
+            for i in range(total):
+                scheduled = start + i / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(
+                    pool.submit(self.one_run, f"run-bench-{prefix}-{i}", scheduled)
+                )
+            results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+
+        errors = Counter(error for error, *_ in results if error)
+        ok = [result for result in results if result[0] is None]
+        return {
+            "target_rps": rate,
+            "achieved_rps": round(len(ok) / elapsed, 2),
+            "runs": total,
+            "succeeded": len(ok),
+            "error_rate": round(1 - len(ok) / total, 4),
+            "errors": dict(errors),
+            "teams_approval": summarize([r[1] for r in ok]),
+            "approve": summarize([r[2] for r in ok]),
+            "end_to_end": summarize([r[3] for r in ok]),
+        }
+
+
+def sustainable(step, args):
+    return (
+        step["error_rate"] <= args.max_error_rate
+        and step["end_to_end"]["p99_ms"] is not None
+        and step["end_to_end"]["p99_ms"] <= args.slo_p99_ms
+        and step["achieved_rps"] >= 0.95 * step["target_rps"]
+    )
+
+
+def print_step(backend, step):
+    e2e, post, approve = step["end_to_end"], step["teams_approval"], step["approve"]
+    print(
+        f"[{backend}] target {step['target_rps']:>7} rps | "
+        f"achieved {step['achieved_rps']:>7} | errors {step['error_rate']:.2%} | "
+        f"e2e p50/p95/p99/max {e2e['p50_ms']}/{e2e['p95_ms']}/{e2e['p99_ms']}/"
+        f"{e2e['max_ms']} ms | teams-approval p99 {post['p99_ms']} ms | "
+        f"approve p99 {approve['p99_ms']} ms"
+    )
+    if step["errors"]:
+        print(f"[{backend}]   errors: {step['errors']}")
+
+
+def benchmark_backend(backend, args, teams, callback):
+    app = AppServer(args, backend, teams.url).start()
+    try:
+        driver = Driver(app.url, teams, callback, max_in_flight=args.max_in_flight)
+        # Warm up connection pools and imports before measuring
+        driver.run(min(args.rate, 20), 1)
+
+        if not args.find_max:
+            step = driver.run(args.rate, args.duration)
+            print_step(backend, step)
+            return {"steps": [step]}
+
+        steps, best, rate = [], None, args.rate
+        while rate <= args.max_rate:
+            step = driver.run(rate, args.duration)
+            print_step(backend, step)
+            steps.append(step)
+            if not sustainable(step, args):
+                break
+            best = rate
+            rate = round(rate * args.ramp_factor, 1)
+        print(f"[{backend}] max sustainable rate: {best} rps")
+        return {"steps": steps, "max_sustainable_rps": best}
+    finally:
+        app.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="End-to-end load test for the Teams approval app."
+    )
+    parser.add_argument("--backends", default="memory,redis")
+    parser.add_argument("--redis-url", default=os.environ.get("BENCH_REDIS_URL"))
+    parser.add_argument("--server", choices=["gunicorn", "uvicorn"], default="gunicorn")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=50.0, help="Runs per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per step")
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument(
+        "--find-max",
+        action="store_true",
+        help="Ramp the rate up from --rate until the run stops being sustainable",
+    )
+    parser.add_argument("--ramp-factor", type=float, default=1.5)
+    parser.add_argument("--max-rate", type=float, default=5000.0)
+    parser.add_argument("--slo-p99-ms", type=float, default=1000.0)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    for stub in ("teams", "callback"):
+        parser.add_argument(f"--{stub}-latency-ms", type=float, default=0.0)
+        parser.add_argument(f"--{stub}-jitter-ms", type=float, default=0.0)
+        parser.add_argument(f"--{stub}-error-rate", type=float, default=0.0)
+        parser.add_argument(f"--{stub}-error-status", type=int, default=503)
+    parser.add_argument(
+        "--app-env",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Extra environment for the app, e.g. TEAMS_DELIVERY_MODE=queue",
+    )
+    parser.add_argument("--json", help="Write results to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    if "redis" in backends and not args.redis_url:
+        print("Skipping redis backend: pass --redis-url or set BENCH_REDIS_URL.")
+        backends.remove("redis")
+
+    teams = TeamsWebhookStub(
+        args.teams_latency_ms,
+        args.teams_jitter_ms,
+        args.teams_error_rate,
+        args.teams_error_status,
+    )
+    callback = TerraformCallbackStub(
+        args.callback_latency_ms,
+        args.callback_jitter_ms,
+        args.callback_error_rate,
+        args.callback_error_status,
+    )
+    results = {}
+    with teams, callback:
+        for backend in backends:
+            results[backend] = benchmark_backend(backend, args, teams, callback)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
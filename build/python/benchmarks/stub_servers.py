@@ -0,0 +1,170 @@
+"""
+Local stand-ins for the Teams incoming webhook and the Terraform task-result
+callback, so the app can be load tested without touching real services.
+
+Each stub answers any path, can add a fixed delay plus random jitter to every
+request, and can fail a fraction of requests with a chosen status.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Approve links in a rendered card: .../approve?run_id=<run_id>&uuid=<uuid>
+APPROVE_LINK = re.compile(r"/approve\?run_id=([^&\"]+)&uuid=(\w+)")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under load
+    request_queue_size = 1024
+
+
+class StubServer:
+    """
+    Threaded HTTP server with latency and error injection. Subclasses
+    override `handle` to act on requests that weren't failed on purpose.
+    """
+
+    name = "stub"
+
+    def __init__(
+        self,
+        latency_ms=0.0,
+        jitter_ms=0.0,
+        error_rate=0.0,
+        error_status=503,
+        host="127.0.0.1",
+        port=0,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.host = host
+        self.port = port
+
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so the app's pooled client behaves as it would in
+            # production
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out as separate writes; without this,
+            # Nagle plus delayed ACKs adds ~40ms to every keep-alive response
+            disable_nagle_algorithm = True
+
+            def _serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, response = stub._respond(self.command, self.path, body)
+                payload = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PATCH = _serve
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _Server((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name=f"{self.name}-stub", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _respond(self, method, path, body):
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and random.random() < self.error_rate:
+                self.errors += 1
+                return self.error_status, {"error": "injected failure"}
+        return self.handle(method, path, body)
+
+    def handle(self, method, path, body):
+        return 200, {}
+
+
+class TeamsWebhookStub(StubServer):
+    """
+    Accepts Teams cards and remembers the approve link for each run, so a
+    load driver can click "Approve" the way a person would.
+    """
+
+    name = "teams"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._posted = threading.Condition()
+        self.approvals = {}  # run_id -> uuid
+
+    def handle(self, method, path, body):
+        links = APPROVE_LINK.findall(body.decode("utf-8", "replace"))
+        with self._posted:
+            self.approvals.update(links)
+            self._posted.notify_all()
+        return 200, {}
+
+    def wait_for_uuid(self, run_id, timeout=10.0):
+        """
+        The uuid from `run_id`'s approve link, once its card has been posted.
+        Returns None on timeout.
+        """
+        with self._posted:
+            self._posted.wait_for(lambda: run_id in self.approvals, timeout)
+            return self.approvals.get(run_id)
+
+
+class TerraformCallbackStub(StubServer):
+    """
+    Accepts task-result PATCHes and records the status sent for each path.
+    """
+
+    name = "terraform"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results = {}  # path -> status
+
+    def handle(self, method, path, body):
+        try:
+            status = json.loads(body)["data"]["attributes"]["status"]
+        except (ValueError, KeyError, TypeError):
+            return 422, {"error": "malformed task result"}
+        with self._lock:
+            self.results[path] = status
+        return 200, {}
@@ -0,0 +1,129 @@
+"""
+Micro-benchmarks for the per-request hot paths: HMAC verification, card
+rendering and token store operations.
+
+    pip install -r requirements-bench.txt
+    python -m pytest benchmarks/test_microbench.py --benchmark-autosave
+    python -m pytest benchmarks/test_microbench.py --benchmark-compare \\
+        --benchmark-compare-fail=mean:15%
+
+The Redis store benchmark needs a real server (BENCH_REDIS_URL); fakeredis
+timings say nothing about the network round trip that dominates in
+production.
+"""
+
+import hashlib
+import hmac
+import itertools
+import json
+import os
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import app
+from idempotency import MemoryIdempotencyBackend, idempotency_key
+from token_store import MemoryTokenStore, RedisTokenStore, SQLiteTokenStore
+
+HMAC_KEY = "benchmark-hmac-key"
+
+
+@pytest.fixture
+def payload():
+    return {
+        "payload_version": 1,
+        "stage": "post_plan",
+        "access_token": "x" * 400,
+        "task_result_callback_url": (
+            "https://app.terraform.io/api/v2/task-results/taskrs-abc123/callback"
+        ),
+        "run_id": "run-abc123",
+        "run_message": "Update network module for the staging environment",
+        "run_created_by": "jdoe",
+        "is_speculative": True,
+        "workspace_name": "networking-staging",
+        "workspace_app_url": "https://app.terraform.io/app/org/workspaces/ws",
+        "vcs_pull_request_url": "https://github.com/org/repo/pull/42",
+        "vcs_commit_url": "https://github.com/org/repo/commit/abc123",
+    }
+
+
+@pytest.fixture
+def token():
+    return {
+        "access_token": "x" * 400,
+        "callback_url": "https://app.terraform.io/api/v2/task-results/abc/callback",
+        "uuid": "abc123def456",
+        "workspace": "networking-staging",
+    }
+
+
+def test_hmac_verify(benchmark, monkeypatch, payload):
+    body = json.dumps(payload).encode("utf-8")
+    signature = hmac.new(HMAC_KEY.encode(), body, hashlib.sha512).hexdigest()
+    monkeypatch.setattr(app, "HMAC_KEY", HMAC_KEY)
+    assert benchmark(app.check_hmac, signature, body) is None
+
+
+def test_render_card(benchmark, payload):
+    result = benchmark(
+        lambda: json.dumps(app.build_teams_message(payload, "abc123def456"))
+    )
+    assert "abc123def456" in result
+
+
+def test_render_digest(benchmark, payload):
+    entries = [
+        app.build_run_entry(dict(payload, run_id=f"run-{i}"), f"uuid{i}")
+        for i in range(app.TEAMS_BATCH_MAX_SIZE)
+    ]
+    result = benchmark(
+        lambda: json.dumps(app.build_digest_message("batch-1", entries))
+    )
+    assert "Approve all" in result
+
+
+def test_idempotency_check(benchmark, payload):
+    body = json.dumps(payload).encode("utf-8")
+    backend = MemoryIdempotencyBackend()
+    counter = itertools.count()
+
+    def check():
+        key = idempotency_key(f"run-{next(counter)}", "post_plan", body)
+        backend.claim(key, "owner", 30)
+        backend.complete(key, "owner", ("ok", 200), 3600)
+
+    benchmark(check)
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryTokenStore()
+    if request.param == "sqlite":
+        return SQLiteTokenStore(str(tmp_path / "tokens.db"))
+    redis_url = os.environ.get("BENCH_REDIS_URL")
+    if not redis_url or app.redis is None:
+        pytest.skip("Set BENCH_REDIS_URL to benchmark the Redis store")
+    return RedisTokenStore(app.redis.Redis.from_url(redis_url))
+
+
+def test_store_lifecycle(benchmark, store, token):
+    """
+    One run's worth of store traffic: store_token, get_token, remove_token.
+    """
+    counter = itertools.count()
+
+    def lifecycle():
+        run_id = f"run-bench-{next(counter)}"
+        store.set(run_id, token, 600)
+        assert store.get(run_id) is not None
+        store.delete(run_id)
+
+    benchmark(lifecycle)
+
+
+def test_store_get(benchmark, store, token):
+    store.set("run-bench-get", token, 600)
+    assert benchmark(store.get, "run-bench-get") == token
@@ -0,0 +1,389 @@
+import json
+import os
+import queue
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+
+from http_client import CircuitOpenError
+
+
+class DeliveryQueueFull(Exception):
+    """Raised when a message cannot be enqueued because the queue is at capacity."""
+
+
+#
+# Queue backends
+#
+class MemoryDeliveryBackend:
+    """
+    Bounded in-process queue. Only the process that enqueued a message can
+    deliver it, which is fine for a single replica.
+    """
+
+    def __init__(self, maxsize=1000, dead_letter_size=100):
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._dead = deque(maxlen=dead_letter_size)
+
+    def put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            raise DeliveryQueueFull(f"Delivery queue is full ({self.maxsize} items)")
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def ack(self, item):
+        pass
+
+    def keepalive(self):
+        pass
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def dead_letter(self, item):
+        self._dead.append(item)
+
+    def dead_letter_depth(self):
+        return len(self._dead)
+
+
+class RedisDeliveryBackend:
+    """
+    Redis list used as a shared queue, so any replica can drain messages
+    enqueued by any other. Failed messages are pushed to a capped
+    dead-letter list alongside it.
+
+    `get` moves each message atomically (BLMOVE, Redis 6.2+) into a
+    processing list owned by this process, and `ack` removes it once it has
+    been delivered, dead-lettered or handed back. A process that dies
+    mid-delivery stops refreshing its heartbeat key, and after
+    `stale_seconds` any other consumer moves its processing list back onto
+    the queue. Delivery is therefore at least once: a message can be posted
+    twice if its consumer died between the post and the ack, but it is
+    never lost.
+    """
+
+    def __init__(
+        self,
+        client,
+        key="teams-approval:delivery",
+        maxsize=1000,
+        dead_letter_size=100,
+        stale_seconds=60.0,
+    ):
+        self.client = client
+        self.key = key
+        self.dead_key = f"{key}:dead"
+        self.consumers_key = f"{key}:consumers"
+        self.maxsize = maxsize
+        self.dead_letter_size = dead_letter_size
+        self.stale_seconds = stale_seconds
+
+        self._lock = threading.Lock()
+        self._receipts = {}  # id(item) -> raw list entry, for ack
+        self._pid = None
+        self.consumer = None
+        self._beat_at = 0.0
+        self._reclaimed_at = 0.0
+
+    def processing_key(self, consumer):
+        return f"{self.key}:processing:{consumer}"
+
+    def heartbeat_key(self, consumer):
+        return f"{self.key}:heartbeat:{consumer}"
+
+    def put(self, item):
+        # The length check and push are not atomic, so the bound is approximate
+        # when several replicas enqueue at once. That's close enough for backpressure.
+        if self.client.llen(self.key) >= self.maxsize:
+            raise DeliveryQueueFull(f"Delivery queue is full ({self.maxsize} items)")
+        self.client.lpush(self.key, json.dumps(item))
+
+    def keepalive(self):
+        """
+        Register this process as a consumer and refresh its heartbeat, at
+        most a few times per `stale_seconds`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked worker is a consumer of its own
+                self._pid = os.getpid()
+                self.consumer = (
+                    f"{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:8]}"
+                )
+                self._receipts = {}
+                self._beat_at = 0.0
+            elif now - self._beat_at < self.stale_seconds / 3:
+                return
+            self._beat_at = now
+        pipe = self.client.pipeline(transaction=False)
+        pipe.sadd(self.consumers_key, self.consumer)
+        pipe.set(
+            self.heartbeat_key(self.consumer),
+            1,
+            px=int(self.stale_seconds * 1000),
+        )
+        pipe.execute()
+
+    def get(self, timeout):
+        self.keepalive()
+        if time.monotonic() - self._reclaimed_at >= self.stale_seconds:
+            self._reclaimed_at = time.monotonic()
+            self.reclaim()
+        raw = self.client.blmove(
+            self.key,
+            self.processing_key(self.consumer),
+            max(1, int(timeout)),
+            "RIGHT",
+            "LEFT",
+        )
+        if raw is None:
+            return None
+        item = json.loads(raw)
+        with self._lock:
+            self._receipts[id(item)] = raw
+        return item
+
+    def ack(self, item):
+        with self._lock:
+            raw = self._receipts.pop(id(item), None)
+        if raw is not None:
+            self.client.lrem(self.processing_key(self.consumer), 1, raw)
+
+    def reclaim(self):
+        """
+        Move messages held by consumers whose heartbeat has lapsed back onto
+        the queue. Returns the number of messages moved.
+        """
+        moved = 0
+        for consumer in self.client.smembers(self.consumers_key):
+            if isinstance(consumer, bytes):
+                consumer = consumer.decode("utf-8")
+            if consumer == self.consumer or self.client.exists(
+                self.heartbeat_key(consumer)
+            ):
+                continue
+            # LMOVE is atomic, so two replicas reclaiming at once can't
+            # duplicate a message; they just share the work
+            processing = self.processing_key(consumer)
+            while self.client.lmove(processing, self.key, "RIGHT", "RIGHT"):
+                moved += 1
+            self.client.srem(self.consumers_key, consumer)
+        if moved:
+            print(f"Reclaimed {moved} undelivered Teams messages from stale consumers")
+        return moved
+
+    def depth(self):
+        return self.client.llen(self.key)
+
+    def dead_letter(self, item):
+        pipe = self.client.pipeline()
+        pipe.lpush(self.dead_key, json.dumps(item))
+        pipe.ltrim(self.dead_key, 0, self.dead_letter_size - 1)
+        pipe.execute()
+
+    def dead_letter_depth(self):
+        return self.client.llen(self.dead_key)
+
+
+#
+# Delivery workers
+#
+class DeliveryQueue:
+    """
+    Hands Teams messages to background worker threads, which call `send`
+    with retry, exponential backoff and dead-lettering. `send` should not
+    retry on its own, or every queue attempt multiplies into several posts.
+
+    While the webhook's circuit breaker is open, workers wait for it to let
+    a trial call through instead of spending attempts, so a Teams outage
+    longer than the backoff schedule doesn't dead-letter everything queued.
+
+    Workers are started lazily on the first enqueue so that gunicorn can fork
+    its workers before any threads exist.
+    """
+
+    def __init__(
+        self,
+        send,
+        backend,
+        workers=2,
+        max_attempts=5,
+        backoff_seconds=1.0,
+        max_backoff_seconds=30.0,
+    ):
+        self.send = send
+        self.backend = backend
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._pid = None
+
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+
+    def enqueue(self, message, label=None):
+        """
+        Queue a message for delivery. `label` names it in logs, e.g. "run run-abc".
+        """
+        item = {"message": message, "label": label, "enqueued_at": time.time()}
+        self.backend.put(item)
+        self.start()
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._threads:
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"teams-delivery-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                item = self.backend.get(timeout=1.0)
+            except Exception as e:
+                print(f"Delivery queue read failed: {e}")
+                self._stop.wait(self.backoff_seconds)
+                continue
+            if item is None:
+                continue
+            try:
+                self.deliver(item)
+                self.backend.ack(item)
+            except Exception as e:
+                # Unacknowledged, so a shared backend reclaims it later
+                print(f"Teams delivery worker failed: {e}")
+
+    def _backoff(self, attempt):
+        delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (attempt - 1))
+        # Full jitter, so retries from several workers don't line up
+        return random.uniform(0, delay)
+
+    def deliver(self, item):
+        """
+        Deliver a single queued item, retrying up to `max_attempts` times.
+        Returns True on success; on final failure the item is dead-lettered.
+        """
+        label = item.get("label") or "message"
+        attempt = 0
+        while True:
+            try:
+                self.send(item["message"])
+            except CircuitOpenError as e:
+                # Jittered, so waiting workers don't all race for the trial call
+                delay = e.retry_after + random.uniform(0, self.backoff_seconds)
+                print(f"Teams delivery for {label} waiting {delay:.1f}s: {e}")
+                if self._pause(delay):
+                    return self._requeue(item)
+                continue
+            except Exception as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    self.dead_letter(item, e, attempt)
+                    print(
+                        f"Giving up on Teams delivery for {label} after {attempt} attempts: {e}"
+                    )
+                    return False
+                self.retried += 1
+                print(f"Teams delivery for {label} failed (attempt {attempt}): {e}")
+                if self._pause(self._backoff(attempt)):
+                    return self._requeue(item)
+                continue
+
+            latency = time.time() - item.get("enqueued_at", time.time())
+            self.delivered += 1
+            self.latency_total += latency
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+            print(f"Posted approval request to Teams for {label}.")
+            return True
+
+    def _pause(self, delay):
+        """
+        Wait `delay` seconds, keeping this consumer's claim on its messages
+        alive. Returns True if the queue is stopping.
+        """
+        deadline = time.monotonic() + delay
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self._stop.wait(min(remaining, 5.0)):
+                return True
+            try:
+                self.backend.keepalive()
+            except Exception as e:
+                print(f"Delivery queue heartbeat failed: {e}")
+
+    def dead_letter(self, item, error, attempts=1):
+        """
+        Record an item that could not be delivered on the dead-letter list.
+        """
+        item["error"] = str(error)
+        item["attempts"] = attempts
+        self.failed += 1
+        try:
+            self.backend.dead_letter(item)
+        except Exception as e:
+            print(f"Failed to dead-letter {item.get('label') or 'message'}: {e}")
+
+    def _requeue(self, item):
+        # Shutting down; put the item back for another worker or replica
+        try:
+            self.backend.put(item)
+        except DeliveryQueueFull:
+            self.backend.dead_letter(item)
+        return False
+
+    def stats(self):
+        try:
+            depth = self.backend.depth()
+            dead_letter_depth = self.backend.dead_letter_depth()
+        except Exception as e:
+            print(f"Failed to read delivery queue depth: {e}")
+            depth = dead_letter_depth = None
+        return {
+            "queue_depth": depth,
+            "dead_letter_depth": dead_letter_depth,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_seconds": {
+                "last": self.latency_last,
+                "max": self.latency_max,
+                "avg": self.latency_total / self.delivered if self.delivered else 0.0,
+            },
+        }
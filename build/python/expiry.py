@@ -0,0 +1,114 @@
+import os
+import socket
+import threading
+import uuid
+
+
+class ExpiryScheduler:
+    """
+    Background sweep that hands each expired run to `on_expired` exactly once.
+
+    The token store does the bookkeeping: a heap (memory), an indexed column
+    (SQLite) or a sorted set (Redis) of deadlines, so a sweep only touches
+    runs that are actually due. With a shared store, `try_lead` elects one
+    sweeper at a time, and claims are atomic, so a handover between leaders
+    still can't fire a run twice.
+
+    A claim is removed from the store before the policy runs, so a policy
+    that fails (say, Terraform is down) hands the run back with
+    `requeue_expired`, to be claimed again after an exponential backoff from
+    `retry_seconds`. After `max_attempts` the run is given up on and left to
+    HCP's own run task timeout.
+
+    Like the delivery workers, the thread starts lazily so gunicorn can fork
+    first.
+    """
+
+    def __init__(
+        self,
+        get_store,
+        on_expired,
+        poll_seconds=1.0,
+        batch_size=100,
+        lease_seconds=10.0,
+        max_attempts=5,
+        retry_seconds=10.0,
+    ):
+        self.get_store = get_store
+        self.on_expired = on_expired
+        self.poll_seconds = poll_seconds
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.owner = None
+        self.fired = 0
+        self.abandoned = 0
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._pid = os.getpid()
+            self.owner = f"{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:8]}"
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="expiry-scheduler", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                swept = self.sweep()
+            except Exception as e:
+                print(f"Expiry sweep failed: {e}")
+                swept = 0
+            # A full batch means more are due; go again without waiting
+            if swept < self.batch_size:
+                self._stop.wait(self.poll_seconds)
+
+    def sweep(self):
+        """
+        Claim one batch of expired runs and fire the policy for each.
+        Returns the number of runs claimed.
+        """
+        store = self.get_store()
+        if not store.try_lead(self.owner or "local", self.lease_seconds):
+            return 0
+        expired = store.pop_expired(self.batch_size)
+        for run_id, data in expired:
+            try:
+                self.on_expired(run_id, data)
+                self.fired += 1
+            except Exception as e:
+                self._retry(store, run_id, data, e)
+        return len(expired)
+
+    def _retry(self, store, run_id, data, error):
+        attempts = data.get("expiry_attempts", 0) + 1
+        if attempts >= self.max_attempts:
+            self.abandoned += 1
+            print(
+                f"Expiry policy failed for run {run_id} {attempts} times, "
+                f"giving up: {error}"
+            )
+            return
+        delay = self.retry_seconds * 2 ** (attempts - 1)
+        print(f"Expiry policy failed for run {run_id}, retrying in {delay}s: {error}")
+        try:
+            store.requeue_expired(run_id, dict(data, expiry_attempts=attempts), delay)
+        except Exception as e:
+            self.abandoned += 1
+            print(f"Failed to requeue expired run {run_id}: {e}")
@@ -0,0 +1,28 @@
+"""
+gunicorn settings, picked up automatically from the working directory.
+
+With PROMETHEUS_MULTIPROC_DIR set, each worker writes its metrics to that
+directory and /metrics aggregates them. A worker's files must be marked dead
+when it exits, or its in-flight gauges would be counted forever.
+
+Each worker also flushes its open digest batch and stops its Teams delivery
+queue on the way out, so messages waiting on a retry are handed back to the
+queue instead of dying with it.
+"""
+
+import os
+import sys
+
+
+def worker_exit(server, worker):
+    # Only if the worker loaded the app; importing it here would start one
+    app = sys.modules.get("app")
+    if app is not None:
+        app.stop_delivery()
+
+
+def child_exit(server, worker):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
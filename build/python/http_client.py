@@ -0,0 +1,342 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+#
+# Optional async client (ASGI mode only)
+#
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Methods that are safe to repeat after the server may have acted on them.
+# PATCHing a task result only sets its status, so a repeat is harmless.
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE", "PATCH"])
+
+# Statuses that mean the request was turned away without being processed,
+# so even a POST (a Teams card) can be retried without posting twice
+UNPROCESSED_STATUSES = frozenset([429, 503])
+
+
+def connect_failed(error):
+    """
+    True if a requests exception means the request never reached the host.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class CircuitOpenError(requests.RequestException):
+    """
+    Raised instead of calling a host whose circuit breaker is open.
+    `retry_after` is the number of seconds until a trial call is let through.
+    """
+
+    def __init__(self, message, retry_after=0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for a single host.
+
+    After `failure_threshold` failures in a row the circuit opens and calls
+    fail fast for `reset_seconds`. The first call after that is let through as
+    a trial; success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                # Let one trial call through and hold the rest until it reports back
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def retry_after(self):
+        """
+        Seconds until the next trial call is let through.
+        """
+        opened_at = self.opened_at
+        if opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_seconds - (time.monotonic() - opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class BaseHttpClient:
+    """
+    Timeout, retry and circuit breaker policy shared by the sync and async
+    clients.
+    """
+
+    def __init__(
+        self,
+        connect_timeout=3.05,
+        read_timeout=10.0,
+        max_retries=2,
+        backoff_seconds=0.5,
+        max_backoff_seconds=8.0,
+        pool_maxsize=20,
+        breaker_threshold=5,
+        breaker_reset_seconds=30.0,
+        metrics=None,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.pool_maxsize = pool_maxsize
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_seconds = breaker_reset_seconds
+        # A metrics.Metrics, recording latency and errors per host
+        self.metrics = metrics
+
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def _host(self, url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def breaker(self, url):
+        host = self._host(url)
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_reset_seconds
+                )
+                self._breakers[host] = breaker
+            return breaker
+
+    def _retry_delay(self, attempt, resp=None):
+        if resp is not None and resp.headers.get("Retry-After", "").isdigit():
+            return min(self.max_backoff_seconds, float(resp.headers["Retry-After"]))
+        delay = min(self.max_backoff_seconds, self.backoff_seconds * 2**attempt)
+        return random.uniform(0, delay)
+
+    def _should_retry(self, method, attempt, max_retries, status=None, unsent=False):
+        """
+        Whether to retry after a response with `status`, or after an exception
+        (no status) where `unsent` says the request never reached the host.
+        Non-idempotent methods are only retried when the host can't have
+        acted on the request: a read timeout or a 502 may follow a Teams post
+        that went through, and retrying it would post the card twice.
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        if attempt >= max_retries:
+            return False
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        if status is None:
+            return idempotent or unsent
+        if idempotent:
+            return status in RETRY_STATUSES
+        return status in UNPROCESSED_STATUSES
+
+    def _check_breaker(self, url):
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError(
+                f"Circuit open for {self._host(url)}; not sending request",
+                retry_after=breaker.retry_after(),
+            )
+        return breaker
+
+    def _record(self, breaker, resp):
+        if resp.status_code in RETRY_STATUSES:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+
+class HttpClient(BaseHttpClient):
+    """
+    Shared outbound HTTP client.
+
+    Keeps one keep-alive connection pool per host, applies connect/read
+    timeouts to every call, retries 429/5xx responses and connection errors
+    with jittered exponential backoff, and trips a per-host circuit breaker
+    when a host keeps failing. POSTs are only retried when the host can't
+    have processed them: connect failures, 429 and 503.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sessions = {}
+        self._pid = os.getpid()
+
+    def _session(self, host):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Pools inherited across a fork share sockets with the parent
+                self._sessions = {}
+                self._pid = os.getpid()
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0
+                )
+                session.mount(host, adapter)
+                self._sessions[host] = session
+            return session
+
+    def request(self, method, url, max_retries=None, **kwargs):
+        """
+        Send a request and return the final response. Callers still decide
+        what to do with a non-2xx status (usually `raise_for_status()`).
+        `max_retries` overrides the client's own, e.g. 0 for a caller that
+        retries on its own schedule.
+        """
+        if self.metrics is None:
+            return self._send(method, url, max_retries, **kwargs)
+        host = self._host(url)
+        handle = self.metrics.outbound_started(host, method)
+        try:
+            resp = self._send(method, url, max_retries, **kwargs)
+        except Exception as e:
+            self.metrics.outbound_finished(host, method, handle, error=e)
+            raise
+        self.metrics.outbound_finished(host, method, handle, status=resp.status_code)
+        return resp
+
+    def _send(self, method, url, max_retries, **kwargs):
+        breaker = self._check_breaker(url)
+        kwargs.setdefault("timeout", self.timeout)
+        session = self._session(self._host(url))
+        attempt = 0
+        while True:
+            try:
+                resp = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                unsent = connect_failed(e)
+                if not self._should_retry(method, attempt, max_retries, unsent=unsent):
+                    breaker.record_failure()
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if self._should_retry(method, attempt, max_retries, resp.status_code):
+                time.sleep(self._retry_delay(attempt, resp))
+                attempt += 1
+                continue
+
+            self._record(breaker, resp)
+            return resp
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+
+class AsyncHttpClient(BaseHttpClient):
+    """
+    Non-blocking counterpart of HttpClient for ASGI mode, built on httpx.
+
+    One AsyncClient holds the per-host keep-alive pools; `max_connections`
+    bounds the total number of concurrent outbound connections.
+    """
+
+    def __init__(self, *args, max_connections=1000, **kwargs):
+        if httpx is None:
+            raise RuntimeError("ASGI mode requires the 'httpx' package")
+        super().__init__(*args, **kwargs)
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=self.pool_maxsize,
+            ),
+        )
+
+    async def request(self, method, url, max_retries=None, **kwargs):
+        if self.metrics is None:
+            return await self._send(method, url, max_retries, **kwargs)
+        host = self._host(url)
+        handle = self.metrics.outbound_started(host, method)
+        try:
+            resp = await self._send(method, url, max_retries, **kwargs)
+        except Exception as e:
+            self.metrics.outbound_finished(host, method, handle, error=e)
+            raise
+        self.metrics.outbound_finished(host, method, handle, status=resp.status_code)
+        return resp
+
+    async def _send(self, method, url, max_retries, **kwargs):
+        breaker = self._check_breaker(url)
+        attempt = 0
+        while True:
+            try:
+                resp = await self._client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                unsent = isinstance(
+                    e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+                )
+                if not self._should_retry(method, attempt, max_retries, unsent=unsent):
+                    breaker.record_failure()
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+
+            if self._should_retry(method, attempt, max_retries, resp.status_code):
+                await asyncio.sleep(self._retry_delay(attempt, resp))
+                attempt += 1
+                continue
+
+            self._record(breaker, resp)
+            return resp
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request("PATCH", url, **kwargs)
+
+    async def aclose(self):
+        await self._client.aclose()
@@ -0,0 +1,298 @@
+"""
+Idempotent handling of duplicate run task deliveries.
+
+HCP Terraform retries run task POSTs, and proxies sometimes replay them.
+Each delivery is keyed on run_id, stage and a digest of the verified body.
+The first delivery of a key claims it and does the work. Its result is
+recorded, so a duplicate gets the original response back without posting
+to Teams or PATCHing Terraform again. A duplicate that arrives while the
+original is still running waits for its result instead of racing it.
+"""
+
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+REDIS_IDEMPOTENCY_PREFIX = "teams-approval:idempotency"
+
+# claim() outcomes
+DONE = "done"
+CLAIMED = "claimed"
+BUSY = "busy"
+
+
+def idempotency_key(run_id, stage, raw_body):
+    digest = hashlib.sha256(raw_body or b"").hexdigest()
+    return f"{run_id}:{stage}:{digest}"
+
+
+def is_replayable(result):
+    """
+    Only successful responses are recorded. Errors are left unrecorded so
+    HCP's retry gets a fresh attempt.
+    """
+    return result is not None and 200 <= result[1] < 300
+
+
+#
+# Backends
+#
+class MemoryIdempotencyBackend:
+    """
+    Per-process record of handled deliveries, bounded with LRU eviction.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._results = OrderedDict()  # key -> (expires_at, result)
+        self._claims = {}  # key -> (owner, lease expires_at)
+
+    def claim(self, key, owner, lock_seconds):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._results.move_to_end(key)
+                    return DONE, entry[1]
+                del self._results[key]
+            current = self._claims.get(key)
+            if current is not None and current[1] > now:
+                return BUSY, None
+            self._claims[key] = (owner, now + lock_seconds)
+            return CLAIMED, None
+
+    def complete(self, key, owner, result, ttl_seconds):
+        with self._lock:
+            self._results[key] = (time.monotonic() + ttl_seconds, tuple(result))
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+            self._release(key, owner)
+
+    def release(self, key, owner):
+        with self._lock:
+            self._release(key, owner)
+
+    def _release(self, key, owner):
+        current = self._claims.get(key)
+        if current is not None and current[0] == owner:
+            del self._claims[key]
+
+
+def redis_result_key(key):
+    return f"{REDIS_IDEMPOTENCY_PREFIX}:{key}"
+
+
+def redis_lock_key(key):
+    return f"{REDIS_IDEMPOTENCY_PREFIX}:{key}:lock"
+
+
+def decode_result(raw):
+    if raw is None:
+        return None
+    body, status = json.loads(raw)
+    return body, status
+
+
+def decode_owner(raw):
+    if isinstance(raw, bytes):
+        return raw.decode("utf-8")
+    return raw
+
+
+class RedisIdempotencyBackend:
+    """
+    Shared by every replica. The claim is a lease (SET NX PX), so a replica
+    that dies mid-request holds up duplicates for at most `lock_seconds`.
+
+    A claim checks for a recorded result and takes the lease in one round
+    trip. The result is written before the lease is dropped, so once the
+    lease is gone every later claim sees the result.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def claim(self, key, owner, lock_seconds):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(redis_result_key(key))
+        pipe.set(redis_lock_key(key), owner, nx=True, px=int(lock_seconds * 1000))
+        raw, locked = pipe.execute()
+        if raw is not None:
+            if locked:
+                self.client.delete(redis_lock_key(key))
+            return DONE, decode_result(raw)
+        return (CLAIMED if locked else BUSY), None
+
+    def complete(self, key, owner, result, ttl_seconds):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.setex(redis_result_key(key), int(ttl_seconds), json.dumps(list(result)))
+        pipe.delete(redis_lock_key(key))
+        pipe.execute()
+
+    def release(self, key, owner):
+        # Not atomic, but the window only matters if our lease has already
+        # run out and another replica has claimed the key in between
+        if decode_owner(self.client.get(redis_lock_key(key))) == owner:
+            self.client.delete(redis_lock_key(key))
+
+
+class AsyncRedisIdempotencyBackend:
+    """
+    RedisIdempotencyBackend for a `redis.asyncio` client. Same keys, so sync
+    and async deployments can share one Redis.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def claim(self, key, owner, lock_seconds):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(redis_result_key(key))
+        pipe.set(redis_lock_key(key), owner, nx=True, px=int(lock_seconds * 1000))
+        raw, locked = await pipe.execute()
+        if raw is not None:
+            if locked:
+                await self.client.delete(redis_lock_key(key))
+            return DONE, decode_result(raw)
+        return (CLAIMED if locked else BUSY), None
+
+    async def complete(self, key, owner, result, ttl_seconds):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.setex(redis_result_key(key), int(ttl_seconds), json.dumps(list(result)))
+        pipe.delete(redis_lock_key(key))
+        await pipe.execute()
+
+    async def release(self, key, owner):
+        if decode_owner(await self.client.get(redis_lock_key(key))) == owner:
+            await self.client.delete(redis_lock_key(key))
+
+
+class AsyncMemoryIdempotencyBackend:
+    """
+    Wraps a MemoryIdempotencyBackend for use from the event loop. Its calls
+    never block, so they are made directly.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def claim(self, key, owner, lock_seconds):
+        return self.backend.claim(key, owner, lock_seconds)
+
+    async def complete(self, key, owner, result, ttl_seconds):
+        self.backend.complete(key, owner, result, ttl_seconds)
+
+    async def release(self, key, owner):
+        self.backend.release(key, owner)
+
+
+#
+# Coordinators
+#
+class Idempotency:
+    """
+    Runs `handler()` at most once per key while its result is recorded.
+
+    `run` returns the handler's `(body, status)`, or the recorded one for a
+    duplicate. It returns None if the original is still being handled after
+    `wait_seconds`. If the backend itself fails, the delivery is handled
+    anyway: a possible duplicate post is better than a dropped run task.
+    """
+
+    def __init__(
+        self,
+        backend,
+        ttl_seconds=3600,
+        lock_seconds=30.0,
+        wait_seconds=10.0,
+        poll_seconds=0.05,
+    ):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.lock_seconds = lock_seconds
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self.replayed = 0
+
+    def run(self, key, handler):
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            try:
+                state, result = self.backend.claim(key, owner, self.lock_seconds)
+            except Exception as e:
+                print(f"Idempotency check failed for {key}: {e}")
+                return handler()
+            if state == DONE:
+                self.replayed += 1
+                return result
+            if state == CLAIMED:
+                break
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_seconds)
+
+        try:
+            result = handler()
+        except BaseException:
+            self._finish(key, owner, None)
+            raise
+        self._finish(key, owner, result)
+        return result
+
+    def _finish(self, key, owner, result):
+        try:
+            if is_replayable(result):
+                self.backend.complete(key, owner, result, self.ttl_seconds)
+            else:
+                self.backend.release(key, owner)
+        except Exception as e:
+            print(f"Failed to record idempotency result for {key}: {e}")
+
+
+class AsyncIdempotency(Idempotency):
+    """
+    Idempotency for the event loop, with an async backend and handler.
+    """
+
+    async def run(self, key, handler):
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            try:
+                state, result = await self.backend.claim(key, owner, self.lock_seconds)
+            except Exception as e:
+                print(f"Idempotency check failed for {key}: {e}")
+                return await handler()
+            if state == DONE:
+                self.replayed += 1
+                return result
+            if state == CLAIMED:
+                break
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(self.poll_seconds)
+
+        try:
+            result = await handler()
+        except BaseException:
+            await self._finish(key, owner, None)
+            raise
+        await self._finish(key, owner, result)
+        return result
+
+    async def _finish(self, key, owner, result):
+        try:
+            if is_replayable(result):
+                await self.backend.complete(key, owner, result, self.ttl_seconds)
+            else:
+                await self.backend.release(key, owner)
+        except Exception as e:
+            print(f"Failed to record idempotency result for {key}: {e}")
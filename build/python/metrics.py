@@ -0,0 +1,270 @@
+"""
+Prometheus metrics and optional OpenTelemetry spans.
+
+Covers inbound routes, outbound calls per host (Teams, Terraform callback),
+token store operations per backend, and the HMAC check. Each observation is
+a few label lookups and a bucket increment, cheap enough to leave on in
+production. Without prometheus_client (or opentelemetry-api, for spans)
+everything here is a no-op, so callers never need to check.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates every
+worker rather than whichever one served the scrape.
+"""
+
+import contextlib
+import os
+import time
+
+#
+# Optional dependencies
+#
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# Inbound and outbound calls range from well under a millisecond (a replayed
+# delivery) to a Teams post that was retried; store operations and the HMAC
+# check are usually far below a millisecond.
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STORE_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.5,
+)
+HMAC_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+
+
+class Metrics:
+    """
+    Holds every metric the app records. Pass a fresh `registry` to keep
+    instances apart (e.g. in tests); by default metrics go to the global
+    prometheus_client registry alongside its process metrics.
+    """
+
+    def __init__(self, enabled=True, tracing=False, registry=None):
+        self.enabled = enabled and prometheus_client is not None
+        self.tracer = None
+        if tracing and trace is not None:
+            self.tracer = trace.get_tracer("teams-approval")
+        if not self.enabled:
+            return
+
+        self.registry = registry if registry is not None else prometheus_client.REGISTRY
+        # labels() validates and locks on every call; children never change,
+        # so look them up once
+        self._children = {}
+        common = {"namespace": "teams_approval", "registry": self.registry}
+        Counter = prometheus_client.Counter
+        Gauge = prometheus_client.Gauge
+        Histogram = prometheus_client.Histogram
+
+        self.request_seconds = Histogram(
+            "request_duration_seconds",
+            "Time spent handling inbound requests",
+            ["route", "method"],
+            buckets=REQUEST_BUCKETS,
+            **common,
+        )
+        self.requests_in_flight = Gauge(
+            "requests_in_flight",
+            "Inbound requests currently being handled",
+            ["route"],
+            multiprocess_mode="livesum",
+            **common,
+        )
+        self.request_errors = Counter(
+            "request_errors",
+            "Inbound requests answered with a 4xx or 5xx status",
+            ["route", "status"],
+            **common,
+        )
+        self.outbound_seconds = Histogram(
+            "outbound_request_duration_seconds",
+            "Time spent on outbound calls, including retries",
+            ["host", "method"],
+            buckets=REQUEST_BUCKETS,
+            **common,
+        )
+        self.outbound_in_flight = Gauge(
+            "outbound_requests_in_flight",
+            "Outbound calls currently waiting on a host",
+            ["host"],
+            multiprocess_mode="livesum",
+            **common,
+        )
+        self.outbound_errors = Counter(
+            "outbound_request_errors",
+            "Outbound calls that ended in a 4xx/5xx status or an exception",
+            ["host", "status"],
+            **common,
+        )
+        self.store_seconds = Histogram(
+            "token_store_duration_seconds",
+            "Time spent on token store operations",
+            ["operation", "backend"],
+            buckets=STORE_BUCKETS,
+            **common,
+        )
+        self.store_errors = Counter(
+            "token_store_errors",
+            "Token store operations that raised",
+            ["operation", "backend"],
+            **common,
+        )
+        self.hmac_seconds = Histogram(
+            "hmac_check_duration_seconds",
+            "Time spent checking run task HMAC signatures",
+            buckets=HMAC_BUCKETS,
+            **common,
+        )
+
+    def _child(self, metric, *values):
+        key = (id(metric), values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = metric.labels(*values)
+        return child
+
+    #
+    # Spans
+    #
+    def start_span(self, name, attributes):
+        """
+        Start a span and make it current. Returns a handle for end_span().
+        """
+        if self.tracer is None:
+            return None
+        span = self.tracer.start_span(name, attributes=attributes)
+        token = otel_context.attach(trace.set_span_in_context(span))
+        return span, token
+
+    def end_span(self, handle, status=None, error=None):
+        if handle is None:
+            return
+        span, token = handle
+        if status is not None:
+            span.set_attribute("http.status_code", status)
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+        span.end()
+        otel_context.detach(token)
+
+    #
+    # Inbound requests
+    #
+    def request_started(self, route, method):
+        """
+        Returns a handle to pass to request_finished().
+        """
+        if self.enabled:
+            self._child(self.requests_in_flight, route).inc()
+        span = self.start_span(f"{method} {route}", {"http.route": route})
+        return time.perf_counter(), span
+
+    def request_finished(self, route, method, status, handle):
+        started, span = handle
+        if self.enabled:
+            self._child(self.requests_in_flight, route).dec()
+            self._child(self.request_seconds, route, method).observe(
+                time.perf_counter() - started
+            )
+            if status >= 400:
+                self._child(self.request_errors, route, str(status)).inc()
+        self.end_span(span, status=status)
+
+    #
+    # Outbound calls
+    #
+    def outbound_started(self, host, method):
+        """
+        Returns a handle to pass to outbound_finished().
+        """
+        if self.enabled:
+            self._child(self.outbound_in_flight, host).inc()
+        span = self.start_span(
+            f"{method} {host}", {"http.method": method, "server.address": host}
+        )
+        return time.perf_counter(), span
+
+    def outbound_finished(self, host, method, handle, status=None, error=None):
+        """
+        Record an outbound call that ended with a response `status` or
+        raised `error`.
+        """
+        started, span = handle
+        if self.enabled:
+            self._child(self.outbound_in_flight, host).dec()
+            self._child(self.outbound_seconds, host, method).observe(
+                time.perf_counter() - started
+            )
+            if error is not None:
+                self._child(self.outbound_errors, host, type(error).__name__).inc()
+            elif status >= 400:
+                self._child(self.outbound_errors, host, str(status)).inc()
+        self.end_span(span, status=status, error=error)
+
+    #
+    # Token store and HMAC
+    #
+    @contextlib.contextmanager
+    def store_operation(self, operation, backend):
+        span = self.start_span(
+            f"token_store.{operation}", {"token_store.backend": backend}
+        )
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            if self.enabled:
+                self._child(self.store_errors, operation, backend).inc()
+            self.end_span(span, error=e)
+            raise
+        finally:
+            if self.enabled:
+                self._child(self.store_seconds, operation, backend).observe(
+                    time.perf_counter() - started
+                )
+        self.end_span(span)
+
+    @contextlib.contextmanager
+    def hmac_check(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.hmac_seconds.observe(time.perf_counter() - started)
+
+    #
+    # Exposition
+    #
+    def render(self):
+        """
+        Returns the /metrics body and its content type.
+        """
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = self.registry
+        return (
+            prometheus_client.generate_latest(registry),
+            prometheus_client.CONTENT_TYPE_LATEST,
+        )
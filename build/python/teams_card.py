@@ -0,0 +1,116 @@
+"""
+Adaptive Card rendering for Teams approval messages.
+
+A card lists one or more runs. Each run gets its own facts and its own
+Approve/Reject actions, so a digest of many runs is still a single webhook
+post.
+"""
+
+import json
+
+ADAPTIVE_CARD_CONTENT_TYPE = "application/vnd.microsoft.card.adaptive"
+
+# Teams rejects webhook payloads over about 28 KB
+MAX_PAYLOAD_BYTES = 28 * 1024
+
+# Run messages are free-form commit messages; cap them so a single run
+# can't crowd a digest out of its payload budget
+MAX_RUN_MESSAGE_CHARS = 500
+
+
+def truncate(text, limit):
+    if len(text) <= limit:
+        return text
+    return text[: limit - 1] + "\u2026"
+
+
+def open_url(title, url, style=None):
+    action = {"type": "Action.OpenUrl", "title": title, "url": url}
+    if style:
+        action["style"] = style
+    return action
+
+
+def run_section(entry, separator=False):
+    """
+    Card elements for a single run. `entry` is the dict built by
+    app.build_run_entry().
+    """
+    facts = [
+        {"title": "Run ID", "value": entry["run_id"]},
+        {"title": "Stage", "value": entry["stage"]},
+        {"title": "Speculative", "value": "Yes" if entry["is_speculative"] else "No"},
+    ]
+    if entry.get("run_created_by"):
+        facts.append({"title": "Triggered by", "value": entry["run_created_by"]})
+    if entry.get("run_message"):
+        facts.append({"title": "Run Message", "value": entry["run_message"]})
+
+    actions = []
+    if entry.get("workspace_app_url"):
+        actions.append(open_url("Open Workspace", entry["workspace_app_url"]))
+    if entry.get("vcs_pull_request_url"):
+        actions.append(open_url("View Pull Request", entry["vcs_pull_request_url"]))
+    elif entry.get("vcs_commit_url"):
+        actions.append(open_url("View Commit", entry["vcs_commit_url"]))
+    actions.append(open_url("Approve", entry["approve_link"], "positive"))
+    actions.append(open_url("Reject", entry["reject_link"], "destructive"))
+
+    return {
+        "type": "Container",
+        "separator": separator,
+        "spacing": "Medium" if separator else "Default",
+        "items": [
+            {
+                "type": "TextBlock",
+                "text": f"Workspace **{entry['workspace']}** has requested approval.",
+                "wrap": True,
+                "weight": "Bolder",
+            },
+            {"type": "FactSet", "facts": facts},
+            {"type": "ActionSet", "actions": actions},
+        ],
+    }
+
+
+def run_section_bytes(entry):
+    """
+    Size of a run's section in a posted digest. The client serializes with
+    ASCII escapes, so characters and bytes are the same count.
+    """
+    return len(json.dumps(run_section(entry, separator=True)))
+
+
+def build_card_message(entries, title=None, actions=None):
+    """
+    Wrap one or more run sections in the message envelope the Teams webhook
+    expects. `actions` are card-level actions shown after every run.
+    """
+    body = []
+    if title:
+        body.append(
+            {"type": "TextBlock", "text": title, "wrap": True, "size": "Medium"}
+        )
+    for i, entry in enumerate(entries):
+        body.append(run_section(entry, separator=i > 0))
+
+    card = {
+        "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+        "type": "AdaptiveCard",
+        "version": "1.4",
+        "msteams": {"width": "Full"},
+        "body": body,
+    }
+    if actions:
+        card["actions"] = actions
+
+    return {
+        "type": "message",
+        "attachments": [
+            {
+                "contentType": ADAPTIVE_CARD_CONTENT_TYPE,
+                "contentUrl": None,
+                "content": card,
+            }
+        ],
+    }
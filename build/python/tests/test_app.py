@@ -7,6 +7,7 @@ from unittest.mock import patch, MagicMock
 import requests
 import redis
 from app import app, store_token, get_token, remove_token
+from idempotency import MemoryIdempotencyBackend
 
 # Existing fixtures and imports remain the same...
 
@@ -50,9 +51,10 @@ def test_missing_base_public_url(client, mock_requests):
         call_args = mock_requests.post.call_args[1]
         assert 'json' in call_args
         teams_message = call_args['json']
+        card = json.dumps(teams_message)
         # Message should contain absolute paths without base URL
-        assert '[Approve](/approve?run_id=' in teams_message['text']
-        assert '[Reject](/reject?run_id=' in teams_message['text']
+        assert '/approve?run_id=' in card
+        assert '/reject?run_id=' in card
 
 # Security Tests
 def test_hmac_invalid_content_type(client):
@@ -153,8 +155,9 @@ def test_unicode_workspace_name(client, mock_requests):
         assert 'json' in call_args
         teams_message = call_args['json']
         # Verify Unicode characters are preserved
-        assert '🚀' in teams_message['text']
-        assert '测试' in teams_message['text']
+        card = json.dumps(teams_message, ensure_ascii=False)
+        assert '🚀' in card
+        assert '测试' in card
 
 def test_very_long_run_id(client):
     """Test handling of very long run ID"""
@@ -238,13 +241,16 @@ def test_empty_workspace_name(client, mock_requests):
         assert 'json' in call_args
         teams_message = call_args['json']
         # Empty workspace name should appear in message
-        assert 'Workspace ****' in teams_message['text']
+        assert 'Workspace ****' in json.dumps(teams_message)
 
 @pytest.fixture
 def client():
     app.config['TESTING'] = True
-    with app.test_client() as client:
-        yield client
+    # Each test starts with no deliveries recorded by duplicate detection
+    with patch('app.local_idempotency_backend', MemoryIdempotencyBackend()), \
+         patch('app.idempotency', None):
+        with app.test_client() as client:
+            yield client
 
 @pytest.fixture
 def mock_redis():
@@ -253,7 +259,7 @@ def mock_redis():
 
 @pytest.fixture
 def mock_requests():
-    with patch('app.requests') as mock:
+    with patch('app.http_client') as mock:
         yield mock
 
 def test_verify_hmac_success(client):
@@ -500,12 +506,12 @@ def test_teams_message_formatting(client, mock_requests):
         assert response.status_code == 200
         
         # Verify Teams message format
-        teams_message = mock_requests.post.call_args[1]['json']
-        assert 'test-user' in teams_message['text']
-        assert 'test message' in teams_message['text']
-        assert 'http://github.com/pr/123' in teams_message['text']
-        assert 'http://app.terraform.io/workspace' in teams_message['text']
-        assert 'http://example.com/approve?run_id=test-run' in teams_message['text']
+        card = json.dumps(mock_requests.post.call_args[1]['json'])
+        assert 'test-user' in card
+        assert 'test message' in card
+        assert 'http://github.com/pr/123' in card
+        assert 'http://app.terraform.io/workspace' in card
+        assert 'http://example.com/approve?run_id=test-run' in card
 
 def test_redis_connection_failure(mock_redis):
     """Test Redis connection failure fallback"""
@@ -550,4 +556,430 @@ def test_auto_approve_non_speculative(client, mock_requests):
         # Verify Terraform callback was called with "passed" status
         mock_requests.patch.assert_called_once()
         call_kwargs = mock_requests.patch.call_args[1]
-        assert '"status": "passed"' in json.dumps(call_kwargs['json'])
\ No newline at end of file
+        assert '"status": "passed"' in json.dumps(call_kwargs['json'])
+def test_queue_mode_acknowledges_before_delivery(client, mock_requests):
+    """Test that queue mode returns 200 without posting to Teams inline"""
+    queue = MagicMock()
+
+    with patch('app.HMAC_KEY', ''), \
+         patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False), \
+         patch('app.TEAMS_DELIVERY_MODE', 'queue'), \
+         patch('app.delivery_queue', queue):
+        payload = {
+            'access_token': 'real-token',
+            'task_result_callback_url': 'http://callback.example.com',
+            'run_id': 'test-run',
+            'is_speculative': True
+        }
+        response = client.post('/teams-approval', json=payload)
+
+        assert response.status_code == 200
+        assert b"queued" in response.data
+        queue.enqueue.assert_called_once()
+        mock_requests.post.assert_not_called()
+        assert get_token('test-run')['access_token'] == 'real-token'
+
+def test_queue_full_falls_back_to_direct_post(client, mock_requests):
+    """Test that a full delivery queue posts to Teams inline instead of dropping"""
+    from delivery import DeliveryQueueFull
+    queue = MagicMock()
+    queue.enqueue.side_effect = DeliveryQueueFull("full")
+    mock_requests.post.return_value.raise_for_status.return_value = None
+
+    with patch('app.HMAC_KEY', ''), \
+         patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False), \
+         patch('app.TEAMS_DELIVERY_MODE', 'queue'), \
+         patch('app.delivery_queue', queue):
+        payload = {
+            'access_token': 'real-token',
+            'task_result_callback_url': 'http://callback.example.com',
+            'run_id': 'test-run',
+            'is_speculative': True
+        }
+        response = client.post('/teams-approval', json=payload)
+
+        assert response.status_code == 200
+        mock_requests.post.assert_called_once()
+
+def test_queued_delivery_not_retried_by_client(mock_requests):
+    """Test that queue workers post without the client's own retries"""
+    import app
+    mock_requests.post.return_value.raise_for_status.return_value = None
+
+    with patch('app.delivery_queue', None), patch('app.REDIS_ENABLED', False):
+        queue = app.get_delivery_queue()
+        assert queue.deliver({'message': {'text': 'hi'}, 'label': 'run test-run'})
+
+    assert mock_requests.post.call_args[1]['max_retries'] == 0
+
+def test_delivery_stats(client):
+    """Test the delivery stats endpoint reports queue depth"""
+    queue = MagicMock()
+    queue.stats.return_value = {'queue_depth': 3}
+
+    with patch('app.TEAMS_DELIVERY_MODE', 'queue'), patch('app.delivery_queue', queue):
+        response = client.get('/delivery-stats')
+
+    assert response.status_code == 200
+    assert response.get_json() == {'queue_depth': 3, 'mode': 'queue'}
+
+def test_teams_message_is_adaptive_card(client, mock_requests):
+    """Test that Teams receives an Adaptive Card with per-run actions"""
+    mock_requests.post.return_value.raise_for_status.return_value = None
+
+    with patch('app.HMAC_KEY', ''), \
+         patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False):
+        payload = {
+            'access_token': 'real-token',
+            'task_result_callback_url': 'http://callback.example.com',
+            'run_id': 'test-run',
+            'workspace_name': 'test-workspace',
+            'is_speculative': True
+        }
+        response = client.post('/teams-approval', json=payload)
+        assert response.status_code == 200
+
+    teams_message = mock_requests.post.call_args[1]['json']
+    attachment = teams_message['attachments'][0]
+    assert attachment['contentType'] == 'application/vnd.microsoft.card.adaptive'
+    card = attachment['content']
+    assert card['type'] == 'AdaptiveCard'
+    actions = card['body'][0]['items'][-1]['actions']
+    titles = [action['title'] for action in actions]
+    assert titles == ['Approve', 'Reject']
+    assert 'run_id=test-run' in actions[0]['url']
+
+def test_batching_coalesces_runs_into_one_card(client, mock_requests):
+    """Test that runs arriving within the window produce a single Teams post"""
+    queue = MagicMock()
+
+    with patch('app.HMAC_KEY', ''), \
+         patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False), \
+         patch('app.TEAMS_BATCH_WINDOW_MS', 60000), \
+         patch('app.TEAMS_BATCH_MAX_SIZE', 3), \
+         patch('app.coalescer', None), \
+         patch('app.delivery_queue', queue):
+        for i in range(3):
+            payload = {
+                'access_token': f'token-{i}',
+                'task_result_callback_url': 'http://callback.example.com',
+                'run_id': f'batch-run-{i}',
+                'workspace_name': f'workspace-{i}',
+                'is_speculative': True
+            }
+            response = client.post('/teams-approval', json=payload)
+            assert response.status_code == 200
+            assert b"digest" in response.data
+
+    # The third run filled the batch, so it was flushed once, through the
+    # delivery queue even in sync mode
+    queue.enqueue.assert_called_once()
+    mock_requests.post.assert_not_called()
+    card = queue.enqueue.call_args[0][0]['attachments'][0]['content']
+    assert '3 runs' in card['body'][0]['text']
+    assert len(card['body']) == 4
+
+    batch_ids = {get_token(f'batch-run-{i}')['batch_id'] for i in range(3)}
+    assert len(batch_ids) == 1
+
+def test_digest_batches_stay_under_payload_limit():
+    """Test that large runs split a batch before its card outgrows Teams' limit"""
+    from app import build_run_entry, build_digest_message
+    from teams_card import MAX_PAYLOAD_BYTES
+    cards = []
+    entries = [
+        build_run_entry({'run_id': f'run-{i}', 'run_message': 'x' * 5000}, f'uuid{i}')
+        for i in range(20)
+    ]
+    assert len(entries[0]['run_message']) == 500
+
+    with patch('app.TEAMS_BATCH_WINDOW_MS', 60000), \
+         patch('app.TEAMS_BATCH_MAX_SIZE', 20), \
+         patch('app.TEAMS_BATCH_MAX_BYTES', 4000), \
+         patch('app.coalescer', None), \
+         patch('app.flush_batch', lambda batch_id, batch: cards.append(
+             build_digest_message(batch_id, batch))):
+        import app
+        for entry in entries:
+            app.get_coalescer().add(entry)
+        app.get_coalescer().flush_now()
+
+    assert len(cards) > 1
+    assert sum(len(c['attachments'][0]['content']['body']) - 1 for c in cards) == 20
+    for card in cards:
+        assert len(json.dumps(card)) < MAX_PAYLOAD_BYTES
+
+def test_empty_batch_not_posted(mock_requests):
+    """Test that a batch with no runs never reaches Teams"""
+    from app import flush_batch
+    queue = MagicMock()
+
+    with patch('app.delivery_queue', queue):
+        flush_batch('batch-1', [])
+
+    queue.enqueue.assert_not_called()
+    mock_requests.post.assert_not_called()
+
+def test_digest_dead_lettered_when_queue_full_and_post_fails(mock_requests):
+    """Test that a digest that can't be queued or posted isn't just logged"""
+    from app import flush_batch, build_run_entry
+    from delivery import DeliveryQueueFull
+    queue = MagicMock()
+    queue.enqueue.side_effect = DeliveryQueueFull('full')
+    mock_requests.post.side_effect = Exception('Teams is down')
+
+    with patch('app.delivery_queue', queue):
+        flush_batch('batch-1', [build_run_entry({'run_id': 'run-1'}, 'uuid1')])
+
+    item, error = queue.dead_letter.call_args[0]
+    assert item['label'] == 'batch batch-1 (1 runs)'
+    assert str(error) == 'Teams is down'
+
+@pytest.fixture
+def pending_runs():
+    """Store three pending runs across two workspaces and one batch"""
+    runs = {
+        'bulk-run-1': {'workspace': 'ws-a', 'batch_id': 'batch-1'},
+        'bulk-run-2': {'workspace': 'ws-a', 'batch_id': 'batch-1'},
+        'bulk-run-3': {'workspace': 'ws-b', 'batch_id': 'batch-1'},
+    }
+    for run_id, fields in runs.items():
+        store_token(run_id, dict(
+            fields,
+            access_token=f'token-{run_id}',
+            callback_url=f'http://callback.example.com/{run_id}',
+            uuid='abc',
+        ))
+    yield runs
+    for run_id in runs:
+        remove_token(run_id)
+
+def test_bulk_approve_by_batch(client, mock_requests, pending_runs):
+    """Test that a batch link approves every run in the batch"""
+    mock_requests.patch.return_value.raise_for_status.return_value = None
+
+    response = client.get('/bulk-approve?batch_id=batch-1')
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['matched'] == 3
+    assert body['succeeded'] == 3
+    assert mock_requests.patch.call_count == 3
+    for run_id in pending_runs:
+        assert get_token(run_id) is None
+
+def test_bulk_by_workspace_requires_token(client, mock_requests, pending_runs):
+    """Test that workspace selection needs BULK_API_TOKEN"""
+    with patch('app.BULK_API_TOKEN', ''):
+        response = client.post('/bulk-reject', json={'workspace': 'ws-a'})
+        assert response.status_code == 403
+
+    with patch('app.BULK_API_TOKEN', 'secret'):
+        response = client.post(
+            '/bulk-reject',
+            json={'workspace': 'ws-a'},
+            headers={'Authorization': 'Bearer wrong'}
+        )
+        assert response.status_code == 403
+    mock_requests.patch.assert_not_called()
+
+def test_bulk_reject_by_workspace(client, mock_requests, pending_runs):
+    """Test rejecting every pending run in one workspace"""
+    mock_requests.patch.return_value.raise_for_status.return_value = None
+
+    with patch('app.BULK_API_TOKEN', 'secret'):
+        response = client.post(
+            '/bulk-reject',
+            json={'workspace': 'ws-a'},
+            headers={'Authorization': 'Bearer secret'}
+        )
+
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert sorted(r['run_id'] for r in results) == ['bulk-run-1', 'bulk-run-2']
+    assert all(r['status'] == 'failed' for r in results)
+    assert get_token('bulk-run-3') is not None
+
+def test_bulk_approve_by_run_ids_partial_failure(client, mock_requests, pending_runs):
+    """Test per-run results when one callback fails"""
+    def patch_side_effect(url, **kwargs):
+        if url.endswith('bulk-run-2'):
+            raise requests.RequestException("Failed to send callback")
+        return MagicMock()
+    mock_requests.patch.side_effect = patch_side_effect
+
+    with patch('app.BULK_API_TOKEN', 'secret'):
+        response = client.get(
+            '/bulk-approve?run_ids=bulk-run-1,bulk-run-2,unknown-run',
+            headers={'Authorization': 'Bearer secret'}
+        )
+
+    assert response.status_code == 502
+    body = response.get_json()
+    assert body['matched'] == 2
+    assert body['failed'] == 1
+    # The failed run stays pending so it can be retried
+    assert get_token('bulk-run-1') is None
+    assert get_token('bulk-run-2') is not None
+
+def test_bulk_no_selection_or_match(client):
+    """Test bulk endpoint validation"""
+    assert client.get('/bulk-approve').status_code == 400
+    assert client.get('/bulk-approve?batch_id=no-such-batch').status_code == 404
+
+def test_expired_run_failed(mock_requests):
+    """Test the fail expiry policy PATCHes the run as failed"""
+    from app import handle_expired_run
+    data = {'access_token': 'token', 'callback_url': 'http://callback.example.com'}
+
+    with patch('app.EXPIRY_POLICY', 'fail'):
+        handle_expired_run('test-run', data)
+
+    body = mock_requests.patch.call_args[1]['json']
+    assert body['data']['attributes']['status'] == 'failed'
+
+def test_expired_run_passed(mock_requests):
+    """Test the pass expiry policy PATCHes the run as passed"""
+    from app import handle_expired_run
+    data = {'access_token': 'token', 'callback_url': 'http://callback.example.com'}
+
+    with patch('app.EXPIRY_POLICY', 'pass'):
+        handle_expired_run('test-run', data)
+
+    body = mock_requests.patch.call_args[1]['json']
+    assert body['data']['attributes']['status'] == 'passed'
+
+def test_evicted_run_only_failed(mock_requests):
+    """Test an evicted run is failed, never passed or renotified"""
+    from app import handle_expired_run
+    data = {
+        'access_token': 'token',
+        'callback_url': 'http://callback.example.com',
+        'entry': {'run_id': 'test-run'},
+        'evicted': True,
+    }
+
+    for policy in ('pass', 'renotify'):
+        with patch('app.EXPIRY_POLICY', policy):
+            handle_expired_run('test-run', data)
+        body = mock_requests.patch.call_args[1]['json']
+        assert body['data']['attributes']['status'] == 'failed'
+    mock_requests.post.assert_not_called()
+
+def test_expired_run_renotified_then_failed(mock_requests):
+    """Test the renotify policy re-posts with a fresh link, then fails"""
+    from app import handle_expired_run, build_run_entry
+    mock_requests.post.return_value.raise_for_status.return_value = None
+    entry = build_run_entry({'run_id': 'test-run', 'workspace_name': 'ws'}, 'old-uuid')
+    data = {
+        'access_token': 'token',
+        'callback_url': 'http://callback.example.com',
+        'uuid': 'old-uuid',
+        'entry': entry,
+    }
+
+    with patch('app.EXPIRY_POLICY', 'renotify'), \
+         patch('app.EXPIRY_MAX_RENOTIFY', 1), \
+         patch('app.EXPIRY_TRACKING', False):
+        handle_expired_run('test-run', data)
+
+        mock_requests.patch.assert_not_called()
+        mock_requests.post.assert_called_once()
+        card = json.dumps(mock_requests.post.call_args[1]['json'])
+        assert 'Reminder' in card
+        stored = get_token('test-run')
+        assert stored['uuid'] != 'old-uuid'
+        assert stored['uuid'] in card
+        assert stored['renotify_count'] == 1
+
+        # Second expiry exhausts the reminders
+        handle_expired_run('test-run', stored)
+        body = mock_requests.patch.call_args[1]['json']
+        assert body['data']['attributes']['status'] == 'failed'
+    remove_token('test-run')
+
+def test_duplicate_delivery_posts_once(client, mock_requests):
+    """Test that a replayed run task keeps the original approve link working"""
+    mock_requests.post.return_value.raise_for_status.return_value = None
+    payload = {
+        'access_token': 'real-token',
+        'task_result_callback_url': 'http://callback.example.com',
+        'run_id': 'dup-run',
+        'stage': 'post_plan',
+        'is_speculative': True
+    }
+    with patch('app.HMAC_KEY', ''), patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False):
+        first = client.post('/teams-approval', json=payload)
+        uuid = get_token('dup-run')['uuid']
+        second = client.post('/teams-approval', json=payload)
+
+        assert (second.status_code, second.data) == (first.status_code, first.data)
+        mock_requests.post.assert_called_once()
+        assert get_token('dup-run')['uuid'] == uuid
+
+        # A different delivery for the same run is handled normally
+        client.post('/teams-approval', json=dict(payload, stage='pre_apply'))
+        assert mock_requests.post.call_count == 2
+    remove_token('dup-run')
+
+def test_failed_delivery_can_be_retried(client, mock_requests):
+    """Test that HCP's retry after a failed Teams post is not swallowed"""
+    mock_requests.post.side_effect = [requests.RequestException('Teams down'), MagicMock()]
+    payload = {
+        'access_token': 'real-token',
+        'task_result_callback_url': 'http://callback.example.com',
+        'run_id': 'retry-run',
+        'is_speculative': True
+    }
+    with patch('app.HMAC_KEY', ''), patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False):
+        assert client.post('/teams-approval', json=payload).status_code == 500
+        assert client.post('/teams-approval', json=payload).status_code == 200
+    assert mock_requests.post.call_count == 2
+    remove_token('retry-run')
+
+def test_duplicate_detection_shared_via_redis(client, mock_requests):
+    """Test that replicas sharing Redis recognise each other's deliveries"""
+    fakeredis = pytest.importorskip('fakeredis')
+    mock_requests.post.return_value.raise_for_status.return_value = None
+    payload = {
+        'access_token': 'real-token',
+        'task_result_callback_url': 'http://callback.example.com',
+        'run_id': 'redis-dup-run',
+        'is_speculative': True
+    }
+    with patch('app.REDIS_ENABLED', True), \
+         patch('app.redis_client', fakeredis.FakeRedis()), \
+         patch('app.HMAC_KEY', ''), \
+         patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False):
+        client.post('/teams-approval', json=payload)
+        # A second replica has its own guard but the same Redis
+        with patch('app.idempotency', None):
+            response = client.post('/teams-approval', json=payload)
+    assert response.status_code == 200
+    mock_requests.post.assert_called_once()
+
+def test_metrics_endpoint(client, mock_requests):
+    """Test that routes, HMAC checks and store operations are exported"""
+    prometheus_client = pytest.importorskip('prometheus_client')
+    from metrics import Metrics
+    metrics = Metrics(registry=prometheus_client.CollectorRegistry())
+
+    with patch('app.metrics', metrics), \
+         patch('app.HMAC_KEY', 'test-key'), \
+         patch('app.REDIS_ENABLED', False):
+        client.post('/teams-approval', json={'run_id': 'x'})
+        client.get('/approve?run_id=no-such-run&uuid=u')
+        response = client.get('/metrics')
+
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'teams_approval_request_errors_total{route="/teams-approval",status="403"} 1.0' in body
+    assert 'teams_approval_request_errors_total{route="/approve",status="404"} 1.0' in body
+    assert 'teams_approval_hmac_check_duration_seconds_count 1.0' in body
+    assert 'teams_approval_token_store_duration_seconds_count{backend="memory",operation="get_token"} 1.0' in body
+
+def test_metrics_endpoint_disabled(client):
+    """Test /metrics when metrics are turned off"""
+    from metrics import Metrics
+    with patch('app.metrics', Metrics(enabled=False)):
+        assert client.get('/metrics').status_code == 404
@@ -0,0 +1,189 @@
+import pytest
+import json
+import hmac
+import hashlib
+from unittest.mock import patch, AsyncMock, MagicMock
+
+pytest.importorskip('starlette')
+pytest.importorskip('httpx')
+
+from starlette.testclient import TestClient
+import asgi_app
+from idempotency import AsyncIdempotency, AsyncMemoryIdempotencyBackend, MemoryIdempotencyBackend
+from token_store import AsyncLocalTokenStore, MemoryTokenStore
+
+
+@pytest.fixture
+def client():
+    with patch('app.REDIS_ENABLED', False), TestClient(asgi_app.app) as client:
+        # A fresh store per test so runs don't leak between them
+        asgi_app.token_store = AsyncLocalTokenStore(MemoryTokenStore())
+        asgi_app.idempotency = AsyncIdempotency(
+            AsyncMemoryIdempotencyBackend(MemoryIdempotencyBackend())
+        )
+        yield client
+
+@pytest.fixture
+def mock_http():
+    response = MagicMock()
+    response.raise_for_status.return_value = None
+    mock = MagicMock()
+    mock.post = AsyncMock(return_value=response)
+    mock.patch = AsyncMock(return_value=response)
+    with patch('asgi_app.http_client', mock):
+        yield mock
+
+@pytest.fixture
+def payload():
+    return {
+        'access_token': 'real-token',
+        'task_result_callback_url': 'http://callback.example.com',
+        'run_id': 'test-run',
+        'workspace_name': 'test-workspace',
+        'is_speculative': True
+    }
+
+def test_hmac_required(client):
+    """Test that the async app enforces HMAC like the Flask app"""
+    with patch('app.HMAC_KEY', 'test-key'):
+        response = client.post('/teams-approval', json={'test': 'data'})
+    assert response.status_code == 403
+
+def test_hmac_valid_signature(client):
+    """Test that a correctly signed request passes the HMAC check"""
+    body = json.dumps({}).encode('utf-8')
+    signature = hmac.new(b'test-key', body, hashlib.sha512).hexdigest()
+    with patch('app.HMAC_KEY', 'test-key'):
+        response = client.post(
+            '/teams-approval',
+            content=body,
+            headers={'X-Tfc-Task-Signature': signature, 'Content-Type': 'application/json'}
+        )
+    assert response.status_code == 400
+
+def test_teams_approval_then_approve(client, mock_http, payload):
+    """Test the full async flow from run task to approval"""
+    with patch('app.HMAC_KEY', ''), patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False):
+        response = client.post('/teams-approval', json=payload)
+    assert response.status_code == 200
+    mock_http.post.assert_awaited_once()
+
+    uuid = asgi_app.token_store.store.get('test-run')['uuid']
+    response = client.get(f'/approve?run_id=test-run&uuid={uuid}')
+    assert response.status_code == 200
+    assert 'APPROVED' in response.text
+    body = mock_http.patch.await_args[1]['json']
+    assert body['data']['attributes']['status'] == 'passed'
+    assert asgi_app.token_store.store.get('test-run') is None
+
+def test_reject_uuid_mismatch(client, mock_http, payload):
+    """Test that a wrong uuid is refused without calling Terraform"""
+    with patch('app.HMAC_KEY', ''), patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False):
+        client.post('/teams-approval', json=payload)
+
+    response = client.get('/reject?run_id=test-run&uuid=wrong')
+    assert response.status_code == 403
+    mock_http.patch.assert_not_awaited()
+
+def test_reject_expired(client):
+    """Test that an unknown run_id returns 404"""
+    response = client.get('/reject?run_id=expired-run&uuid=abc')
+    assert response.status_code == 404
+
+def test_auto_approve_non_speculative(client, mock_http, payload):
+    """Test auto-approval of non-speculative runs in async mode"""
+    payload['is_speculative'] = False
+    with patch('app.HMAC_KEY', ''), patch('app.FILTER_SPECULATIVE_PLANS_ONLY', True):
+        response = client.post('/teams-approval', json=payload)
+    assert response.status_code == 200
+    assert 'Auto-approved' in response.text
+    mock_http.post.assert_not_awaited()
+
+def test_teams_failure_returns_500(client, mock_http, payload):
+    """Test that a failed Teams post is reported as an error"""
+    mock_http.post.side_effect = Exception('Teams is down')
+    with patch('app.HMAC_KEY', ''), patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False):
+        response = client.post('/teams-approval', json=payload)
+    assert response.status_code == 500
+    assert 'Error in teams_approval' in response.text
+
+def test_bulk_approve_by_workspace(client, mock_http):
+    """Test concurrent bulk approval in async mode"""
+    store = asgi_app.token_store.store
+    for i in range(3):
+        store.set(f'run-{i}', {
+            'access_token': 'token',
+            'callback_url': f'http://callback.example.com/{i}',
+            'uuid': 'abc',
+            'workspace': 'ws-a',
+        }, 600)
+
+    with patch('app.BULK_API_TOKEN', 'secret'):
+        response = client.post(
+            '/bulk-approve',
+            json={'workspace': 'ws-a'},
+            headers={'Authorization': 'Bearer secret'}
+        )
+
+    assert response.status_code == 200
+    assert response.json()['succeeded'] == 3
+    assert mock_http.patch.await_count == 3
+    assert store.find('workspace', 'ws-a') == {}
+
+def test_duplicate_delivery_posts_once(client, mock_http, payload):
+    """Test that a replayed run task gets the original response"""
+    with patch('app.HMAC_KEY', ''), patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False):
+        first = client.post('/teams-approval', json=payload)
+        uuid = asgi_app.token_store.store.get('test-run')['uuid']
+        second = client.post('/teams-approval', json=payload)
+
+    assert (second.status_code, second.text) == (first.status_code, first.text)
+    mock_http.post.assert_awaited_once()
+    assert asgi_app.token_store.store.get('test-run')['uuid'] == uuid
+
+def test_delivery_stats(client):
+    """Test that ASGI mode reports the delivery queue like the Flask app"""
+    queue = MagicMock()
+    queue.stats.return_value = {'queue_depth': 3}
+
+    with patch('app.TEAMS_DELIVERY_MODE', 'queue'), patch('app.delivery_queue', queue):
+        response = client.get('/delivery-stats')
+
+    assert response.status_code == 200
+    assert response.json() == {'queue_depth': 3, 'mode': 'queue'}
+    with patch('app.TEAMS_DELIVERY_MODE', 'sync'):
+        assert client.get('/delivery-stats').json() == {'mode': 'sync'}
+
+def test_metrics_endpoint(client, mock_http, payload):
+    """Test that the async app records routes and outbound calls"""
+    prometheus_client = pytest.importorskip('prometheus_client')
+    from metrics import Metrics
+    metrics = Metrics(registry=prometheus_client.CollectorRegistry())
+
+    with patch('app.metrics', metrics), patch('app.HMAC_KEY', ''), \
+         patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False):
+        client.post('/teams-approval', json=payload)
+        client.get('/no-such-route')
+        body = client.get('/metrics').text
+
+    assert 'teams_approval_request_duration_seconds_count{method="POST",route="/teams-approval"} 1.0' in body
+    assert 'teams_approval_request_errors_total{route="unmatched",status="404"} 1.0' in body
+    assert 'teams_approval_token_store_duration_seconds_count{backend="memory",operation="store_token"} 1.0' in body
+
+def test_shutdown_stops_delivery_queue():
+    """Test that the lifespan shutdown stops the delivery workers"""
+    queue = MagicMock()
+    with patch('app.REDIS_ENABLED', False), patch('app.delivery_queue', queue):
+        with TestClient(asgi_app.app):
+            queue.stop.assert_not_called()
+        queue.stop.assert_called_once()
+
+def test_shutdown_flushes_digest_before_stopping_queue():
+    """Test that the open digest batch is flushed before the workers stop"""
+    parent = MagicMock()
+    with patch('app.REDIS_ENABLED', False), \
+         patch('app.coalescer', parent.coalescer), \
+         patch('app.delivery_queue', parent.queue):
+        with TestClient(asgi_app.app):
+            pass
+    assert [c[0] for c in parent.mock_calls] == ['coalescer.flush_now', 'queue.stop']
@@ -0,0 +1,100 @@
+import pytest
+import threading
+from unittest.mock import MagicMock
+from batching import Coalescer
+
+
+def test_flushes_when_batch_full():
+    """Test that reaching max_batch_size flushes immediately"""
+    flush = MagicMock()
+    coalescer = Coalescer(flush, window_seconds=60, max_batch_size=2)
+
+    first = coalescer.add('a')
+    second = coalescer.add('b')
+
+    assert first == second
+    flush.assert_called_once_with(first, ['a', 'b'])
+
+def test_flushes_when_window_closes():
+    """Test that a partial batch is flushed once the window elapses"""
+    flushed = threading.Event()
+    batches = []
+
+    def flush(batch_id, items):
+        batches.append(items)
+        flushed.set()
+
+    coalescer = Coalescer(flush, window_seconds=0.05, max_batch_size=10)
+    coalescer.add('a')
+
+    assert flushed.wait(2)
+    assert batches == [['a']]
+
+def test_new_batch_after_flush():
+    """Test that items after a flush start a new batch"""
+    flush = MagicMock()
+    coalescer = Coalescer(flush, window_seconds=60, max_batch_size=1)
+
+    assert coalescer.add('a') != coalescer.add('b')
+    assert flush.call_count == 2
+
+def test_flushes_before_exceeding_byte_budget():
+    """Test that an item that would overflow the byte budget opens a new batch"""
+    flush = MagicMock()
+    coalescer = Coalescer(flush, window_seconds=60, max_batch_size=10, max_batch_bytes=10)
+
+    first = coalescer.add('aaaa')
+    assert coalescer.add('bbbb') == first
+    third = coalescer.add('cccc')
+
+    assert third != first
+    flush.assert_called_once_with(first, ['aaaa', 'bbbb'])
+    coalescer.flush_now()
+    flush.assert_called_with(third, ['cccc'])
+
+def test_on_join_runs_before_flush():
+    """Test that on_join sees the batch id before the batch is delivered"""
+    order = []
+    coalescer = Coalescer(lambda batch_id, items: order.append('flush'), 60, 1)
+
+    batch_id = coalescer.add('a', on_join=lambda b: order.append(b))
+
+    assert order == [batch_id, 'flush']
+
+def test_flush_now_and_errors_contained():
+    """Test manual flush and that a failing flush doesn't propagate"""
+    flush = MagicMock(side_effect=Exception('Teams is down'))
+    coalescer = Coalescer(flush, window_seconds=60, max_batch_size=10)
+    coalescer.add('a')
+
+    coalescer.flush_now()
+    flush.assert_called_once()
+    coalescer.flush_now()  # Nothing open; no-op
+    flush.assert_called_once()
+
+def test_failed_on_join_discards_new_batch():
+    """Test that an item whose on_join raises never produces an empty batch"""
+    flush = MagicMock()
+    coalescer = Coalescer(flush, window_seconds=0.05, max_batch_size=10)
+
+    def fail(batch_id):
+        raise Exception('Redis is down')
+
+    with pytest.raises(Exception, match='Redis is down'):
+        coalescer.add('a', on_join=fail)
+    threading.Event().wait(0.2)
+    flush.assert_not_called()
+
+    # A batch that already holds items keeps them
+    batch_id = coalescer.add('b')
+    with pytest.raises(Exception):
+        coalescer.add('c', on_join=fail)
+    coalescer.flush_now()
+    flush.assert_called_once_with(batch_id, ['b'])
+
+def test_empty_batch_never_flushed():
+    """Test that an empty batch is skipped rather than posted"""
+    flush = MagicMock()
+    coalescer = Coalescer(flush, window_seconds=60, max_batch_size=10)
+    coalescer._flush('batch-1', [])
+    flush.assert_not_called()
@@ -0,0 +1,135 @@
+import pytest
+from unittest.mock import MagicMock
+from delivery import (
+    DeliveryQueue, DeliveryQueueFull, MemoryDeliveryBackend, RedisDeliveryBackend
+)
+from http_client import CircuitOpenError
+
+
+@pytest.fixture
+def backend():
+    return MemoryDeliveryBackend(maxsize=2, dead_letter_size=10)
+
+
+def test_memory_backend_bounded(backend):
+    """Test that the in-memory queue rejects items beyond its capacity"""
+    backend.put({'message': 1})
+    backend.put({'message': 2})
+    with pytest.raises(DeliveryQueueFull):
+        backend.put({'message': 3})
+    assert backend.depth() == 2
+
+def test_deliver_success_records_latency(backend):
+    """Test that a successful delivery is counted and timed"""
+    send = MagicMock()
+    dq = DeliveryQueue(send, backend, max_attempts=3, backoff_seconds=0)
+
+    assert dq.deliver({'message': {'text': 'hi'}, 'label': 'run run-1', 'enqueued_at': 0})
+    send.assert_called_once_with({'text': 'hi'})
+    stats = dq.stats()
+    assert stats['delivered'] == 1
+    assert stats['latency_seconds']['max'] > 0
+
+def test_deliver_retries_then_succeeds(backend):
+    """Test that transient failures are retried"""
+    send = MagicMock(side_effect=[Exception('429'), Exception('502'), None])
+    dq = DeliveryQueue(send, backend, max_attempts=3, backoff_seconds=0)
+
+    assert dq.deliver({'message': {}, 'label': 'run run-1'})
+    assert send.call_count == 3
+    assert dq.stats()['retried'] == 2
+
+def test_deliver_dead_letters_after_max_attempts(backend):
+    """Test that a message is dead-lettered once retries are exhausted"""
+    send = MagicMock(side_effect=Exception('Teams is down'))
+    dq = DeliveryQueue(send, backend, max_attempts=2, backoff_seconds=0)
+
+    assert not dq.deliver({'message': {}, 'label': 'run run-1'})
+    assert send.call_count == 2
+    stats = dq.stats()
+    assert stats['failed'] == 1
+    assert stats['dead_letter_depth'] == 1
+
+def test_open_circuit_waits_without_spending_attempts(backend):
+    """Test that an open breaker delays delivery instead of dead-lettering it"""
+    circuit_open = CircuitOpenError('circuit open', retry_after=0)
+    send = MagicMock(side_effect=[circuit_open] * 5 + [Exception('502'), None])
+    dq = DeliveryQueue(send, backend, max_attempts=2, backoff_seconds=0)
+
+    assert dq.deliver({'message': {}, 'label': 'run run-1'})
+    assert send.call_count == 7
+    assert dq.stats()['retried'] == 1
+    assert dq.stats()['dead_letter_depth'] == 0
+
+def test_workers_drain_queue(backend):
+    """Test that background workers deliver enqueued messages"""
+    send = MagicMock()
+    dq = DeliveryQueue(send, backend, workers=1, backoff_seconds=0)
+    try:
+        dq.enqueue({'text': 'hi'}, label='run run-1')
+        for _ in range(50):
+            if dq.delivered:
+                break
+            dq._stop.wait(0.05)
+        send.assert_called_once_with({'text': 'hi'})
+    finally:
+        dq.stop()
+
+@pytest.fixture
+def redis_client():
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeRedis()
+
+def test_redis_backend_holds_message_until_ack(redis_client):
+    """Test that a message stays in the consumer's processing list until acked"""
+    backend = RedisDeliveryBackend(redis_client)
+    backend.put({'message': {'text': 'hi'}})
+
+    item = backend.get(timeout=1)
+    processing = backend.processing_key(backend.consumer)
+    assert item == {'message': {'text': 'hi'}}
+    assert backend.depth() == 0
+    assert redis_client.llen(processing) == 1
+
+    backend.ack(item)
+    assert redis_client.llen(processing) == 0
+
+def test_redis_backend_reclaims_from_dead_consumer(redis_client):
+    """Test that messages held by a consumer that stopped heartbeating go back on the queue"""
+    dead = RedisDeliveryBackend(redis_client, stale_seconds=60)
+    dead.put({'message': 1})
+    dead.get(timeout=1)
+    # The process died mid-delivery: its heartbeat lapses, the message stays
+    redis_client.delete(dead.heartbeat_key(dead.consumer))
+
+    live = RedisDeliveryBackend(redis_client, stale_seconds=60)
+    live.consumer = 'other-replica'
+    assert live.reclaim() == 1
+    assert live.depth() == 1
+    assert redis_client.sismember(live.consumers_key, dead.consumer) == 0
+
+def test_redis_backend_leaves_live_consumers_alone(redis_client):
+    """Test that reclaim never steals a message another consumer is delivering"""
+    busy = RedisDeliveryBackend(redis_client)
+    busy.put({'message': 1})
+    busy.get(timeout=1)
+
+    other = RedisDeliveryBackend(redis_client)
+    other.consumer = 'other-replica'
+    assert other.reclaim() == 0
+    assert other.depth() == 0
+
+def test_stop_hands_back_messages_waiting_to_retry(redis_client):
+    """Test that a message mid-backoff is requeued, not lost, when workers stop"""
+    backend = RedisDeliveryBackend(redis_client)
+    send = MagicMock(side_effect=Exception('Teams is down'))
+    dq = DeliveryQueue(send, backend, workers=1, backoff_seconds=60)
+    dq.enqueue({'text': 'hi'}, label='run run-1')
+    for _ in range(50):
+        if send.called:
+            break
+        dq._stop.wait(0.05)
+
+    dq.stop()
+    assert backend.depth() == 1
+    assert redis_client.llen(backend.processing_key(backend.consumer)) == 0
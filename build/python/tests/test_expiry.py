@@ -0,0 +1,74 @@
+from unittest.mock import MagicMock
+from expiry import ExpiryScheduler
+
+
+def make_store(expired, leader=True):
+    store = MagicMock()
+    store.try_lead.return_value = leader
+    store.pop_expired.return_value = expired
+    return store
+
+def test_sweep_fires_policy_for_each_run():
+    """Test that a sweep hands every claimed run to the policy"""
+    store = make_store([('run-1', {'a': 1}), ('run-2', {'a': 2})])
+    on_expired = MagicMock()
+    scheduler = ExpiryScheduler(lambda: store, on_expired, batch_size=50)
+
+    assert scheduler.sweep() == 2
+    store.pop_expired.assert_called_once_with(50)
+    assert [c.args[0] for c in on_expired.call_args_list] == ['run-1', 'run-2']
+    assert scheduler.fired == 2
+
+def test_sweep_skipped_when_not_leader():
+    """Test that only the elected replica sweeps"""
+    store = make_store([('run-1', {})], leader=False)
+    on_expired = MagicMock()
+    scheduler = ExpiryScheduler(lambda: store, on_expired)
+
+    assert scheduler.sweep() == 0
+    store.pop_expired.assert_not_called()
+    on_expired.assert_not_called()
+
+def test_policy_failure_does_not_stop_sweep():
+    """Test that one failing run doesn't block the rest"""
+    store = make_store([('run-1', {}), ('run-2', {})])
+    on_expired = MagicMock(side_effect=[Exception('Terraform is down'), None])
+    scheduler = ExpiryScheduler(lambda: store, on_expired)
+
+    assert scheduler.sweep() == 2
+    assert on_expired.call_count == 2
+    assert scheduler.fired == 1
+
+def test_failed_policy_requeued_with_backoff():
+    """Test that a run whose policy failed is handed back for a later sweep"""
+    store = make_store([('run-1', {'a': 1, 'expiry_attempts': 1})])
+    on_expired = MagicMock(side_effect=Exception('Terraform is down'))
+    scheduler = ExpiryScheduler(lambda: store, on_expired, retry_seconds=10)
+
+    scheduler.sweep()
+    store.requeue_expired.assert_called_once_with(
+        'run-1', {'a': 1, 'expiry_attempts': 2}, 20)
+
+def test_failed_policy_abandoned_after_max_attempts():
+    """Test that retries stop once max_attempts is reached"""
+    store = make_store([('run-1', {'expiry_attempts': 2})])
+    on_expired = MagicMock(side_effect=Exception('Terraform is down'))
+    scheduler = ExpiryScheduler(lambda: store, on_expired, max_attempts=3)
+
+    scheduler.sweep()
+    store.requeue_expired.assert_not_called()
+    assert scheduler.abandoned == 1
+
+def test_background_thread_sweeps():
+    """Test that the scheduler thread runs sweeps until stopped"""
+    store = make_store([])
+    scheduler = ExpiryScheduler(lambda: store, MagicMock(), poll_seconds=0.01)
+    scheduler.start()
+    try:
+        for _ in range(100):
+            if store.pop_expired.call_count >= 2:
+                break
+            scheduler._stop.wait(0.01)
+        assert store.pop_expired.call_count >= 2
+    finally:
+        scheduler.stop()
@@ -0,0 +1,181 @@
+import pytest
+from unittest.mock import patch, MagicMock
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from http_client import HttpClient, CircuitBreaker, CircuitOpenError
+
+
+def make_response(status, headers=None):
+    resp = MagicMock()
+    resp.status_code = status
+    resp.headers = headers or {}
+    return resp
+
+@pytest.fixture
+def session():
+    with patch.object(HttpClient, '_session') as mock:
+        yield mock.return_value
+
+@pytest.fixture
+def no_sleep():
+    with patch('http_client.time.sleep') as mock:
+        yield mock
+
+def test_default_timeout_applied(session):
+    """Test that every request gets the configured connect/read timeout"""
+    session.request.return_value = make_response(200)
+    client = HttpClient(connect_timeout=1, read_timeout=2)
+
+    client.patch('https://app.terraform.io/api/v2/task-results/1', json={})
+
+    assert session.request.call_args[1]['timeout'] == (1, 2)
+
+def test_session_reused_per_host():
+    """Test that connection pools are shared per host"""
+    client = HttpClient()
+    a = client._session('https://app.terraform.io')
+    b = client._session('https://app.terraform.io')
+    c = client._session('https://example.webhook.office.com')
+    assert a is b
+    assert a is not c
+
+def refused():
+    reason = NewConnectionError(None, 'refused')
+    return requests.ConnectionError(MaxRetryError(None, '/hook', reason))
+
+def test_retries_on_5xx_then_succeeds(session, no_sleep):
+    """Test that 5xx responses are retried"""
+    session.request.side_effect = [make_response(502), make_response(200)]
+    client = HttpClient(max_retries=2)
+
+    resp = client.patch('https://app.terraform.io/api/v2/task-results/1', json={})
+
+    assert resp.status_code == 200
+    assert session.request.call_count == 2
+
+def test_retry_after_header_honoured(session, no_sleep):
+    """Test that Retry-After on 429 sets the backoff delay"""
+    session.request.side_effect = [make_response(429, {'Retry-After': '3'}), make_response(200)]
+    client = HttpClient(max_retries=1, max_backoff_seconds=10)
+
+    client.post('https://example.com/hook', json={})
+
+    no_sleep.assert_called_once_with(3.0)
+
+def test_client_errors_not_retried(session, no_sleep):
+    """Test that 4xx responses other than 429 are returned immediately"""
+    session.request.return_value = make_response(404)
+    client = HttpClient(max_retries=3)
+
+    assert client.post('https://example.com/hook').status_code == 404
+    assert session.request.call_count == 1
+
+def test_connection_error_raised_after_retries(session, no_sleep):
+    """Test that connection errors propagate once retries are exhausted"""
+    session.request.side_effect = requests.ConnectionError('reset')
+    client = HttpClient(max_retries=1)
+
+    with pytest.raises(requests.ConnectionError):
+        client.patch('https://app.terraform.io/api/v2/task-results/1')
+    assert session.request.call_count == 2
+
+@pytest.mark.parametrize('outcome', [
+    make_response(500),
+    make_response(502),
+    requests.ReadTimeout('read timed out'),
+    requests.ConnectionError('connection aborted'),
+])
+def test_post_not_retried_once_it_may_have_landed(session, no_sleep, outcome):
+    """Test that a POST the host may have processed is never sent twice"""
+    session.request.side_effect = [outcome, make_response(200)]
+    client = HttpClient(max_retries=2)
+
+    try:
+        client.post('https://example.com/hook', json={})
+    except requests.RequestException:
+        pass
+    assert session.request.call_count == 1
+
+@pytest.mark.parametrize('outcome', [
+    make_response(429),
+    make_response(503),
+    requests.ConnectTimeout('connect timed out'),
+    refused(),
+])
+def test_post_retried_when_never_processed(session, no_sleep, outcome):
+    """Test that a POST is retried when the host turned it away unprocessed"""
+    session.request.side_effect = [outcome, make_response(200)]
+    client = HttpClient(max_retries=2)
+
+    assert client.post('https://example.com/hook', json={}).status_code == 200
+    assert session.request.call_count == 2
+
+def test_circuit_opens_after_failures(session, no_sleep):
+    """Test that a failing host trips its breaker and later calls fail fast"""
+    session.request.return_value = make_response(503)
+    client = HttpClient(max_retries=0, breaker_threshold=2)
+
+    client.post('https://example.com/hook')
+    client.post('https://example.com/hook')
+    with pytest.raises(CircuitOpenError):
+        client.post('https://example.com/hook')
+    assert session.request.call_count == 2
+
+    # Other hosts are unaffected
+    session.request.return_value = make_response(200)
+    assert client.post('https://other.example.com/hook').status_code == 200
+
+def test_max_retries_overridden_per_call(session, no_sleep):
+    """Test that a caller can turn the client's retries off"""
+    session.request.return_value = make_response(503)
+    client = HttpClient(max_retries=2)
+
+    assert client.post('https://example.com/hook', max_retries=0).status_code == 503
+    assert session.request.call_count == 1
+
+def test_circuit_open_error_reports_retry_after(session, no_sleep):
+    """Test that fail-fast errors say when the breaker will allow a trial"""
+    session.request.return_value = make_response(503)
+    client = HttpClient(max_retries=0, breaker_threshold=1, breaker_reset_seconds=30)
+
+    client.post('https://example.com/hook')
+    with pytest.raises(CircuitOpenError) as excinfo:
+        client.post('https://example.com/hook')
+    assert 29 < excinfo.value.retry_after <= 30
+
+def test_circuit_breaker_half_open():
+    """Test that the breaker lets a trial call through after the reset window"""
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+def test_async_post_retried_only_when_unprocessed():
+    """Test that the async client applies the same POST retry rules"""
+    httpx = pytest.importorskip('httpx')
+    import asyncio
+    from http_client import AsyncHttpClient
+    replies = {'POST': [503, 502, 200], 'PATCH': [502, 503, 200]}
+    statuses = []
+
+    def handler(request):
+        status = replies[request.method][len(statuses)]
+        statuses.append(status)
+        return httpx.Response(status)
+
+    async def send(method):
+        statuses.clear()
+        client = AsyncHttpClient(max_retries=2, backoff_seconds=0)
+        client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return (await client.request(method, 'https://example.com/hook')).status_code
+        finally:
+            await client.aclose()
+
+    # POST: the 503 is retried, the 502 is not
+    assert asyncio.run(send('POST')) == 502
+    assert statuses == [503, 502]
+    # PATCH keeps the full policy
+    assert asyncio.run(send('PATCH')) == 200
+    assert statuses == [502, 503, 200]
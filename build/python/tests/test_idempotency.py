@@ -0,0 +1,153 @@
+import asyncio
+import threading
+import time
+import pytest
+from idempotency import (
+    AsyncIdempotency,
+    AsyncMemoryIdempotencyBackend,
+    Idempotency,
+    MemoryIdempotencyBackend,
+    RedisIdempotencyBackend,
+    idempotency_key,
+)
+
+
+def test_key_depends_on_body():
+    """Test that only an identical delivery maps to the same key"""
+    key = idempotency_key('run-1', 'post_plan', b'{"a": 1}')
+    assert key == idempotency_key('run-1', 'post_plan', b'{"a": 1}')
+    assert key != idempotency_key('run-1', 'post_plan', b'{"a": 2}')
+    assert key != idempotency_key('run-1', 'pre_apply', b'{"a": 1}')
+
+def test_duplicate_replays_original_result():
+    """Test that a duplicate returns the recorded result without re-running"""
+    guard = Idempotency(MemoryIdempotencyBackend())
+    calls = []
+    handler = lambda: calls.append(1) or ('Posted', 200)
+
+    assert guard.run('key', handler) == ('Posted', 200)
+    assert guard.run('key', handler) == ('Posted', 200)
+    assert len(calls) == 1
+    assert guard.replayed == 1
+
+def test_failures_are_not_recorded():
+    """Test that a retry after an error gets a fresh attempt"""
+    guard = Idempotency(MemoryIdempotencyBackend())
+    results = [('Error', 500), ('Posted', 200)]
+    assert guard.run('key', lambda: results.pop(0)) == ('Error', 500)
+    assert guard.run('key', lambda: results.pop(0)) == ('Posted', 200)
+
+def test_exception_releases_claim():
+    """Test that a handler exception doesn't leave the key locked"""
+    guard = Idempotency(MemoryIdempotencyBackend(), wait_seconds=0)
+
+    def fail():
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        guard.run('key', fail)
+    assert guard.run('key', lambda: ('Posted', 200)) == ('Posted', 200)
+
+def test_concurrent_duplicates_collapse():
+    """Test that duplicates arriving mid-request wait for the original"""
+    guard = Idempotency(MemoryIdempotencyBackend(), poll_seconds=0.01)
+    calls = []
+
+    def handler():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'Posted', 200
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(guard.run('key', handler)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [('Posted', 200)] * 5
+
+def test_wait_gives_up_while_original_in_progress():
+    """Test that a duplicate stops waiting after wait_seconds"""
+    backend = MemoryIdempotencyBackend()
+    assert backend.claim('key', 'original', 30)[0] == 'claimed'
+    guard = Idempotency(backend, wait_seconds=0.05, poll_seconds=0.01)
+    assert guard.run('key', lambda: ('Posted', 200)) is None
+
+def test_expired_lease_can_be_reclaimed(monkeypatch):
+    """Test that a crashed request's claim doesn't block duplicates forever"""
+    now = [1000.0]
+    monkeypatch.setattr('idempotency.time.monotonic', lambda: now[0])
+    backend = MemoryIdempotencyBackend()
+    assert backend.claim('key', 'crashed', 30)[0] == 'claimed'
+    assert backend.claim('key', 'retry', 30)[0] == 'busy'
+    now[0] += 31
+    assert backend.claim('key', 'retry', 30)[0] == 'claimed'
+
+def test_results_expire_and_are_bounded(monkeypatch):
+    """Test the result TTL and LRU bound"""
+    now = [1000.0]
+    monkeypatch.setattr('idempotency.time.monotonic', lambda: now[0])
+    backend = MemoryIdempotencyBackend(max_size=2)
+    for key in ('a', 'b', 'c'):
+        backend.claim(key, 'owner', 30)
+        backend.complete(key, 'owner', ('ok', 200), 60)
+    assert backend.claim('a', 'owner', 30)[0] == 'claimed'
+    assert backend.claim('c', 'owner', 30) == ('done', ('ok', 200))
+    now[0] += 61
+    assert backend.claim('c', 'owner', 30)[0] == 'claimed'
+
+def test_backend_failure_fails_open():
+    """Test that an unreachable backend doesn't drop the run task"""
+    class Broken:
+        def claim(self, *args):
+            raise ConnectionError('redis down')
+
+    guard = Idempotency(Broken())
+    assert guard.run('key', lambda: ('Posted', 200)) == ('Posted', 200)
+
+def test_redis_backend_shared_between_replicas():
+    """Test that two replicas sharing Redis see each other's deliveries"""
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeRedis()
+    replica_a = Idempotency(RedisIdempotencyBackend(client), wait_seconds=0)
+    replica_b = Idempotency(RedisIdempotencyBackend(client), wait_seconds=0)
+    calls = []
+    handler = lambda: calls.append(1) or ('Posted', 200)
+
+    assert replica_a.run('key', handler) == ('Posted', 200)
+    assert replica_b.run('key', handler) == ('Posted', 200)
+    assert len(calls) == 1
+    assert client.ttl('teams-approval:idempotency:key') > 0
+    assert not client.exists('teams-approval:idempotency:key:lock')
+
+    # A claim held elsewhere makes a duplicate wait, then give up
+    assert RedisIdempotencyBackend(client).claim('other', 'owner', 30)[0] == 'claimed'
+    assert replica_b.run('other', handler) is None
+    # Only the owner can release its claim
+    replica_b.backend.release('other', 'someone-else')
+    assert client.exists('teams-approval:idempotency:other:lock')
+    replica_b.backend.release('other', 'owner')
+    assert not client.exists('teams-approval:idempotency:other:lock')
+
+def test_async_duplicates_collapse():
+    """Test the event-loop coordinator collapses concurrent duplicates"""
+    guard = AsyncIdempotency(
+        AsyncMemoryIdempotencyBackend(MemoryIdempotencyBackend()), poll_seconds=0.01
+    )
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'Posted', 200
+
+    async def main():
+        return await asyncio.gather(*(guard.run('key', handler) for _ in range(5)))
+
+    assert asyncio.run(main()) == [('Posted', 200)] * 5
+    assert len(calls) == 1
@@ -0,0 +1,68 @@
+import threading
+import pytest
+import requests
+from unittest.mock import patch
+from werkzeug.serving import make_server
+
+import app
+from benchmarks.load_test import HMAC_KEY, Driver, percentile, sustainable, parse_args
+from benchmarks.stub_servers import TeamsWebhookStub, TerraformCallbackStub
+
+
+@pytest.fixture
+def teams():
+    with TeamsWebhookStub() as stub:
+        yield stub
+
+@pytest.fixture
+def callback():
+    with TerraformCallbackStub() as stub:
+        yield stub
+
+@pytest.fixture
+def app_url(teams):
+    server = make_server('127.0.0.1', 0, app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    with patch('app.HMAC_KEY', HMAC_KEY), \
+         patch('app.TEAMS_WEBHOOK_URL', teams.url), \
+         patch('app.FILTER_SPECULATIVE_PLANS_ONLY', False), \
+         patch('app.TEAMS_BATCH_WINDOW_MS', 0), \
+         patch('app.TEAMS_DELIVERY_MODE', 'sync'), \
+         patch('app.REDIS_ENABLED', False):
+        thread.start()
+        yield f'http://127.0.0.1:{server.server_port}'
+        server.shutdown()
+
+def test_percentile():
+    """Test nearest-rank percentiles"""
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([7], 99) == 7
+    assert percentile([], 50) is None
+
+def test_error_injection():
+    """Test that the stubs fail requests on demand"""
+    with TeamsWebhookStub(error_rate=1.0, error_status=429) as stub:
+        assert requests.post(stub.url, json={}).status_code == 429
+        assert stub.errors == 1
+
+def test_teams_stub_captures_approve_links(teams):
+    """Test that the Teams stub records the uuid from a posted card"""
+    card = app.build_teams_message({'run_id': 'run-1'}, 'abc123def456')
+    requests.post(teams.url, json=card)
+    assert teams.wait_for_uuid('run-1', timeout=1) == 'abc123def456'
+    assert teams.wait_for_uuid('run-2', timeout=0.01) is None
+
+def test_end_to_end_run(app_url, teams, callback):
+    """Test the driver against the real app and both stubs"""
+    driver = Driver(app_url, teams, callback, max_in_flight=8)
+    step = driver.run(rate=20, duration=0.5)
+
+    assert step['succeeded'] == step['runs'] == 10
+    assert step['end_to_end']['p99_ms'] > 0
+    assert sorted(set(callback.results.values())) == ['passed']
+    assert len(callback.results) == 10
+
+    args = parse_args(['--slo-p99-ms', '10000'])
+    assert sustainable(step, args)
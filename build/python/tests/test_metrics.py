@@ -0,0 +1,108 @@
+import pytest
+from unittest.mock import patch, MagicMock
+import requests
+
+prometheus_client = pytest.importorskip('prometheus_client')
+
+from http_client import HttpClient
+from metrics import Metrics
+
+
+@pytest.fixture
+def metrics():
+    return Metrics(registry=prometheus_client.CollectorRegistry())
+
+def sample(metrics, name, **labels):
+    return metrics.registry.get_sample_value(f'teams_approval_{name}', labels) or 0
+
+def test_request_latency_and_errors(metrics):
+    """Test inbound latency, in-flight gauge and error counters"""
+    handle = metrics.request_started('/approve', 'GET')
+    assert sample(metrics, 'requests_in_flight', route='/approve') == 1
+    metrics.request_finished('/approve', 'GET', 404, handle)
+
+    ok = metrics.request_started('/approve', 'GET')
+    metrics.request_finished('/approve', 'GET', 200, ok)
+
+    assert sample(metrics, 'requests_in_flight', route='/approve') == 0
+    assert sample(metrics, 'request_duration_seconds_count', route='/approve', method='GET') == 2
+    assert sample(metrics, 'request_errors_total', route='/approve', status='404') == 1
+    assert sample(metrics, 'request_errors_total', route='/approve', status='200') == 0
+
+def test_store_operation_timed_and_errors_counted(metrics):
+    """Test token store timings per operation and backend"""
+    with metrics.store_operation('get_token', 'redis'):
+        pass
+    with pytest.raises(ConnectionError):
+        with metrics.store_operation('get_token', 'redis'):
+            raise ConnectionError('redis down')
+
+    labels = {'operation': 'get_token', 'backend': 'redis'}
+    assert sample(metrics, 'token_store_duration_seconds_count', **labels) == 2
+    assert sample(metrics, 'token_store_errors_total', **labels) == 1
+
+def test_outbound_calls_recorded_per_host(metrics):
+    """Test that HttpClient records latency and errors per host"""
+    client = HttpClient(max_retries=0, metrics=metrics)
+    response = MagicMock(status_code=404, headers={})
+    with patch.object(HttpClient, '_session') as session:
+        session.return_value.request.side_effect = [
+            response,
+            requests.ConnectionError('refused'),
+        ]
+        client.patch('https://app.terraform.io/api/v2/task-results/1', json={})
+        with pytest.raises(requests.ConnectionError):
+            client.post('https://example.webhook.office.com/hook', json={})
+
+    terraform = 'https://app.terraform.io'
+    teams = 'https://example.webhook.office.com'
+    assert sample(metrics, 'outbound_request_duration_seconds_count', host=terraform, method='PATCH') == 1
+    assert sample(metrics, 'outbound_request_errors_total', host=terraform, status='404') == 1
+    assert sample(metrics, 'outbound_request_errors_total', host=teams, status='ConnectionError') == 1
+    assert sample(metrics, 'outbound_requests_in_flight', host=teams) == 0
+
+def test_hmac_check_timed(metrics):
+    """Test that HMAC checks are timed"""
+    with metrics.hmac_check():
+        pass
+    assert sample(metrics, 'hmac_check_duration_seconds_count') == 1
+
+def test_render(metrics):
+    """Test the exposition format"""
+    with metrics.hmac_check():
+        pass
+    body, content_type = metrics.render()
+    assert content_type.startswith('text/plain')
+    assert b'teams_approval_hmac_check_duration_seconds_count 1.0' in body
+
+def test_disabled_is_noop():
+    """Test that disabled metrics record nothing and don't fail"""
+    metrics = Metrics(enabled=False)
+    handle = metrics.request_started('/approve', 'GET')
+    metrics.request_finished('/approve', 'GET', 500, handle)
+    with metrics.store_operation('get_token', 'memory'):
+        pass
+    assert not metrics.enabled
+
+def test_spans_emitted():
+    """Test optional OpenTelemetry spans for requests and store operations"""
+    pytest.importorskip('opentelemetry.sdk')
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    with patch('metrics.trace.get_tracer', provider.get_tracer):
+        metrics = Metrics(tracing=True, registry=prometheus_client.CollectorRegistry())
+
+    handle = metrics.request_started('/approve', 'GET')
+    with metrics.store_operation('get_token', 'memory'):
+        pass
+    metrics.request_finished('/approve', 'GET', 200, handle)
+
+    spans = {span.name: span for span in exporter.get_finished_spans()}
+    assert set(spans) == {'GET /approve', 'token_store.get_token'}
+    assert spans['token_store.get_token'].parent.span_id == spans['GET /approve'].context.span_id
+    assert spans['GET /approve'].attributes['http.status_code'] == 200
@@ -0,0 +1,303 @@
+import json
+import pytest
+from unittest.mock import patch, MagicMock
+from token_store import MemoryTokenStore, SQLiteTokenStore, RedisTokenStore
+
+
+@pytest.fixture
+def clock():
+    """Patch both clocks used by the stores with one controllable value"""
+    now = [1000.0]
+    with patch('token_store.time.monotonic', side_effect=lambda: now[0]), \
+         patch('token_store.time.time', side_effect=lambda: now[0]):
+        yield now
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def local_store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryTokenStore(max_size=100)
+    return SQLiteTokenStore(str(tmp_path / 'tokens.db'), purge_interval_seconds=0)
+
+def test_set_get_delete(local_store):
+    """Test the basic store contract on every local backend"""
+    local_store.set('run-1', {'uuid': 'abc'}, 600)
+    assert local_store.get('run-1') == {'uuid': 'abc'}
+    local_store.delete('run-1')
+    assert local_store.get('run-1') is None
+    # Deleting a missing key is a no-op
+    local_store.delete('run-1')
+
+def test_ttl_expiry(local_store, clock):
+    """Test that entries disappear once their TTL elapses"""
+    local_store.set('run-1', {'uuid': 'abc'}, 10)
+    clock[0] += 9
+    assert local_store.get('run-1') == {'uuid': 'abc'}
+    clock[0] += 2
+    assert local_store.get('run-1') is None
+
+def test_overwrite_resets_ttl(local_store, clock):
+    """Test that re-storing a run_id replaces its data and expiry"""
+    local_store.set('run-1', {'uuid': 'old'}, 10)
+    clock[0] += 8
+    local_store.set('run-1', {'uuid': 'new'}, 10)
+    clock[0] += 8
+    assert local_store.get('run-1') == {'uuid': 'new'}
+
+def test_memory_purges_expired_on_write(clock):
+    """Test that abandoned runs are purged instead of leaking"""
+    store = MemoryTokenStore()
+    for i in range(50):
+        store.set(f'run-{i}', {}, 10)
+    clock[0] += 11
+    store.set('run-new', {}, 10)
+    assert len(store) == 1
+
+def test_memory_lru_eviction():
+    """Test that the least recently used entry is evicted at max size"""
+    store = MemoryTokenStore(max_size=2)
+    store.set('run-1', {}, 600)
+    store.set('run-2', {}, 600)
+    store.get('run-1')  # run-2 is now least recently used
+    store.set('run-3', {}, 600)
+    assert store.get('run-1') == {}
+    assert store.get('run-2') is None
+    assert store.get('run-3') == {}
+
+def test_memory_heap_compacts():
+    """Test that repeated overwrites don't grow the expiry heap unbounded"""
+    store = MemoryTokenStore()
+    for _ in range(1000):
+        store.set('run-1', {}, 600)
+    assert len(store._expiries) < 100
+
+def test_sqlite_shared_between_connections(tmp_path):
+    """Test that two store instances (e.g. two workers) see the same tokens"""
+    path = str(tmp_path / 'tokens.db')
+    writer = SQLiteTokenStore(path)
+    reader = SQLiteTokenStore(path)
+    writer.set('run-1', {'uuid': 'abc'}, 600)
+    assert reader.get('run-1') == {'uuid': 'abc'}
+    reader.delete('run-1')
+    assert writer.get('run-1') is None
+
+def test_redis_store():
+    """Test that the Redis backend uses SETEX for TTL"""
+    client = MagicMock()
+    store = RedisTokenStore(client)
+
+    store.set('run-1', {'uuid': 'abc'}, 600)
+    client.setex.assert_called_once_with('run-1', 600, json.dumps({'uuid': 'abc'}))
+
+    client.get.return_value = None
+    assert store.get('run-1') is None
+
+    store.delete('run-1')
+    client.delete.assert_called_once_with('run-1')
+
+def test_find_by_index(local_store):
+    """Test workspace and batch lookups on every local backend"""
+    local_store.set('run-1', {'workspace': 'ws-a', 'batch_id': 'b1'}, 600)
+    local_store.set('run-2', {'workspace': 'ws-a', 'batch_id': 'b2'}, 600)
+    local_store.set('run-3', {'workspace': 'ws-b', 'batch_id': 'b1'}, 600)
+
+    assert set(local_store.find('workspace', 'ws-a')) == {'run-1', 'run-2'}
+    assert set(local_store.find('batch_id', 'b1')) == {'run-1', 'run-3'}
+    assert local_store.find('workspace', 'missing') == {}
+
+    local_store.delete('run-1')
+    assert set(local_store.find('workspace', 'ws-a')) == {'run-2'}
+
+def test_find_skips_expired(local_store, clock):
+    """Test that index lookups honour the TTL"""
+    local_store.set('run-1', {'workspace': 'ws-a'}, 10)
+    local_store.set('run-2', {'workspace': 'ws-a'}, 100)
+    clock[0] += 11
+    assert set(local_store.find('workspace', 'ws-a')) == {'run-2'}
+
+def test_get_many(local_store):
+    """Test fetching several runs at once"""
+    local_store.set('run-1', {'uuid': '1'}, 600)
+    local_store.set('run-2', {'uuid': '2'}, 600)
+    assert local_store.get_many(['run-1', 'run-2', 'run-3']) == {
+        'run-1': {'uuid': '1'},
+        'run-2': {'uuid': '2'},
+    }
+
+def test_memory_index_follows_overwrite_and_eviction():
+    """Test that the memory index drops runs that are re-stored or evicted"""
+    store = MemoryTokenStore(max_size=1)
+    store.set('run-1', {'workspace': 'ws-a'}, 600)
+    store.set('run-1', {'workspace': 'ws-b'}, 600)
+    assert store.find('workspace', 'ws-a') == {}
+    store.set('run-2', {'workspace': 'ws-b'}, 600)
+    assert set(store.find('workspace', 'ws-b')) == {'run-2'}
+    assert store._index == {('workspace', 'ws-b'): {'run-2'}}
+
+def test_sqlite_upgrades_old_schema(tmp_path):
+    """Test that a database created before the index columns still works"""
+    import sqlite3
+    path = str(tmp_path / 'tokens.db')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE tokens (run_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+    )
+    conn.commit()
+    conn.close()
+
+    store = SQLiteTokenStore(path)
+    store.set('run-1', {'workspace': 'ws-a'}, 600)
+    assert set(store.find('workspace', 'ws-a')) == {'run-1'}
+
+def test_redis_find_single_round_trip():
+    """Test that Redis index lookups are one SORT ... GET and prune stale members"""
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeRedis()
+    store = RedisTokenStore(client)
+    store.set('run-1', {'workspace': 'ws-a'}, 600)
+    store.set('run-2', {'workspace': 'ws-a'}, 600)
+    store.delete('run-2')
+
+    with patch.object(client, 'get', wraps=client.get) as get:
+        assert store.find('workspace', 'ws-a') == {'run-1': {'workspace': 'ws-a'}}
+        get.assert_not_called()
+    assert client.smembers('teams-approval:index:workspace:ws-a') == {b'run-1'}
+    assert client.ttl('teams-approval:index:workspace:ws-a') > 0
+    assert store.get_many(['run-1', 'run-2']) == {'run-1': {'workspace': 'ws-a'}}
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def tracking_store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryTokenStore(track_expiry=True)
+    return SQLiteTokenStore(str(tmp_path / 'tokens.db'), track_expiry=True)
+
+def test_pop_expired_exactly_once(tracking_store, clock):
+    """Test that each expired run is claimed once and only once"""
+    tracking_store.set('run-1', {'uuid': '1'}, 10)
+    tracking_store.set('run-2', {'uuid': '2'}, 100)
+    assert tracking_store.pop_expired() == []
+
+    clock[0] += 11
+    assert tracking_store.get('run-1') is None
+    assert tracking_store.pop_expired() == [('run-1', {'uuid': '1'})]
+    assert tracking_store.pop_expired() == []
+
+def test_pop_expired_skips_resolved(tracking_store, clock):
+    """Test that approved/rejected runs never reach the expiry policy"""
+    tracking_store.set('run-1', {}, 10)
+    tracking_store.delete('run-1')
+    clock[0] += 11
+    assert tracking_store.pop_expired() == []
+
+def test_pop_expired_respects_limit(tracking_store, clock):
+    """Test that sweeps are bounded"""
+    for i in range(5):
+        tracking_store.set(f'run-{i}', {}, 10)
+    clock[0] += 11
+    assert len(tracking_store.pop_expired(limit=3)) == 3
+    assert len(tracking_store.pop_expired(limit=3)) == 2
+
+def test_requeued_run_claimed_again_after_delay(tracking_store, clock):
+    """Test that a requeued run stays unapprovable and is claimed after its delay"""
+    tracking_store.set('run-1', {'uuid': '1'}, 10)
+    clock[0] += 11
+    [(run_id, data)] = tracking_store.pop_expired()
+
+    tracking_store.requeue_expired(run_id, dict(data, expiry_attempts=1), 30)
+    assert tracking_store.get('run-1') is None
+    assert tracking_store.pop_expired() == []
+    clock[0] += 31
+    assert tracking_store.pop_expired() == [('run-1', {'uuid': '1', 'expiry_attempts': 1})]
+    assert tracking_store.pop_expired() == []
+
+def test_requeue_leaves_fresh_token_alone(tracking_store, clock):
+    """Test that a requeue doesn't clobber a token stored since the claim"""
+    tracking_store.set('run-1', {'uuid': 'old'}, 10)
+    clock[0] += 11
+    tracking_store.pop_expired()
+    tracking_store.set('run-1', {'uuid': 'new'}, 100)
+
+    tracking_store.requeue_expired('run-1', {'uuid': 'old'}, 30)
+    clock[0] += 31
+    assert tracking_store.get('run-1') == {'uuid': 'new'}
+    assert tracking_store.pop_expired() == []
+
+def test_untracked_store_reports_nothing(local_store, clock):
+    """Test that expiry tracking is opt-in"""
+    local_store.set('run-1', {}, 10)
+    clock[0] += 11
+    assert local_store.pop_expired() == []
+
+def test_memory_eviction_reported_as_evicted():
+    """Test that runs evicted for space are handed over flagged as evicted"""
+    store = MemoryTokenStore(max_size=1, track_expiry=True)
+    store.set('run-1', {'uuid': '1'}, 600)
+    store.set('run-2', {'uuid': '2'}, 600)
+    assert store.pop_expired() == [('run-1', {'uuid': '1', 'evicted': True})]
+
+def test_sqlite_expiry_shared_between_workers(tmp_path, clock):
+    """Test that two workers sharing a file claim each expired run once"""
+    path = str(tmp_path / 'tokens.db')
+    worker_a = SQLiteTokenStore(path, track_expiry=True)
+    worker_b = SQLiteTokenStore(path, track_expiry=True)
+    for i in range(4):
+        worker_a.set(f'run-{i}', {}, 10)
+    clock[0] += 11
+
+    claimed = worker_a.pop_expired(limit=2) + worker_b.pop_expired() + worker_a.pop_expired()
+    assert sorted(run_id for run_id, _ in claimed) == ['run-0', 'run-1', 'run-2', 'run-3']
+
+def test_redis_expiry_tracking(clock):
+    """Test Redis expiry via the sorted set, grace period and leader lock"""
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeRedis()
+    store = RedisTokenStore(client, track_expiry=True, expiry_grace_seconds=60)
+    other_replica = RedisTokenStore(client, track_expiry=True, expiry_grace_seconds=60)
+
+    store.set('run-1', {'uuid': '1'}, 10)
+    store.set('run-2', {'uuid': '2'}, 10)
+    store.delete('run-2')
+    assert store.get('run-1') == {'uuid': '1'}
+    # The key outlives the logical TTL so the sweep can still read it
+    assert client.ttl('run-1') > 10
+
+    clock[0] += 11
+    assert store.get('run-1') is None
+    assert store.pop_expired() == [('run-1', {'uuid': '1'})]
+    assert other_replica.pop_expired() == []
+    assert client.exists('run-1') == 0
+    assert client.zcard('teams-approval:expiry') == 0
+
+    assert store.try_lead('replica-a', 10)
+    assert store.try_lead('replica-a', 10)
+    assert not other_replica.try_lead('replica-b', 10)
+
+def test_redis_requeue_expired(clock):
+    """Test that a requeued run goes back in the sorted set with its retry time"""
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeRedis()
+    store = RedisTokenStore(client, track_expiry=True, expiry_grace_seconds=60)
+    store.set('run-1', {'uuid': '1'}, 10)
+    clock[0] += 11
+    [(run_id, data)] = store.pop_expired()
+
+    store.requeue_expired(run_id, dict(data, expiry_attempts=1), 30)
+    assert store.get('run-1') is None
+    assert client.zscore('teams-approval:expiry', 'run-1') == clock[0] + 30
+    assert store.pop_expired() == []
+    clock[0] += 31
+    assert store.pop_expired() == [('run-1', {'uuid': '1', 'expiry_attempts': 1})]
+    assert client.exists('run-1') == 0
+
+def test_redis_expiry_restores_restored_run(clock):
+    """Test that a run re-stored mid-sweep keeps its new deadline"""
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeRedis()
+    store = RedisTokenStore(client, track_expiry=True)
+    store.set('run-1', {'uuid': 'old'}, 10)
+    clock[0] += 11
+    # Simulate the token being re-stored after the sweep's range query
+    client.set('run-1', json.dumps({'uuid': 'new', '_expires_at': clock[0] + 100}))
+
+    assert store.pop_expired() == []
+    assert client.zscore('teams-approval:expiry', 'run-1') == clock[0] + 100
+    assert store.get('run-1') == {'uuid': 'new'}
@@ -0,0 +1,651 @@
+import asyncio
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Token data fields the stores keep a secondary index on, for bulk lookups
+INDEX_FIELDS = ("workspace", "batch_id")
+
+
+class TokenStore:
+    """
+    Interface for ephemeral run task tokens.
+
+    Every backend honours `ttl_seconds` the same way: once it has elapsed the
+    entry is gone as far as `get` is concerned, whether or not it has been
+    physically purged yet.
+
+    A store created with `track_expiry=True` also keeps expired entries
+    around until `pop_expired` hands each one out exactly once, so an expiry
+    policy can still resolve the run with its access token.
+    """
+
+    name = "base"
+
+    def set(self, run_id, data, ttl_seconds):
+        raise NotImplementedError
+
+    def get(self, run_id):
+        raise NotImplementedError
+
+    def delete(self, run_id):
+        raise NotImplementedError
+
+    def get_many(self, run_ids):
+        """
+        Return {run_id: data} for those of `run_ids` that are still pending.
+        """
+        found = {}
+        for run_id in run_ids:
+            data = self.get(run_id)
+            if data is not None:
+                found[run_id] = data
+        return found
+
+    def find(self, field, value):
+        """
+        Return {run_id: data} for every pending run whose `field` (one of
+        INDEX_FIELDS) equals `value`.
+        """
+        raise NotImplementedError
+
+    def pop_expired(self, limit=100):
+        """
+        Claim up to `limit` expired runs as [(run_id, data)]. Each expired run
+        is returned once across every process sharing the store.
+        """
+        return []
+
+    def requeue_expired(self, run_id, data, delay_seconds):
+        """
+        Hand a claimed run out of `pop_expired` again after `delay_seconds`,
+        e.g. because its expiry policy failed. The run stays unapprovable in
+        the meantime, and is dropped if a fresh token was stored for it.
+        """
+
+    def try_lead(self, owner, lease_seconds):
+        """
+        Return True if `owner` should run the expiry sweep. Only shared
+        backends need to elect a single sweeper.
+        """
+        return True
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    Per-process store with expiry and a size cap.
+
+    Expiry times sit in a min-heap so purging expired entries is O(log n)
+    each, and the entries themselves sit in an OrderedDict so the least
+    recently used one can be evicted when the store is full. A dict of sets
+    indexes run_ids by INDEX_FIELDS.
+
+    With `track_expiry`, expired and evicted entries move to a queue for
+    `pop_expired`. An evicted run can no longer be approved either, so it is
+    reported rather than left hanging, but flagged `evicted`: its approval
+    window hasn't closed, so only failing it is safe.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_size=10000, track_expiry=False):
+        self.max_size = max_size
+        self.track_expiry = track_expiry
+        self._entries = OrderedDict()  # run_id -> (expires_at, data)
+        self._expiries = []  # heap of (expires_at, run_id)
+        self._index = {}  # (field, value) -> set of run_ids
+        self._expired = deque()  # (run_id, data) awaiting pop_expired
+        self._retries = []  # heap of (due_at, run_id) for requeue_expired
+        self._retry_data = {}  # run_id -> data
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _add_to_index(self, run_id, data):
+        for field in INDEX_FIELDS:
+            if data.get(field):
+                self._index.setdefault((field, data[field]), set()).add(run_id)
+
+    def _remove(self, run_id):
+        entry = self._entries.pop(run_id, None)
+        if entry is None:
+            return None
+        for field in INDEX_FIELDS:
+            key = (field, entry[1].get(field))
+            run_ids = self._index.get(key)
+            if run_ids is not None:
+                run_ids.discard(run_id)
+                if not run_ids:
+                    del self._index[key]
+        return entry[1]
+
+    def _expire(self, run_id):
+        data = self._remove(run_id)
+        if data is not None and self.track_expiry:
+            self._expired.append((run_id, data))
+
+    def _evict(self, run_id):
+        data = self._remove(run_id)
+        if data is not None and self.track_expiry:
+            self._expired.append((run_id, dict(data, evicted=True)))
+
+    def _purge_expired(self, now):
+        while self._expiries and self._expiries[0][0] <= now:
+            expires_at, run_id = heapq.heappop(self._expiries)
+            entry = self._entries.get(run_id)
+            # Skip heap entries left behind by an overwrite or delete
+            if entry is not None and entry[0] == expires_at:
+                self._expire(run_id)
+
+    def _compact(self):
+        # Overwrites and deletes leave stale heap entries; rebuild if they dominate
+        if len(self._expiries) > 2 * len(self._entries) + 64:
+            self._expiries = [(e[0], k) for k, e in self._entries.items()]
+            heapq.heapify(self._expiries)
+
+    def set(self, run_id, data, ttl_seconds):
+        now = time.monotonic()
+        expires_at = now + ttl_seconds
+        with self._lock:
+            self._purge_expired(now)
+            self._remove(run_id)
+            self._entries[run_id] = (expires_at, data)
+            self._add_to_index(run_id, data)
+            heapq.heappush(self._expiries, (expires_at, run_id))
+            while len(self._entries) > self.max_size:
+                self._evict(next(iter(self._entries)))
+            self._compact()
+
+    def get(self, run_id):
+        with self._lock:
+            entry = self._entries.get(run_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._expire(run_id)
+                return None
+            self._entries.move_to_end(run_id)
+            return entry[1]
+
+    def delete(self, run_id):
+        with self._lock:
+            self._remove(run_id)
+
+    def find(self, field, value):
+        now = time.monotonic()
+        with self._lock:
+            found = {}
+            for run_id in self._index.get((field, value), ()):
+                expires_at, data = self._entries[run_id]
+                if expires_at > now:
+                    found[run_id] = data
+            return found
+
+    def pop_expired(self, limit=100):
+        with self._lock:
+            now = time.monotonic()
+            self._purge_expired(now)
+            while self._retries and self._retries[0][0] <= now:
+                run_id = heapq.heappop(self._retries)[1]
+                self._expired.append((run_id, self._retry_data.pop(run_id)))
+            claimed = []
+            while self._expired and len(claimed) < limit:
+                claimed.append(self._expired.popleft())
+            return claimed
+
+    def requeue_expired(self, run_id, data, delay_seconds):
+        with self._lock:
+            if run_id in self._entries or run_id in self._retry_data:
+                return
+            self._retry_data[run_id] = data
+            heapq.heappush(self._retries, (time.monotonic() + delay_seconds, run_id))
+
+
+class SQLiteTokenStore(TokenStore):
+    """
+    File-backed store shared by every worker process on one host, for
+    multi-worker deployments without Redis. Uses WAL so readers never block
+    the writer.
+
+    With `track_expiry`, expired rows are kept for `expiry_grace_seconds` so
+    `pop_expired` can claim them. A claim is a conditional DELETE, so only one
+    worker wins each row. A requeued row goes back in already expired, with
+    `retry_at` holding it back from the next claim.
+    """
+
+    name = "sqlite"
+
+    def __init__(
+        self,
+        path,
+        purge_interval_seconds=30.0,
+        track_expiry=False,
+        expiry_grace_seconds=300.0,
+    ):
+        self.path = path
+        self.purge_interval_seconds = purge_interval_seconds
+        self.track_expiry = track_expiry
+        self.expiry_grace_seconds = expiry_grace_seconds
+        self._local = threading.local()
+        self._last_purge = 0.0
+        self._connect()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        # Connections must not be shared across a fork or between threads
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tokens ("
+            "run_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        # Index and retry columns were added after the table; upgrade older
+        # files in place
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(tokens)")}
+        if "retry_at" not in columns:
+            conn.execute("ALTER TABLE tokens ADD COLUMN retry_at REAL")
+        for field in INDEX_FIELDS:
+            if field not in columns:
+                conn.execute(f"ALTER TABLE tokens ADD COLUMN {field} TEXT")
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS tokens_{field} ON tokens ({field})"
+            )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at)"
+        )
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _purge_expired(self, conn, now):
+        if now - self._last_purge < self.purge_interval_seconds:
+            return
+        self._last_purge = now
+        if self.track_expiry:
+            # Leave recently expired rows for pop_expired to claim
+            now -= self.expiry_grace_seconds
+        conn.execute(
+            "DELETE FROM tokens WHERE expires_at <= ? "
+            "AND (retry_at IS NULL OR retry_at <= ?)",
+            (now, now),
+        )
+
+    def set(self, run_id, data, ttl_seconds):
+        # Wall-clock time, since the expiry is shared between processes
+        now = time.time()
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO tokens "
+            "(run_id, data, expires_at, workspace, batch_id) VALUES (?, ?, ?, ?, ?)",
+            (
+                run_id,
+                json.dumps(data),
+                now + ttl_seconds,
+                data.get("workspace"),
+                data.get("batch_id"),
+            ),
+        )
+        self._purge_expired(conn, now)
+
+    def get(self, run_id):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT data FROM tokens WHERE run_id = ? AND expires_at > ?",
+                (run_id, time.time()),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def delete(self, run_id):
+        self._connect().execute("DELETE FROM tokens WHERE run_id = ?", (run_id,))
+
+    def get_many(self, run_ids, chunk_size=500):
+        conn = self._connect()
+        now = time.time()
+        found = {}
+        run_ids = list(run_ids)
+        # Stay under SQLite's bound-parameter limit
+        for i in range(0, len(run_ids), chunk_size):
+            chunk = run_ids[i : i + chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT run_id, data FROM tokens "
+                f"WHERE run_id IN ({placeholders}) AND expires_at > ?",
+                (*chunk, now),
+            )
+            found.update((run_id, json.loads(data)) for run_id, data in rows)
+        return found
+
+    def find(self, field, value):
+        if field not in INDEX_FIELDS:
+            raise ValueError(f"Cannot look up tokens by {field!r}")
+        rows = self._connect().execute(
+            f"SELECT run_id, data FROM tokens WHERE {field} = ? AND expires_at > ?",
+            (value, time.time()),
+        )
+        return {run_id: json.loads(data) for run_id, data in rows}
+
+    def pop_expired(self, limit=100):
+        if not self.track_expiry:
+            return []
+        conn = self._connect()
+        now = time.time()
+        rows = conn.execute(
+            "SELECT run_id, data, expires_at FROM tokens WHERE expires_at <= ? "
+            "AND (retry_at IS NULL OR retry_at <= ?) ORDER BY expires_at LIMIT ?",
+            (now, now, limit),
+        ).fetchall()
+        claimed = []
+        for run_id, data, expires_at in rows:
+            # Another worker may have claimed or re-stored it since the SELECT
+            cursor = conn.execute(
+                "DELETE FROM tokens WHERE run_id = ? AND expires_at = ?",
+                (run_id, expires_at),
+            )
+            if cursor.rowcount == 1:
+                claimed.append((run_id, json.loads(data)))
+        return claimed
+
+    def requeue_expired(self, run_id, data, delay_seconds):
+        if not self.track_expiry:
+            return
+        now = time.time()
+        # OR IGNORE keeps a token stored for the run since the claim
+        self._connect().execute(
+            "INSERT OR IGNORE INTO tokens "
+            "(run_id, data, expires_at, retry_at) VALUES (?, ?, ?, ?)",
+            (run_id, json.dumps(data), now, now + delay_seconds),
+        )
+
+
+REDIS_EXPIRY_KEY = "teams-approval:expiry"
+REDIS_EXPIRY_LEADER_KEY = "teams-approval:expiry:leader"
+
+
+def redis_index_key(field, value):
+    return f"teams-approval:index:{field}:{value}"
+
+
+def decode_token(raw, now):
+    """
+    Decode a stored token, returning None if its logical expiry has passed.
+    Tracked tokens outlive their TTL in Redis by the grace period.
+    """
+    if raw is None:
+        return None
+    data = json.loads(raw)
+    expires_at = data.pop("_expires_at", None)
+    if expires_at is not None and expires_at <= now:
+        return None
+    return data
+
+
+def parse_sorted_index(flat):
+    """
+    Split the reply of `SORT <index> BY nosort GET # GET *` into
+    ({run_id: data}, [run_ids whose token has gone]).
+    """
+    found, stale = {}, []
+    for run_id, raw in zip(flat[::2], flat[1::2]):
+        if isinstance(run_id, bytes):
+            run_id = run_id.decode("utf-8")
+        if raw is None:
+            stale.append(run_id)
+            continue
+        data = decode_token(raw, time.time())
+        if data is not None:
+            found[run_id] = data
+    return found, stale
+
+
+class RedisKeyLayout:
+    """
+    How tokens are written to Redis, shared by the sync and async stores.
+
+    With `track_expiry`, each token records its logical expiry as
+    `_expires_at` and outlives it in Redis by `expiry_grace_seconds`. Its
+    deadline also goes into a sorted set, so expired runs are found with one
+    range query instead of a key scan.
+    """
+
+    def __init__(self, track_expiry=False, expiry_grace_seconds=300.0):
+        self.track_expiry = track_expiry
+        self.expiry_grace_seconds = expiry_grace_seconds
+
+    def queue_set(self, pipe, run_id, data, ttl_seconds):
+        if self.track_expiry:
+            deadline = time.time() + ttl_seconds
+            pipe.setex(
+                run_id,
+                int(ttl_seconds + self.expiry_grace_seconds),
+                json.dumps(dict(data, _expires_at=deadline)),
+            )
+            pipe.zadd(REDIS_EXPIRY_KEY, {run_id: deadline})
+        else:
+            pipe.setex(run_id, ttl_seconds, json.dumps(data))
+        for field in INDEX_FIELDS:
+            if data.get(field):
+                key = redis_index_key(field, data[field])
+                pipe.sadd(key, run_id)
+                pipe.expire(key, ttl_seconds)
+
+    def queue_requeue(self, pipe, run_id, data, delay_seconds):
+        # Stored already expired, so `get` ignores it; the sorted set score
+        # holds it back from the sweep until the retry is due. NX on both
+        # leaves a token stored for the run since the claim alone.
+        now = time.time()
+        pipe.set(
+            run_id,
+            json.dumps(dict(data, _expires_at=now)),
+            ex=int(delay_seconds + self.expiry_grace_seconds),
+            nx=True,
+        )
+        pipe.zadd(REDIS_EXPIRY_KEY, {run_id: now + delay_seconds}, nx=True)
+
+    def needs_pipeline(self, data):
+        return self.track_expiry or any(data.get(field) for field in INDEX_FIELDS)
+
+
+class RedisTokenStore(TokenStore):
+    """
+    Redis-backed store shared by every replica. Redis enforces the TTL itself.
+
+    Index entries live in one set per (field, value). Members are not removed
+    when a token is deleted or expires; lookups drop them lazily instead, so
+    `delete` stays a single DEL. The same goes for the expiry sorted set:
+    a deleted run's entry is discarded when the sweep finds no token for it.
+    """
+
+    name = "redis"
+
+    def __init__(self, client, track_expiry=False, expiry_grace_seconds=300.0):
+        self.client = client
+        self.layout = RedisKeyLayout(track_expiry, expiry_grace_seconds)
+
+    def set(self, run_id, data, ttl_seconds):
+        if not self.layout.needs_pipeline(data):
+            self.client.setex(run_id, ttl_seconds, json.dumps(data))
+            return
+        pipe = self.client.pipeline(transaction=False)
+        self.layout.queue_set(pipe, run_id, data, ttl_seconds)
+        pipe.execute()
+
+    def get(self, run_id):
+        return decode_token(self.client.get(run_id), time.time())
+
+    def delete(self, run_id):
+        self.client.delete(run_id)
+
+    def get_many(self, run_ids):
+        run_ids = list(run_ids)
+        if not run_ids:
+            return {}
+        now = time.time()
+        found = {}
+        for run_id, raw in zip(run_ids, self.client.mget(run_ids)):
+            data = decode_token(raw, now)
+            if data is not None:
+                found[run_id] = data
+        return found
+
+    def find(self, field, value):
+        key = redis_index_key(field, value)
+        # One round trip: SORT ... GET # GET * returns each member alongside
+        # the value of the key it names, i.e. run_id followed by its token.
+        found, stale = parse_sorted_index(
+            self.client.sort(key, by="nosort", get=["#", "*"])
+        )
+        if stale:
+            self.client.srem(key, *stale)
+        return found
+
+    def pop_expired(self, limit=100):
+        if not self.layout.track_expiry:
+            return []
+        now = time.time()
+        due = self.client.zrangebyscore(REDIS_EXPIRY_KEY, "-inf", now, 0, limit)
+        if not due:
+            return []
+        # ZREM succeeds for exactly one caller, which is what makes a claim
+        # exactly-once across replicas
+        pipe = self.client.pipeline(transaction=False)
+        for run_id in due:
+            pipe.zrem(REDIS_EXPIRY_KEY, run_id)
+        won = [run_id for run_id, removed in zip(due, pipe.execute()) if removed]
+        if not won:
+            return []
+
+        claimed, restore, expired_keys = [], {}, []
+        for run_id, raw in zip(won, self.client.mget(won)):
+            if isinstance(run_id, bytes):
+                run_id = run_id.decode("utf-8")
+            if raw is None:
+                continue  # Approved, rejected or past the grace period
+            data = json.loads(raw)
+            expires_at = data.pop("_expires_at", 0)
+            if expires_at > now:
+                # Re-stored after the range query; put its new deadline back
+                restore[run_id] = expires_at
+                continue
+            claimed.append((run_id, data))
+            expired_keys.append(run_id)
+
+        pipe = self.client.pipeline(transaction=False)
+        if restore:
+            pipe.zadd(REDIS_EXPIRY_KEY, restore)
+        if expired_keys:
+            pipe.delete(*expired_keys)
+        pipe.execute()
+        return claimed
+
+    def requeue_expired(self, run_id, data, delay_seconds):
+        if not self.layout.track_expiry:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        self.layout.queue_requeue(pipe, run_id, data, delay_seconds)
+        pipe.execute()
+
+    def try_lead(self, owner, lease_seconds):
+        lease_ms = int(lease_seconds * 1000)
+        if self.client.set(REDIS_EXPIRY_LEADER_KEY, owner, nx=True, px=lease_ms):
+            return True
+        current = self.client.get(REDIS_EXPIRY_LEADER_KEY)
+        if isinstance(current, bytes):
+            current = current.decode("utf-8")
+        if current == owner:
+            self.client.pexpire(REDIS_EXPIRY_LEADER_KEY, lease_ms)
+            return True
+        return False
+
+
+#
+# Async adapters (ASGI mode)
+#
+class AsyncRedisTokenStore:
+    """
+    RedisTokenStore for a `redis.asyncio` client. Same keys and TTL semantics,
+    so sync and async deployments can share one Redis.
+    """
+
+    name = "redis"
+
+    def __init__(self, client, track_expiry=False, expiry_grace_seconds=300.0):
+        self.client = client
+        self.layout = RedisKeyLayout(track_expiry, expiry_grace_seconds)
+
+    async def set(self, run_id, data, ttl_seconds):
+        pipe = self.client.pipeline(transaction=False)
+        self.layout.queue_set(pipe, run_id, data, ttl_seconds)
+        await pipe.execute()
+
+    async def get(self, run_id):
+        return decode_token(await self.client.get(run_id), time.time())
+
+    async def delete(self, run_id):
+        await self.client.delete(run_id)
+
+    async def get_many(self, run_ids):
+        run_ids = list(run_ids)
+        if not run_ids:
+            return {}
+        now = time.time()
+        found = {}
+        for run_id, raw in zip(run_ids, await self.client.mget(run_ids)):
+            data = decode_token(raw, now)
+            if data is not None:
+                found[run_id] = data
+        return found
+
+    async def find(self, field, value):
+        key = redis_index_key(field, value)
+        found, stale = parse_sorted_index(
+            await self.client.sort(key, by="nosort", get=["#", "*"])
+        )
+        if stale:
+            await self.client.srem(key, *stale)
+        return found
+
+
+class AsyncLocalTokenStore:
+    """
+    Wraps a local TokenStore for use from the event loop. SQLite calls run
+    in a worker thread so disk I/O never stalls the loop; memory calls are
+    cheap enough to make directly.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.name = store.name
+        self._offload = isinstance(store, SQLiteTokenStore)
+
+    async def _call(self, fn, *args):
+        if self._offload:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def set(self, run_id, data, ttl_seconds):
+        await self._call(self.store.set, run_id, data, ttl_seconds)
+
+    async def get(self, run_id):
+        return await self._call(self.store.get, run_id)
+
+    async def delete(self, run_id):
+        await self._call(self.store.delete, run_id)
+
+    async def get_many(self, run_ids):
+        return await self._call(self.store.get_many, run_ids)
+
+    async def find(self, field, value):
+        return await self._call(self.store.find, field, value)